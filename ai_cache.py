@@ -0,0 +1,114 @@
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from typing import Dict, Optional
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS completions (
+    key TEXT PRIMARY KEY,
+    provider TEXT NOT NULL,
+    model TEXT NOT NULL,
+    created REAL NOT NULL,
+    text TEXT NOT NULL,
+    usage TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_completions_created ON completions (created);
+"""
+
+_WS_RE = re.compile(r'\s+')
+
+
+def normalize_prompt(prompt: str) -> str:
+    """Whitespace-insensitive form of a prompt for cache keys."""
+    return _WS_RE.sub(' ', prompt or '').strip()
+
+
+def cache_key(provider: str, model: str, prompt: str) -> str:
+    raw = f"{provider}\x00{model}\x00{normalize_prompt(prompt)}"
+    return hashlib.sha256(raw.encode('utf-8')).hexdigest()
+
+
+class AICache:
+    """Persistent cache of AI completions keyed by (provider, model, normalized prompt).
+
+    Entries older than the caller's TTL are ignored (and pruned on write); at most
+    ``max_entries`` of the newest are kept. Stores the raw response text and usage so a
+    hit is parsed exactly like a fresh answer.
+    """
+
+    def __init__(self, path: str, max_entries: int = 500):
+        self.path = path
+        self.max_entries = max_entries
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def get(self, provider: str, model: str, prompt: str, ttl: float) -> Optional[Dict]:
+        """Cached completion younger than ttl seconds: {'text', 'usage', 'age_s', 'key'} or None."""
+        key = cache_key(provider, model, prompt)
+        try:
+            with self._lock:
+                row = self._db().execute('SELECT created, text, usage FROM completions WHERE key = ?', (key,)).fetchone()
+        except Exception as e:
+            print(f"DEBUG: AI cache read failed: {e}")
+            row = None
+        if row is None or time.time() - row[0] > ttl:
+            self.misses += 1
+            return None
+        self.hits += 1
+        try:
+            usage = json.loads(row[2]) if row[2] else None
+        except ValueError:
+            usage = None
+        return {'text': row[1], 'usage': usage, 'age_s': round(time.time() - row[0], 1), 'key': key[:12]}
+
+    def put(self, provider: str, model: str, prompt: str, text: str, usage: Optional[Dict], ttl: float) -> None:
+        if not text:
+            return
+        key = cache_key(provider, model, prompt)
+        now = time.time()
+        try:
+            with self._lock:
+                conn = self._db()
+                conn.execute(
+                    'INSERT OR REPLACE INTO completions (key, provider, model, created, text, usage) VALUES (?, ?, ?, ?, ?, ?)',
+                    (key, provider, model, now, text, json.dumps(usage) if usage else None),
+                )
+                conn.execute('DELETE FROM completions WHERE created < ?', (now - ttl,))
+                conn.execute(
+                    'DELETE FROM completions WHERE key NOT IN (SELECT key FROM completions ORDER BY created DESC LIMIT ?)',
+                    (self.max_entries,),
+                )
+                conn.commit()
+        except Exception as e:
+            print(f"DEBUG: AI cache write failed: {e}")
+
+    def clear(self) -> None:
+        with self._lock:
+            conn = self._db()
+            conn.execute('DELETE FROM completions')
+            conn.commit()
+
+    def stats(self) -> Dict:
+        try:
+            with self._lock:
+                entries = self._db().execute('SELECT COUNT(*) FROM completions').fetchone()[0]
+        except Exception:
+            entries = None
+        return {'entries': entries, 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses, 'path': self.path}
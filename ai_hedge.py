@@ -0,0 +1,99 @@
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, wait
+from typing import Callable, Dict, List, Optional
+
+
+def _attempt(call: Callable, parse: Callable, cand) -> Dict:
+    """Run one candidate end to end; never raises so usage survives a parse failure."""
+    t0 = time.time()
+    out = {'content': None, 'usage': None, 'timings': None, 'parsed': None, 'error': None, 'latency_ms': None}
+    try:
+        result = call(cand)  # (text, usage) or ai_providers.AIResult
+        out['content'], out['usage'] = result[0], result[1]
+        out['timings'] = result[2] if len(result) > 2 else None
+        out['latency_ms'] = (time.time() - t0) * 1000
+        out['parsed'] = parse(out['content'])
+    except Exception as e:
+        if out['latency_ms'] is None:
+            out['latency_ms'] = (time.time() - t0) * 1000
+        out['error'] = e
+    return out
+
+
+def run_hedged(candidates: List, call: Callable, parse: Callable, delay_for: Callable, executor,
+               on_attempt: Optional[Callable] = None, max_in_flight: int = 2) -> Dict:
+    """Call candidates in order, hedging onto the next one when the current one is slow.
+
+    The next candidate starts when the newest in-flight one has not answered within
+    ``delay_for(cand)`` seconds (never if it returns None, i.e. plain sequential
+    fallback), or immediately when one fails. The first result whose ``parse``
+    succeeds wins. Slower attempts are not cancelled (HTTP calls cannot be
+    interrupted); they finish in the background and are still reported to
+    ``on_attempt(cand, position, result, won)`` so their usage is counted.
+
+    Returns {'winner': cand | None, 'result': attempt dict | None, 'attempts': [...],
+    'hedges': n, 'abandoned': [...]}.
+    """
+    pending = {}
+    attempts = []
+    state = {'next': 0, 'hedges': 0}
+    report_lock = threading.Lock()
+
+    def report(cand, position, res, won):
+        if on_attempt is None:
+            return
+        try:
+            with report_lock:
+                on_attempt(cand, position, res, won)
+        except Exception as e:
+            print(f"DEBUG: hedge attempt report failed: {e}")
+
+    def launch():
+        position = state['next']
+        cand = candidates[position]
+        state['next'] += 1
+        pending[executor.submit(_attempt, call, parse, cand)] = (position, cand, time.time())
+
+    winner = None
+    if candidates:
+        launch()
+    while pending and winner is None:
+        timeout = None
+        if state['next'] < len(candidates) and len(pending) < max_in_flight:
+            newest = max(pending.values(), key=lambda v: v[2])
+            delay = delay_for(newest[1])
+            if delay is not None:
+                timeout = max(0.0, newest[2] + float(delay) - time.time())
+        done, _ = wait(list(pending), timeout=timeout, return_when=FIRST_COMPLETED)
+        if not done:
+            state['hedges'] += 1
+            launch()
+            continue
+        failed = False
+        for fut in sorted(done, key=lambda f: pending[f][0]):
+            position, cand, _ = pending.pop(fut)
+            res = fut.result()
+            won = winner is None and res['error'] is None
+            if won:
+                winner = (cand, res)
+            else:
+                failed = failed or res['error'] is not None
+            attempts.append({'candidate': cand, 'position': position, 'latency_ms': round(res['latency_ms'] or 0, 1),
+                             'error': str(res['error'])[:200] if res['error'] else None, 'won': won})
+            report(cand, position, res, won)
+        if winner is None and failed and state['next'] < len(candidates):
+            launch()
+
+    # Losers still running: report them whenever they finish
+    abandoned = []
+    for fut, (position, cand, _) in pending.items():
+        abandoned.append(cand)
+        fut.add_done_callback(lambda f, c=cand, p=position: report(c, p, f.result(), False))
+    return {
+        'winner': winner[0] if winner else None,
+        'result': winner[1] if winner else None,
+        'attempts': attempts,
+        'hedges': state['hedges'],
+        'abandoned': abandoned,
+    }
@@ -0,0 +1,143 @@
+import json
+import re
+from typing import Dict, List, Optional, Tuple
+
+
+_ITEM_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'title': {'type': 'string'},
+        'year': {'type': 'integer'},
+        'tmdb_id': {'type': 'integer'},
+    },
+    'required': ['title', 'year'],
+}
+
+# Shape requested in every recommendation prompt; passed to providers with native
+# structured output (Gemini response_schema, OpenAI-style response_format)
+RECOMMENDATIONS_SCHEMA = {
+    'type': 'object',
+    'properties': {
+        'shows': {'type': 'array', 'items': _ITEM_SCHEMA},
+        'movies': {'type': 'array', 'items': _ITEM_SCHEMA},
+        'categories': {'type': 'array', 'items': {'type': 'string'}},
+    },
+    'required': ['shows', 'movies', 'categories'],
+}
+
+_FENCE_RE = re.compile(r'^```[a-zA-Z]*\s*|\s*```\s*$')
+_CLOSERS = {'{': '}', '[': ']'}
+_MAX_REPAIR_TRIES = 25
+
+
+def _strip_fences(text: str) -> str:
+    return _FENCE_RE.sub('', text.strip())
+
+
+def _drop_trailing_commas(text: str) -> str:
+    """Remove commas directly before } or ] (outside strings)."""
+    out = []
+    in_str = escape = False
+    for ch in text:
+        if in_str:
+            out.append(ch)
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_str = False
+            continue
+        if ch == '"':
+            in_str = True
+        elif ch in '}]':
+            # Walk back over whitespace to a dangling comma
+            j = len(out) - 1
+            while j >= 0 and out[j] in ' \t\r\n':
+                j -= 1
+            if j >= 0 and out[j] == ',':
+                del out[j]
+        out.append(ch)
+    return ''.join(out)
+
+
+def _safe_points(text: str, start: int) -> List[Tuple[int, Tuple[str, ...]]]:
+    """Positions after each complete array element / container, with the open-bracket stack there.
+
+    Cutting the text at one of these points and appending the matching closers yields
+    JSON that only contains complete items."""
+    points = []
+    stack: List[str] = []
+    in_str = escape = False
+    for i in range(start, len(text)):
+        ch = text[i]
+        if in_str:
+            if escape:
+                escape = False
+            elif ch == '\\':
+                escape = True
+            elif ch == '"':
+                in_str = False
+                if stack and stack[-1] == '[':
+                    points.append((i + 1, tuple(stack)))  # complete string element
+            continue
+        if ch == '"':
+            in_str = True
+        elif ch in '{[':
+            stack.append(ch)
+        elif ch in '}]':
+            if not stack or _CLOSERS[stack[-1]] != ch:
+                break  # malformed beyond this point
+            stack.pop()
+            points.append((i + 1, tuple(stack)))
+            if not stack:
+                break  # end of the first top-level value
+    return points
+
+
+def repair_json(text: str) -> Optional[str]:
+    """Salvage the longest prefix of a (possibly truncated) JSON object made of complete items."""
+    start = text.find('{')
+    if start == -1:
+        return None
+    for end, stack in reversed(_safe_points(text, start)[-_MAX_REPAIR_TRIES:]):
+        candidate = _drop_trailing_commas(text[start:end].rstrip().rstrip(',') + ''.join(_CLOSERS[c] for c in reversed(stack)))
+        try:
+            json.loads(candidate)
+            return candidate
+        except ValueError:
+            continue
+    return None
+
+
+def parse_json_object(text: Optional[str]) -> Tuple[Optional[str], Optional[Dict], Dict]:
+    """(json text, parsed object, info) from a model response; never raises.
+
+    Tries, in order: the whole (fence-stripped) text, the first-{ to last-} slice, the
+    slice without trailing commas, then ``repair_json``. ``info['method']`` says which
+    one worked; ``info['repaired']`` is True when content had to be dropped or fixed."""
+    info = {'method': None, 'repaired': False}
+    if not text:
+        return None, None, info
+    body = _strip_fences(text)
+    attempts = [('direct', body)]
+    start, end = body.find('{'), body.rfind('}')
+    if start != -1 and end > start:
+        attempts.append(('slice', body[start:end + 1]))
+        attempts.append(('trailing_commas', _drop_trailing_commas(body[start:end + 1])))
+    for method, candidate in attempts:
+        try:
+            obj = json.loads(candidate)
+        except ValueError:
+            continue
+        if isinstance(obj, dict):
+            info['method'] = method
+            info['repaired'] = method == 'trailing_commas'
+            return candidate, obj, info
+    repaired = repair_json(body)
+    if repaired is not None:
+        obj = json.loads(repaired)
+        if isinstance(obj, dict):
+            info.update(method='repaired', repaired=True, dropped_chars=max(0, len(body) - len(repaired)))
+            return repaired, obj, info
+    return None, None, info
@@ -0,0 +1,298 @@
+import json
+import threading
+from abc import ABC, abstractmethod
+import time
+from collections import namedtuple
+from typing import Dict, Iterator, Optional
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# Prefer new google-genai SDK; fall back to legacy google-generativeai if present
+try:
+    from google import genai as genai  # google-genai
+    GENAI_SDK = 'new'
+except Exception:
+    try:
+        import google.generativeai as genai  # legacy
+        GENAI_SDK = 'legacy'
+    except Exception:
+        genai = None
+        GENAI_SDK = None
+
+
+# text: full completion; usage: prompt/candidates/total *_token_count (None when unknown);
+# timings: request_s (call start -> full answer), first_chunk_s when streaming
+AIResult = namedtuple('AIResult', ['text', 'usage', 'timings'])
+
+
+def _usage(prompt_tokens=None, output_tokens=None, total_tokens=None) -> Dict:
+    return {
+        'prompt_token_count': prompt_tokens,
+        'candidates_token_count': output_tokens,
+        'total_token_count': total_tokens,
+    }
+
+
+class AIProvider(ABC):
+    """One AI backend. ``generate(prompt, model, schema, stream)`` -> AIResult.
+
+    Instances are shared across requests and threads (see ``get_provider``), so
+    backends keep their HTTP clients/sessions and reuse pooled connections.
+    """
+
+    name = ''
+    endpoint = ''
+    default_model = ''
+
+    def __init__(self, api_key: str, timeout: float = 30.0):
+        self.api_key = api_key
+        self.timeout = timeout
+        # Models that rejected native structured output; asked for plain text from then on
+        self._no_schema = set()
+
+    @abstractmethod
+    def generate(self, prompt: str, model: Optional[str] = None, schema: Optional[Dict] = None,
+                 stream: bool = False) -> AIResult:
+        """Complete ``prompt``. ``schema`` is a JSON schema for the response (used by
+        backends with native structured output); ``stream`` reads the answer incrementally."""
+
+    @staticmethod
+    def _schema_rejected(error) -> bool:
+        """True if a failed call looks like the model refusing the structured-output options."""
+        resp = getattr(error, 'response', None)
+        status = getattr(resp, 'status_code', None)
+        text = (getattr(resp, 'text', '') or '') if resp is not None else ''
+        msg = f"{error} {text}".lower()
+        if status is not None and status not in (400, 422):
+            return False
+        if status is None and '400' not in msg and 'invalid_argument' not in msg:
+            return False
+        return any(k in msg for k in ('schema', 'response_format', 'mime', 'json mode', 'json_object'))
+
+    def _with_schema(self, model: str, schema: Optional[Dict], call):
+        """call(schema or None); falls back to plain output once if the model rejects the schema."""
+        use = schema if schema and model not in self._no_schema else None
+        try:
+            return call(use)
+        except Exception as e:
+            if use is None or not self._schema_rejected(e):
+                raise
+            print(f"DEBUG: {self.name}/{model} rejected structured output ({e}); using plain text")
+            self._no_schema.add(model)
+            return call(None)
+
+
+class GeminiProvider(AIProvider):
+    """google-genai SDK (one client per API key)."""
+
+    name = 'gemini'
+    endpoint = 'https://generativelanguage.googleapis.com/v1beta/models'
+    default_model = 'gemini-2.5-flash-lite'
+
+    def __init__(self, api_key: str, timeout: float = 30.0):
+        super().__init__(api_key, timeout)
+        # HttpOptions.timeout is in milliseconds; without it a hung call holds its worker forever
+        self._client = genai.Client(api_key=api_key, http_options=genai.types.HttpOptions(timeout=int(self.timeout * 1000)))
+
+    @staticmethod
+    def _usage_from(response) -> Optional[Dict]:
+        usage_meta = getattr(response, 'usage_metadata', None)
+        if usage_meta is None:
+            return None
+        if isinstance(usage_meta, dict):
+            return usage_meta
+        return _usage(getattr(usage_meta, 'prompt_token_count', None),
+                      getattr(usage_meta, 'candidates_token_count', None),
+                      getattr(usage_meta, 'total_token_count', None))
+
+    def generate(self, prompt, model=None, schema=None, stream=False):
+        model = model or self.default_model
+        t0 = time.time()
+
+        def call(use_schema):
+            config = None
+            if use_schema:
+                config = genai.types.GenerateContentConfig(response_mime_type='application/json', response_schema=use_schema)
+            if not stream:
+                response = self._client.models.generate_content(model=model, contents=prompt, config=config)
+                return AIResult(getattr(response, 'text', None), self._usage_from(response),
+                                {'request_s': time.time() - t0})
+            parts, usage, first = [], None, None
+            for chunk in self._client.models.generate_content_stream(model=model, contents=prompt, config=config):
+                if first is None:
+                    first = time.time() - t0
+                parts.append(getattr(chunk, 'text', None) or '')
+                usage = self._usage_from(chunk) or usage
+            return AIResult(''.join(parts), usage, {'request_s': time.time() - t0, 'first_chunk_s': first})
+
+        return self._with_schema(model, schema, call)
+
+
+class GeminiLegacyProvider(GeminiProvider):
+    """google-generativeai SDK. Its API key is process-global, so calls are serialized.
+
+    Only JSON mode is requested here; schema support varies across SDK releases."""
+
+    default_model = 'gemini-pro'
+    _lock = threading.Lock()
+
+    def __init__(self, api_key: str, timeout: float = 30.0):
+        AIProvider.__init__(self, api_key, timeout)
+
+    def generate(self, prompt, model=None, schema=None, stream=False):
+        model = model or self.default_model
+        return self._with_schema(model, schema, lambda use_schema: self._generate(prompt, model, use_schema, stream))
+
+    def _generate(self, prompt, model, schema, stream):
+        t0 = time.time()
+        config = {'response_mime_type': 'application/json'} if schema else None
+        with self._lock:
+            genai.configure(api_key=self.api_key)
+            response = genai.GenerativeModel(model).generate_content(prompt, stream=stream, generation_config=config,
+                                                                      request_options={'timeout': self.timeout})
+            first = None
+            if stream:
+                parts = []
+                for chunk in response:
+                    if first is None:
+                        first = time.time() - t0
+                    parts.append(getattr(chunk, 'text', None) or '')
+                text = ''.join(parts)
+            else:
+                text = getattr(response, 'text', None)
+        timings = {'request_s': time.time() - t0}
+        if stream:
+            timings['first_chunk_s'] = first
+        return AIResult(text, self._usage_from(response), timings)
+
+
+class OpenAICompatibleProvider(AIProvider):
+    """Chat-completions style HTTP API over a pooled requests.Session."""
+
+    def __init__(self, api_key: str, timeout: float = 30.0, extra_headers: Optional[Dict] = None):
+        super().__init__(api_key, timeout)
+        self.session = requests.Session()
+        self.session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+        self.session.headers.update({'Authorization': f'Bearer {api_key}', 'Content-Type': 'application/json'})
+        if extra_headers:
+            self.session.headers.update(extra_headers)
+
+    def _payload(self, prompt, model, schema, stream) -> Dict:
+        data = {
+            'model': model or self.default_model,
+            'messages': [{'role': 'user', 'content': prompt}],
+            'temperature': 0.7,
+            'max_tokens': 4000,
+        }
+        if schema:
+            data['response_format'] = self._response_format(schema)
+        if stream:
+            data['stream'] = True
+        return data
+
+    def _response_format(self, schema: Dict) -> Dict:
+        return {'type': 'json_schema', 'json_schema': {'name': 'response', 'schema': schema}}
+
+    @staticmethod
+    def _usage_from(payload: Dict) -> Optional[Dict]:
+        usage = payload.get('usage') if isinstance(payload, dict) else None
+        if not usage:
+            return None
+        return _usage(usage.get('prompt_tokens'), usage.get('completion_tokens'), usage.get('total_tokens'))
+
+    def _iter_events(self, response) -> Iterator[Dict]:
+        """Server-sent events of a streamed completion."""
+        for line in response.iter_lines(decode_unicode=True):
+            if not line or not line.startswith('data:'):
+                continue
+            data = line[5:].strip()
+            if data == '[DONE]':
+                break
+            try:
+                yield json.loads(data)
+            except ValueError:
+                continue
+
+    def generate(self, prompt, model=None, schema=None, stream=False):
+        model = model or self.default_model
+        return self._with_schema(model, schema, lambda use_schema: self._generate(prompt, model, use_schema, stream))
+
+    def _generate(self, prompt, model, schema, stream):
+        t0 = time.time()
+        response = self.session.post(self.endpoint, json=self._payload(prompt, model, schema, stream),
+                                     timeout=self.timeout, stream=stream)
+        try:
+            response.raise_for_status()
+            if not stream:
+                result = response.json()
+                return AIResult(result['choices'][0]['message']['content'], self._usage_from(result),
+                                {'request_s': time.time() - t0})
+            parts, usage, first = [], None, None
+            for event in self._iter_events(response):
+                if first is None:
+                    first = time.time() - t0
+                for choice in event.get('choices') or []:
+                    parts.append((choice.get('delta') or {}).get('content') or '')
+                usage = self._usage_from(event) or usage
+            return AIResult(''.join(parts), usage, {'request_s': time.time() - t0, 'first_chunk_s': first})
+        finally:
+            response.close()
+
+
+class MistralProvider(OpenAICompatibleProvider):
+    name = 'mistral'
+    endpoint = 'https://api.mistral.ai/v1/chat/completions'
+    default_model = 'mistral-small'
+
+    def _response_format(self, schema):
+        # JSON mode works on every Mistral chat model; the prompt spells out the shape
+        return {'type': 'json_object'}
+
+
+class OpenRouterProvider(OpenAICompatibleProvider):
+    name = 'openrouter'
+    endpoint = 'https://openrouter.ai/api/v1/chat/completions'
+    default_model = 'anthropic/claude-3-haiku'
+
+    def __init__(self, api_key: str, timeout: float = 30.0, referer: str = ''):
+        super().__init__(api_key, timeout, extra_headers={'HTTP-Referer': referer or '', 'X-Title': 'Conjurr'})
+
+    def _payload(self, prompt, model, schema, stream):
+        data = super()._payload(prompt, model, schema, stream)
+        if stream:
+            data['usage'] = {'include': True}
+        return data
+
+
+PROVIDERS = {
+    'gemini': GeminiProvider if GENAI_SDK == 'new' else GeminiLegacyProvider,
+    'mistral': MistralProvider,
+    'openrouter': OpenRouterProvider,
+}
+
+_INSTANCES: Dict[tuple, AIProvider] = {}
+_INSTANCES_LOCK = threading.Lock()
+
+
+def get_provider(name: str, api_key: str, referer: str = '') -> AIProvider:
+    """Shared backend instance for (provider, key); raises ValueError if unusable."""
+    cls = PROVIDERS.get(name)
+    if cls is None:
+        raise ValueError(f"Unsupported AI provider: {name}")
+    if name == 'gemini' and GENAI_SDK is None:
+        raise ValueError('Google GenAI SDK not installed')
+    if not api_key:
+        raise ValueError(f"No API key configured for {name}")
+    key = (name, api_key, referer if name == 'openrouter' else '')
+    with _INSTANCES_LOCK:
+        inst = _INSTANCES.get(key)
+        if inst is None:
+            inst = cls(api_key, referer=referer) if name == 'openrouter' else cls(api_key)
+            _INSTANCES[key] = inst
+        return inst
+
+
+def default_model(name: str) -> str:
+    cls = PROVIDERS.get(name)
+    return cls.default_model if cls else ''
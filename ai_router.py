@@ -0,0 +1,204 @@
+import datetime
+import re
+import threading
+import time
+from collections import deque
+from typing import Callable, Dict, List, Optional, Tuple
+
+
+def _seconds_until_tomorrow() -> float:
+    now = datetime.datetime.now()
+    tomorrow = datetime.datetime.combine(now.date() + datetime.timedelta(days=1), datetime.time())
+    return max(60.0, (tomorrow - now).total_seconds())
+
+
+# 429 as a standalone status code, not part of a model id, date or request id
+_STATUS_429_RE = re.compile(r'(?<![\w.-])429(?![\w.-])')
+_EXHAUSTED_RE = re.compile(r'resource_exhausted|too many requests|rate[ _-]?limit|quota (?:exceeded|exhausted)|exceeded (?:your )?(?:current )?quota')
+
+
+def classify_error(error) -> Tuple[Optional[str], Optional[float]]:
+    """('quota_daily' | 'rate_limit' | None, cooldown seconds) for a failed AI call.
+
+    Only an HTTP 429 status (from the exception's response, or as a standalone code in
+    the message) or an explicit exhaustion/rate-limit code counts."""
+    msg = str(error or '')
+    low = msg.lower()
+    status = getattr(getattr(error, 'response', None), 'status_code', None) or getattr(error, 'code', None)
+    if not (status == 429 or _STATUS_429_RE.search(msg) or _EXHAUSTED_RE.search(low)):
+        return None, None
+    if 'perday' in low or 'per day' in low or 'daily' in low:
+        return 'quota_daily', _seconds_until_tomorrow()
+    # Per-minute limits: honour the server's retry hint when present
+    m = re.search(r'retry(?:[ _-]?delay)?\D{0,12}?(\d+(?:\.\d+)?)\s*s', low)
+    return 'rate_limit', min(float(m.group(1)), 600.0) if m else 60.0
+
+
+class _ModelHealth:
+    __slots__ = ('calls', 'consecutive_failures', 'open_until', 'open_reason', 'trips')
+
+    def __init__(self, window: int):
+        self.calls = deque(maxlen=window)  # (ts, ok, latency_ms)
+        self.consecutive_failures = 0
+        self.open_until = 0.0
+        self.open_reason: Optional[str] = None
+        self.trips = 0
+
+
+class ModelRouter:
+    """Orders candidate models before any call is made.
+
+    Models are skipped when their configured daily quota (``AI_DAILY_QUOTAS``) is used
+    up, when the provider reported quota/rate-limit exhaustion, or while a circuit
+    breaker is open after repeated failures (30s, doubling up to 10 min). Remaining
+    models are ranked by observed p50 latency inflated by recent error rate; an
+    explicitly selected model stays first while it is healthy.
+    """
+
+    def __init__(self, window: int = 50, stats_horizon: float = 3600.0, failure_threshold: int = 3,
+                 base_cooldown: float = 30.0, max_cooldown: float = 600.0):
+        self.window = window
+        self.stats_horizon = stats_horizon
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = base_cooldown
+        self.max_cooldown = max_cooldown
+        self._health: Dict[str, _ModelHealth] = {}
+        self._lock = threading.Lock()
+        self._seeded = False
+
+    def _get(self, model: str) -> _ModelHealth:
+        h = self._health.get(model)
+        if h is None:
+            h = self._health[model] = _ModelHealth(self.window)
+        return h
+
+    def seed(self, load_stats: Callable[[], Dict]) -> None:
+        """Prime latency/error estimates once from persisted telemetry (usage_tracker.get_call_stats)."""
+        if self._seeded:
+            return
+        self._seeded = True
+        try:
+            stats = load_stats() or {}
+        except Exception as e:
+            print(f"DEBUG: model router seed failed: {e}")
+            return
+        now = time.time()
+        with self._lock:
+            for row in stats.values():
+                model = row.get('model')
+                p50 = (row.get('latency_ms_ok') or {}).get('p50') or (row.get('latency_ms') or {}).get('p50')
+                if not model or p50 is None:
+                    continue
+                h = self._get(model)
+                if h.calls:
+                    continue
+                # A handful of synthetic samples so real calls quickly dominate
+                n = min(5, int(row.get('calls') or 0))
+                ok_n = round(n * float(row.get('parse_rate') or 0))
+                for i in range(n):
+                    h.calls.append((now, i < ok_n, float(p50)))
+
+    def record(self, model: str, latency_ms: Optional[float], ok: bool, error=None) -> None:
+        if not model:
+            return
+        now = time.time()
+        with self._lock:
+            h = self._get(model)
+            h.calls.append((now, bool(ok), latency_ms))
+            if ok:
+                h.consecutive_failures = 0
+                h.trips = 0
+                h.open_until = 0.0
+                h.open_reason = None
+                return
+            h.consecutive_failures += 1
+            kind, cooldown = classify_error(error)
+            if kind:
+                h.open_until = now + cooldown
+                h.open_reason = kind
+            elif h.consecutive_failures >= self.failure_threshold:
+                h.open_until = now + min(self.max_cooldown, self.base_cooldown * (2 ** h.trips))
+                h.open_reason = 'failing'
+                h.trips += 1
+
+    def _score(self, h: Optional[_ModelHealth], now: float) -> Tuple[float, float]:
+        """(error rate, p50 latency ms) over the recent window; unknown models score neutral."""
+        if h is None:
+            return 0.0, None
+        recent = [c for c in h.calls if now - c[0] <= self.stats_horizon]
+        if not recent:
+            return 0.0, None
+        err = sum(1 for c in recent if not c[1]) / len(recent)
+        lat = sorted(c[2] for c in recent if c[1] and c[2] is not None)
+        return err, (lat[len(lat) // 2] if lat else None)
+
+    def order(self, candidates: List[str], quotas: Optional[Dict] = None,
+              usage_today: Optional[Callable[[str], Dict]] = None, pinned: Optional[str] = None):
+        """Return (ordered models to try, {skipped model: reason}).
+
+        If every model is only circuit-open (not out of quota) they are returned anyway,
+        soonest-to-recover first, so a request is never refused on stale failures alone."""
+        now = time.time()
+        seen = set()
+        usable, broken, skipped = [], [], {}
+        for pref, model in enumerate(candidates):
+            if not model or model in seen:
+                continue
+            seen.add(model)
+            quota = (quotas or {}).get(model) if isinstance(quotas, dict) else None
+            remaining_frac = 1.0
+            if isinstance(quota, (int, float)) and quota > 0 and usage_today is not None:
+                try:
+                    used = int((usage_today(model) or {}).get('calls') or 0)
+                except Exception:
+                    used = 0
+                if used >= quota:
+                    skipped[model] = f'daily quota used ({used}/{int(quota)})'
+                    continue
+                remaining_frac = (quota - used) / float(quota)
+            with self._lock:
+                h = self._health.get(model)
+                open_until = h.open_until if h else 0.0
+                reason = h.open_reason if h else None
+                err, p50 = self._score(h, now)
+            if open_until > now:
+                skipped[model] = f'{reason} ({int(open_until - now)}s left)'
+                if reason != 'quota_daily':
+                    broken.append((open_until, model))
+                continue
+            # Expected cost: latency (unknown -> neutral 0 so preference order decides),
+            # inflated by error rate; nearly exhausted models sink to the back.
+            cost = (p50 or 0.0) * (1.0 + 4.0 * err) + (1e6 if remaining_frac < 0.1 else 0.0)
+            usable.append((model != pinned, cost, pref, model))
+        ordered = [m for *_, m in sorted(usable)]
+        if not ordered and broken:
+            ordered = [m for _, m in sorted(broken)]
+        return ordered, skipped
+
+    def latency_percentile(self, model: str, pct: float) -> Optional[float]:
+        """Nearest-rank percentile (ms) of recent successful call latency, None without data."""
+        now = time.time()
+        with self._lock:
+            h = self._health.get(model)
+            lat = sorted(c[2] for c in (h.calls if h else ()) if c[1] and c[2] is not None and now - c[0] <= self.stats_horizon)
+        if not lat:
+            return None
+        k = max(0, min(len(lat) - 1, int(-(-pct * len(lat) // 100)) - 1))
+        return lat[k]
+
+    def stats(self) -> Dict:
+        now = time.time()
+        out = {}
+        with self._lock:
+            for model, h in self._health.items():
+                err, p50 = self._score(h, now)
+                out[model] = {
+                    'samples': len(h.calls),
+                    'error_rate': round(err, 3),
+                    'p50_ms': round(p50, 1) if p50 is not None else None,
+                    'consecutive_failures': h.consecutive_failures,
+                    'open': h.open_until > now,
+                    'open_reason': h.open_reason if h.open_until > now else None,
+                    'open_for_s': max(0, int(h.open_until - now)),
+                }
+        return out
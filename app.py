@@ -1,26 +1,29 @@
-from rapidfuzz import fuzz, process
+from rapidfuzz import fuzz
 from flask import Flask, jsonify, render_template, request, send_from_directory, g, redirect, url_for, abort
 import requests
 import os, shutil, sys
 from pathlib import Path
 from dotenv import load_dotenv, set_key, dotenv_values, find_dotenv
 import configparser
-from usage_tracker import record_usage, get_usage_today
-from collections import Counter
-# Prefer new google-genai SDK; fall back to legacy google-generativeai if present
-try:
-    from google import genai as genai  # google-genai
-    _GENAI_SDK = 'new'
-except Exception:
-    try:
-        import google.generativeai as genai  # legacy
-        _GENAI_SDK = 'legacy'
-    except Exception:
-        genai = None
-        _GENAI_SDK = None
+from usage_tracker import record_usage, get_usage_today, record_call, get_call_stats, get_recent_calls
+from title_normalize import normalize_title, normalize_titles, get_title_variations, cache_info as title_cache_info
+from title_matcher import score_one_to_many, best_matches
+from title_index import TitleIndex
+from availability import AvailabilityChain, AvailabilityTier, LocalAvailabilityIndex, DEFAULT_TIER_ORDER, DEFAULT_TIER_TIMEOUTS, summarize_tier_stats
+from history_service import HistoryService
+from history_replica import HistoryReplica
+from user_directory import UserDirectory, display_name
+from ai_router import ModelRouter
+from ai_hedge import run_hedged
+from ai_json import RECOMMENDATIONS_SCHEMA, parse_json_object
+from ai_cache import AICache
+from prompt_builder import DEFAULT_HISTORY_BUDGET, build_history_context, calibrate, estimate_tokens
+from taste_profile import TasteProfileStore, render as render_taste_profile, score as taste_score, summarize as summarize_taste_profile, watched_ids as taste_watched_ids
+from candidate_pool import CandidatePoolStore
+from local_recommender import Catalogue as LocalCatalogue, GENRE_CODE_IDS as _LOCAL_GENRE_IDS, as_recommendations as local_recommendations, rank as local_rank
+from ai_providers import GENAI_SDK as _GENAI_SDK, PROVIDERS as _AI_PROVIDERS, get_provider, default_model as _ai_default_model
 import time
 import threading
-import re
 import json
 from datetime import datetime, date, time as datetime_time
 from concurrent.futures import ThreadPoolExecutor, as_completed
@@ -206,6 +209,12 @@ def cache_info():
     <p>Persistent cache file: {'Exists' if cache_file_exists else 'Not found'}</p>
     <p>Cache file size: {cache_file_size} bytes</p>
     <p>Cache file path: {_TMDB_CACHE_FILE}</p>
+    <p>Title normalization memo: {title_cache_info()}</p>
+    <p>History summaries: {_HISTORY_SERVICE.stats()}</p>
+    <p>AI responses: {_AI_CACHE.stats()}</p>
+    <p>Taste profiles: {_TASTE_PROFILES.stats()}</p>
+    <p>Candidate pools: {_CANDIDATE_POOLS.stats()}</p>
+    <p>Segment pools: {_SEGMENT_POOLS.stats()}</p>
     <br>
     <a href="/cache/clear">Clear Cache</a> | <a href="/cache/save">Save Cache</a> | <a href="/">Back to Main</a>
     """
@@ -215,6 +224,12 @@ def clear_cache():
     global _TMDB_SEARCH_CACHE
     with _TMDB_CACHE_LOCK:
         _TMDB_SEARCH_CACHE.clear()
+    _LOCAL_AVAILABILITY_INDEX.clear()
+    _HISTORY_SERVICE.clear()
+    _AI_CACHE.clear()
+    _TASTE_PROFILES.clear()
+    _CANDIDATE_POOLS.clear()
+    _SEGMENT_POOLS.clear()
     if os.path.exists(_TMDB_CACHE_FILE):
         os.remove(_TMDB_CACHE_FILE)
     return "Cache cleared. <a href='/cache'>Back to cache info</a>"
@@ -255,6 +270,18 @@ def get_settings():
         'AI_PROVIDER': 'gemini',
         'AI_MODEL': '',
         'AI_DAILY_QUOTAS': '',
+        'AVAILABILITY_TIERS': '',
+        'AVAILABILITY_TIER_TIMEOUTS': '',
+        'AI_HEDGE': '0',
+        'AI_HEDGE_PERCENTILE': '90',
+        'AI_HEDGE_DELAY': '8',
+        'AI_CACHE_TTL': '3600',
+        'AI_PROMPT_TOKEN_BUDGET': str(DEFAULT_HISTORY_BUDGET),
+        'TASTE_PROFILE_LOOKUPS': '60',
+        'RECOMMENDATION_POOL_SIZE': '40',
+        'RECOMMENDATION_POOL_TTL': '21600',
+        'SEGMENT_POOL_TTL': '86400',
+        'AI_LOCAL_FALLBACK': '1',
     }
     # Suggested default DB path (Windows)
     try:
@@ -365,6 +392,61 @@ def reload_settings():
                 # keep raw as fallback string id
                 include_ids.add(p)
     g.TAUTULLI_INCLUDE_LIBRARIES = set()  # deprecated
+    # Availability tier chain: comma-separated order (subset of local, overseerr, tautulli_db, plex)
+    raw_tiers = settings.get('AVAILABILITY_TIERS') or ''
+    tiers = [t.strip().lower() for t in str(raw_tiers).split(',') if t.strip()]
+    g.AVAILABILITY_TIERS = [t for t in tiers if t in DEFAULT_TIER_ORDER] or list(DEFAULT_TIER_ORDER)
+    g.AVAILABILITY_TIER_TIMEOUTS = {}
+    try:
+        raw_tt = settings.get('AVAILABILITY_TIER_TIMEOUTS')
+        if raw_tt:
+            parsed_tt = json.loads(raw_tt)
+            if isinstance(parsed_tt, dict):
+                g.AVAILABILITY_TIER_TIMEOUTS = {str(k).lower(): float(v) for k, v in parsed_tt.items() if isinstance(v, (int, float))}
+    except Exception:
+        g.AVAILABILITY_TIER_TIMEOUTS = {}
+    # Hedged AI requests: start the next candidate once the current one is slower than
+    # its own p<AI_HEDGE_PERCENTILE> latency (AI_HEDGE_DELAY seconds until there is data)
+    g.AI_HEDGE = str(settings.get('AI_HEDGE') or '').strip().lower() in ('1', 'true', 'yes', 'on')
+    try:
+        g.AI_HEDGE_PERCENTILE = min(99.0, max(50.0, float(settings.get('AI_HEDGE_PERCENTILE') or 90)))
+    except (TypeError, ValueError):
+        g.AI_HEDGE_PERCENTILE = 90.0
+    try:
+        g.AI_HEDGE_DELAY = max(0.5, float(settings.get('AI_HEDGE_DELAY') or 8))
+    except (TypeError, ValueError):
+        g.AI_HEDGE_DELAY = 8.0
+    # Reuse AI answers for identical prompts for this many seconds (0 disables)
+    try:
+        g.AI_CACHE_TTL = max(0.0, float(settings.get('AI_CACHE_TTL') or 0))
+    except (TypeError, ValueError):
+        g.AI_CACHE_TTL = 3600.0
+    # Token budget for the watch-history part of AI prompts
+    try:
+        g.AI_PROMPT_TOKEN_BUDGET = max(100, int(settings.get('AI_PROMPT_TOKEN_BUDGET') or DEFAULT_HISTORY_BUDGET))
+    except (TypeError, ValueError):
+        g.AI_PROMPT_TOKEN_BUDGET = DEFAULT_HISTORY_BUDGET
+    # TMDb searches per request for watched titles not yet in the user's taste profile
+    try:
+        g.TASTE_PROFILE_LOOKUPS = max(0, int(settings.get('TASTE_PROFILE_LOOKUPS') or 0))
+    except (TypeError, ValueError):
+        g.TASTE_PROFILE_LOOKUPS = 60
+    # Titles generated per media type for a user's candidate pool, and how long it is reused (0 = off)
+    try:
+        g.RECOMMENDATION_POOL_SIZE = min(100, max(20, int(settings.get('RECOMMENDATION_POOL_SIZE') or 40)))
+    except (TypeError, ValueError):
+        g.RECOMMENDATION_POOL_SIZE = 40
+    try:
+        g.RECOMMENDATION_POOL_TTL = max(0.0, float(settings.get('RECOMMENDATION_POOL_TTL') or 0))
+    except (TypeError, ValueError):
+        g.RECOMMENDATION_POOL_TTL = 21600.0
+    # Custom mode: one shared AI run per decade/genre/mood segment for this long (0 = per-user runs)
+    try:
+        g.SEGMENT_POOL_TTL = max(0.0, float(settings.get('SEGMENT_POOL_TTL') or 0))
+    except (TypeError, ValueError):
+        g.SEGMENT_POOL_TTL = 86400.0
+    # Rank cached TMDb metadata locally when the AI run fails (AI_PROVIDER=local always does)
+    g.AI_LOCAL_FALLBACK = str(settings.get('AI_LOCAL_FALLBACK') or '').strip().lower() in ('1', 'true', 'yes', 'on')
     # AI Provider Configuration
     g.AI_PROVIDER = settings.get('AI_PROVIDER', 'gemini')
     g.AI_MODEL = settings.get('AI_MODEL', '').strip()
@@ -388,28 +470,22 @@ def reload_settings():
         except Exception:
             g.AI_DAILY_QUOTAS = {}
     
-    # Initialize AI clients based on provider
-    g.genai_client = None
-    g.genai_sdk = None
+    # AI clients live in ai_providers (created once per key and reused across requests)
+    g.genai_sdk = _GENAI_SDK if g.AI_PROVIDER == 'gemini' and settings.get('GOOGLE_API_KEY') else None
     if g.AI_PROVIDER == 'gemini' and settings.get('GOOGLE_API_KEY'):
         g.GOOGLE_API_KEY = settings['GOOGLE_API_KEY']
-        if genai is not None:
-            try:
-                if _GENAI_SDK == 'new':
-                    g.genai_client = genai.Client(api_key=g.GOOGLE_API_KEY)
-                    g.genai_sdk = 'new'
-                elif _GENAI_SDK == 'legacy':
-                    genai.configure(api_key=g.GOOGLE_API_KEY)
-                    g.genai_client = 'legacy'
-                    g.genai_sdk = 'legacy'
-            except Exception:
-                g.genai_client = None
-                g.genai_sdk = None
     elif g.AI_PROVIDER == 'mistral' and settings.get('MISTRAL_API_KEY'):
         g.MISTRAL_API_KEY = settings['MISTRAL_API_KEY']
     elif g.AI_PROVIDER == 'openrouter' and settings.get('OPENROUTER_API_KEY'):
         g.OPENROUTER_API_KEY = settings['OPENROUTER_API_KEY']
     
+    # Keys for every provider, so hedging can fall over to the others
+    g.AI_PROVIDER_KEYS = {
+        'gemini': settings.get('GOOGLE_API_KEY', ''),
+        'mistral': settings.get('MISTRAL_API_KEY', ''),
+        'openrouter': settings.get('OPENROUTER_API_KEY', ''),
+    }
+
     # Keep old variables for backward compatibility
     g.GOOGLE_API_KEY = settings.get('GOOGLE_API_KEY', '')
     g.GEMINI_MODEL = g.AI_MODEL
@@ -596,9 +672,11 @@ class PlexClient:
                     
                     if items:
                         logs.append(f"Found {len(items)} {media_type} result(s) for '{search_title}' in library")
+                        normalized_plex_titles = normalize_titles([item.get('title', 'Unknown') for item in items])
+                        similarities = score_one_to_many(normalized_original, normalized_plex_titles, scorer=fuzz.ratio)
                         
                         # Validate the match using fuzzy comparison
-                        for item in items:
+                        for item, similarity in zip(items, similarities.tolist()):
                             plex_title = item.get('title', 'Unknown')
                             item_type = item.get('type', 'unknown')
                             
@@ -610,10 +688,7 @@ class PlexClient:
                                 logs.append(f"Skipping '{plex_title}' - wrong type: {item_type}")
                                 continue
                             
-                            normalized_plex = normalize_title(plex_title)
-                            
-                            # Use fuzzy matching to verify similarity
-                            similarity = fuzz.ratio(normalized_original, normalized_plex)
+                            similarity = round(similarity, 1)
                             
                             # Require 70% similarity to confirm match (lowered to handle anthology series)
                             if similarity >= 70:
@@ -647,38 +722,56 @@ def get_plex_client():
     return plex_client
 
 
-_USER_CACHE = { 'users': None, 'hash': None, 'ts': 0 }
-_USER_CACHE_LOCK = threading.Lock()
+# Availability answers remembered from slower tiers (Overseerr / Tautulli DB / Plex)
+_LOCAL_AVAILABILITY_INDEX = LocalAvailabilityIndex()
 
-def _hash_users(user_list):
-    try:
-        # Build a stable hash based on user_id + username + email
-        parts = []
-        for u in user_list or []:
-            try:
-                parts.append(f"{u.get('user_id')}|{(u.get('username') or '').lower()}|{(u.get('email') or '').lower()}")
-            except Exception:
-                continue
-        import hashlib
-        return hashlib.sha1('\n'.join(sorted(parts)).encode('utf-8')).hexdigest()
-    except Exception:
-        return None
+# Tautulli DB library titles, cached briefly per (db_path, media_type, library filter)
+_DB_LIBRARY_TITLES_CACHE = {}
+_DB_LIBRARY_TITLES_LOCK = threading.Lock()
+_DB_LIBRARY_TITLES_TTL = 600
+
+def _get_db_library_titles(db_path, media_type, section_ids=None):
+    """Return a TitleIndex over library titles from the Tautulli DB.
 
-# Low-level fetch (no caching) from Tautulli / DB
-def _fetch_users_raw():
+    Returns None when the DB only offers the partial watched-titles fallback, since that
+    cannot tell us what is currently in the library."""
+    if not db_path:
+        return None
+    key = (db_path, media_type, tuple(sorted(str(s) for s in (section_ids or []))))
+    now = time.time()
+    with _DB_LIBRARY_TITLES_LOCK:
+        ent = _DB_LIBRARY_TITLES_CACHE.get(key)
+        if ent and now - ent[0] <= _DB_LIBRARY_TITLES_TTL:
+            return ent[1]
+    from tautulli_db import db_get_all_library_titles
+    titles = db_get_all_library_titles(db_path, media_type, section_ids=list(section_ids or []) or None)
+    value = None
+    if titles and titles[-1] != '__PARTIAL__':
+        value = TitleIndex(titles)
+    with _DB_LIBRARY_TITLES_LOCK:
+        _DB_LIBRARY_TITLES_CACHE[key] = (now, value)
+    return value
+
+
+# Low-level fetch (no caching) from Tautulli / DB. Takes explicit settings (not g) so the
+# user directory can call it from its background refresher.
+def _fetch_users_raw(settings):
+    tautulli_url = settings.get('TAUTULLI_URL') or ''
+    tautulli_api_key = settings.get('TAUTULLI_API_KEY') or ''
+    db_path = settings.get('TAUTULLI_DB_PATH') or ''
     # Prefer DB if available
-    if getattr(g, 'use_tautulli_db', False):
+    if db_path and os.path.exists(db_path):
         try:
             from tautulli_db import db_get_users
-            db_users = db_get_users(g.TAUTULLI_DB_PATH)
+            db_users = db_get_users(db_path)
             # Best-effort: enrich with API data to populate email/username if missing
             params = {
-                'apikey': g.TAUTULLI_API_KEY,
+                'apikey': tautulli_api_key,
                 'cmd': 'get_users'
             }
             api_users = []
             try:
-                resp = requests.get(f"{g.TAUTULLI_URL}/api/v2", params=params, timeout=5)
+                resp = requests.get(f"{tautulli_url}/api/v2", params=params, timeout=5)
                 data = resp.json()
                 payload = data.get('response', {}).get('data', [])
                 if isinstance(payload, list):
@@ -720,11 +813,11 @@ def _fetch_users_raw():
             pass
     # Fallback to API
     params = {
-        'apikey': g.TAUTULLI_API_KEY,
+        'apikey': tautulli_api_key,
         'cmd': 'get_users'
     }
     try:
-        resp = requests.get(f"{g.TAUTULLI_URL}/api/v2", params=params, timeout=2)
+        resp = requests.get(f"{tautulli_url}/api/v2", params=params, timeout=2)
         data = resp.json()
         payload = data.get('response', {}).get('data', [])
         # Tautulli may return a list directly or under a 'users' or 'data' key
@@ -745,239 +838,38 @@ def _fetch_users_raw():
     except Exception:
         return []
 
-def refresh_user_cache_if_changed():
-    """Fetch latest users and update cache only if membership changed.
-    Called during recommendation generation (POST) to detect updates lazily."""
-    try:
-        latest = _fetch_users_raw()
-        new_hash = _hash_users(latest)
-        with _USER_CACHE_LOCK:
-            if new_hash and new_hash != _USER_CACHE['hash']:
-                _USER_CACHE['users'] = latest
-                _USER_CACHE['hash'] = new_hash
-                _USER_CACHE['ts'] = time.time()
-    except Exception:
-        pass
-
-def get_cached_users():
-    """Return cached users (may be None on first run). Does not trigger network."""
-    with _USER_CACHE_LOCK:
-        users = _USER_CACHE['users']
-    # If cache empty, perform one lazy fill (non-blocking future calls reused)
-    if users is None:
-        users = _fetch_users_raw()
-        with _USER_CACHE_LOCK:
-            _USER_CACHE['users'] = users
-            _USER_CACHE['hash'] = _hash_users(users)
-            _USER_CACHE['ts'] = time.time()
-    return users
-
-# Helper to fetch user watch history from Tautulli
-def get_user_watch_history_api(user_id, selected_libraries=None):
-    """Always fetch recent (bounded window) history via API for top/recent calculations."""
-    one_year_ago = int(time.time()) - 365*24*60*60
-    params = {
-        'apikey': g.TAUTULLI_API_KEY,
-        'cmd': 'get_history',
-        'user_id': user_id,
-        'length': 1000,
-        'after': one_year_ago
-    }
-    try:
-        resp = requests.get(f"{g.TAUTULLI_URL}/api/v2", params=params, timeout=5)
-        data = resp.json()
-        items = data.get('response', {}).get('data', {}).get('data', [])
-        
-        # Filter by selected libraries if provided and section_id is available
-        if selected_libraries and items:
-            selected_libraries = [str(lib) for lib in selected_libraries]  # Ensure string format
-            filtered_items = []
-            for item in items:
-                section_id = item.get('section_id')
-                if section_id is None or str(section_id) in selected_libraries:
-                    filtered_items.append(item)
-            items = filtered_items
-        
-        return items
-    except Exception:
-        return []
+def _fetch_users_current():
+    """User list using the current saved settings (works outside a request)."""
+    return _fetch_users_raw(get_settings())
 
-def get_user_watch_history(user_id, selected_libraries=None):
-    """Retained for backward compatibility: prefer DB for recent subset if available, else API.
-    Not used for top/recent anymore (we explicitly call API)."""
-    one_year_ago = int(time.time()) - 365*24*60*60
-    if getattr(g, 'use_tautulli_db', False):
-        try:
-            from tautulli_db import db_get_user_watch_history
-            return db_get_user_watch_history(g.TAUTULLI_DB_PATH, user_id, after=one_year_ago, limit=1000, selected_libraries=selected_libraries)
-        except Exception:
-            pass
-    return get_user_watch_history_api(user_id, selected_libraries)
+# Indexed user list, refreshed in the background instead of on every recommendation POST
+_USER_DIRECTORY = UserDirectory(_fetch_users_current)
 
-# Helper to fetch the user's entire watch history from Tautulli (paginated)
-def get_user_watch_history_all(user_id, selected_libraries=None):
-    # Prefer DB if available
-    if getattr(g, 'use_tautulli_db', False):
-        try:
-            from tautulli_db import db_get_user_watch_history_all
-            return db_get_user_watch_history_all(g.TAUTULLI_DB_PATH, user_id, selected_libraries=selected_libraries)
-        except Exception:
-            pass
-    start = 0
-    page_size = 1000
-    all_items = []
-    total_records = None
-    while True:
-        params = {
-            'apikey': g.TAUTULLI_API_KEY,
-            'cmd': 'get_history',
-            'user_id': user_id,
-            'start': start,
-            'length': page_size
-        }
-        try:
-            resp = requests.get(f"{g.TAUTULLI_URL}/api/v2", params=params, timeout=15)
-            data = resp.json()
-            payload = data.get('response', {}).get('data', {})
-            items = payload.get('data', []) if isinstance(payload, dict) else []
-            if total_records is None and isinstance(payload, dict):
-                total_records = payload.get('recordsTotal') or payload.get('recordsFiltered')
-            if not items:
-                break
-            
-            # Filter by selected libraries if provided
-            if selected_libraries:
-                selected_libraries = [str(lib) for lib in selected_libraries]  # Ensure string format
-                filtered_items = []
-                for item in items:
-                    section_id = item.get('section_id')
-                    if section_id is None or str(section_id) in selected_libraries:
-                        filtered_items.append(item)
-                items = filtered_items
-            
-            all_items.extend(items)
-            # Stop if we've collected all records
-            if total_records is not None and len(all_items) >= int(total_records):
-                break
-            start += page_size
-        except Exception:
-            break
-    return all_items
+def get_cached_users():
+    """Return cached users. Does not trigger network except for the very first fill."""
+    return _USER_DIRECTORY.users()
+
+# Per-user history summaries (one fetch per change; local replica > Tautulli DB > API)
+_HISTORY_SERVICE = HistoryService(
+    replica=HistoryReplica(os.path.join(get_appdata_dir(), 'history_replica.db')),
+    snapshot_dir=os.path.join(get_appdata_dir(), 'history_snapshots'),
+)
+
+# Picks the AI model order per request from quota, recent errors and latency
+_MODEL_ROUTER = ModelRouter()
+
+
+def get_user_history_summary(user_id, selected_libraries=None):
+    """Top/recent/watched summary for the recommender, from a single history snapshot."""
+    return _HISTORY_SERVICE.get_summary(
+        user_id,
+        selected_libraries,
+        db_path=g.TAUTULLI_DB_PATH if getattr(g, 'use_tautulli_db', False) else None,
+        api_url=g.TAUTULLI_URL,
+        api_key=g.TAUTULLI_API_KEY,
+    )
 
 # Helpers
-def normalize_title(title: str) -> str:
-    if not title:
-        return ''
-    t = title.lower()
-    
-    # Handle common character/word substitutions before removing special chars
-    # Convert & to "and" 
-    t = re.sub(r'\s*&\s*', ' and ', t)
-    t = re.sub(r'\s*\+\s*', ' and ', t)
-    
-    # Preserve important differentiators before normalization
-    # Keep Jr, Sr, III, etc. as they are significant differentiators
-    important_suffixes = ['jr', 'sr', 'ii', 'iii', 'iv', 'v']
-    preserved_suffix = ''
-    for suffix in important_suffixes:
-        pattern = rf'\b{suffix}\.?\s*$'
-        if re.search(pattern, t):
-            preserved_suffix = f' {suffix}'
-            t = re.sub(pattern, '', t).strip()
-            break
-    
-    # Remove all non-alphanumeric except spaces
-    t = re.sub(r'[^a-z0-9 ]', '', t)
-    
-    # Remove common articles but KEEP "and" as it's often significant
-    # Only remove leading articles
-    t = re.sub(r'^\bthe\b\s+', '', t)  # Remove "the" only at start
-    t = re.sub(r'^\ba\b\s+', '', t)    # Remove "a" only at start
-    t = re.sub(r'^\ban\b\s+', '', t)   # Remove "an" only at start
-    
-    # Clean up multiple spaces and add back preserved suffix
-    t = re.sub(r'\s+', ' ', t).strip()
-    t += preserved_suffix
-    return t.strip()
-
-def get_title_variations(title: str) -> set[str]:
-    """Generate multiple variations of a title for better matching"""
-    if not title:
-        return set()
-    
-    variations = set()
-    title_lower = title.lower()
-    
-    # Always add the normalized version
-    normalized = normalize_title(title)
-    if normalized:
-        variations.add(normalized)
-    
-    # Add original lowercased
-    variations.add(title_lower)
-    
-    # Handle anthology series patterns (e.g., "The Haunting of Hill House" -> "The Haunting")
-    anthology_patterns = [
-        r'^(.*?)\s+of\s+[^:]+$',  # "The Haunting of Hill House" -> "The Haunting"
-        r'^(.*?):\s+.*$',          # "American Horror Story: Coven" -> "American Horror Story"
-    ]
-    for pattern in anthology_patterns:
-        match = re.match(pattern, title_lower)
-        if match:
-            anthology_base = match.group(1).strip()
-            if anthology_base:
-                variations.add(anthology_base)
-                # Also add normalized version
-                anthology_normalized = normalize_title(anthology_base)
-                if anthology_normalized:
-                    variations.add(anthology_normalized)
-    
-    # Remove common version suffixes for core matching
-    version_suffixes = [
-        r'\s+xl\b',           # "QI XL" -> "QI"
-        r'\s+extended\b',     # "Movie Extended" -> "Movie"
-        r'\s+uncut\b',        # "Movie Uncut" -> "Movie"
-        r'\s+directors?\s*cut\b',  # "Movie Director's Cut" -> "Movie" (handles apostrophe)
-        r'\s+ultimate\s+edition\b', # "Movie Ultimate Edition" -> "Movie"
-        r'\s+special\s+edition\b',  # "Movie Special Edition" -> "Movie"
-        r'\s+remastered\b',   # "Movie Remastered" -> "Movie"
-        r'\s+redux\b',        # "Movie Redux" -> "Movie"
-        r'\s+\d+th\s+anniversary\b',  # "Movie 25th Anniversary" -> "Movie"
-    ]
-    
-    for suffix_pattern in version_suffixes:
-        base_title = re.sub(suffix_pattern, '', title_lower)
-        if base_title != title_lower:
-            variations.add(base_title)
-            # Also add normalized version of base title
-            base_normalized = normalize_title(base_title)
-            if base_normalized:
-                variations.add(base_normalized)
-    
-    # Remove articles from beginning
-    for article in ['the ', 'a ', 'an ']:
-        if title_lower.startswith(article):
-            variant = title_lower[len(article):]
-            variations.add(variant)
-            # Add normalized version of variant too
-            variant_normalized = normalize_title(variant)
-            if variant_normalized:
-                variations.add(variant_normalized)
-    
-    # Remove year from title if present
-    year_pattern = r'\s*\(\d{4}\)\s*$'
-    title_no_year = re.sub(year_pattern, '', title_lower)
-    if title_no_year != title_lower:
-        variations.add(title_no_year)
-        # Add normalized version without year
-        no_year_normalized = normalize_title(title_no_year)
-        if no_year_normalized:
-            variations.add(no_year_normalized)
-    
-    # Remove empty strings
-    variations.discard('')
-    return variations
-
 def fuzzy_available(ai_list, library_list, watched_set, threshold=80):
     """Deprecated full fuzzy matcher retained as a fallback if enabled.
     Set ENABLE_FUZZY_FALLBACK=1 in environment to activate when TMDb/Overseerr fail."""
@@ -985,22 +877,26 @@ def fuzzy_available(ai_list, library_list, watched_set, threshold=80):
         return [], []
     available = []
     debug_matches = []
-    norm_library = [normalize_title(lib) for lib in library_list]
+    norm_library = normalize_titles(library_list)
+    library_years = [_extract_year_from_title(lib) for lib in library_list]
+    # One matrix per query form ("title year" first, then bare title) instead of extractOne per item
+    ai_rows = []
     for ai_item in ai_list:
         ai_title = ai_item.get('title') if isinstance(ai_item, dict) else ai_item
         ai_year = ai_item.get('year') if isinstance(ai_item, dict) else None
-        if not ai_title:
-            continue
-        norm_ai_title = normalize_title(ai_title)
-        candidates = [norm_ai_title]
-        if ai_year:
-            candidates.insert(0, f"{norm_ai_title} {ai_year}")
+        if ai_title:
+            ai_rows.append((ai_title, ai_year, normalize_title(ai_title)))
+    plain = best_matches([n for _, _, n in ai_rows], norm_library, scorer=fuzz.token_sort_ratio, score_cutoff=threshold,
+                         query_years=[y for _, y, _ in ai_rows], choice_years=library_years)
+    with_year_rows = [i for i, (_, y, _) in enumerate(ai_rows) if y]
+    with_year = best_matches([f"{ai_rows[i][2]} {ai_rows[i][1]}" for i in with_year_rows], norm_library, scorer=fuzz.token_sort_ratio, score_cutoff=threshold,
+                             query_years=[ai_rows[i][1] for i in with_year_rows], choice_years=library_years)
+    with_year_by_row = dict(zip(with_year_rows, with_year))
+    for i, (ai_title, ai_year, _) in enumerate(ai_rows):
         matched_title = None
         best_score = 0
-        for cand in candidates:
-            match = process.extractOne(cand, norm_library, scorer=fuzz.token_sort_ratio, score_cutoff=threshold) or (None,0,None)
-            _, score, idx = match
-            if score > best_score and match[0] is not None and idx is not None:
+        for idx, score in (with_year_by_row.get(i, (None, 0.0)), plain[i]):
+            if idx is not None and score > best_score:
                 matched_title = library_list[idx]
                 best_score = score
         debug_matches.append({'ai_title': ai_title, 'ai_year': ai_year, 'match': matched_title, 'score': best_score})
@@ -1012,20 +908,21 @@ def fuzzy_available(ai_list, library_list, watched_set, threshold=80):
 def _poster_url_from_result(result: dict) -> str | None:
     return None
 
-def _tmdb_search(media_type: str, title: str, year: int | None):
-    # Use TMDb's search endpoints
+def _tmdb_search(media_type: str, title: str, year: int | None, api_key: str | None = None):
+    # Use TMDb's search endpoints (pass api_key when calling outside a request, e.g. from a worker thread)
     try:
-        if not getattr(g, 'TMDB_API_KEY', ''):
+        api_key = api_key or getattr(g, 'TMDB_API_KEY', '')
+        if not api_key:
             return None
         base = 'https://api.themoviedb.org/3'
         if media_type == 'movie':
             url = f"{base}/search/movie"
-            params = {'api_key': g.TMDB_API_KEY, 'query': title, 'include_adult': 'false'}
+            params = {'api_key': api_key, 'query': title, 'include_adult': 'false'}
             if year:
                 params['year'] = year
         else:
             url = f"{base}/search/tv"
-            params = {'api_key': g.TMDB_API_KEY, 'query': title, 'include_adult': 'false'}
+            params = {'api_key': api_key, 'query': title, 'include_adult': 'false'}
             if year:
                 params['first_air_date_year'] = year
         resp = requests.get(url, params=params, timeout=8)
@@ -1034,8 +931,10 @@ def _tmdb_search(media_type: str, title: str, year: int | None):
         if not results:
             return None
         ntarget = normalize_title(title)
+        norm_names = normalize_titles([it.get('title') or it.get('name') or '' for it in results])
+        title_scores = score_one_to_many(ntarget, norm_names, scorer=fuzz.token_sort_ratio)
+        score_by_id = {id(it): float(sc) for it, sc in zip(results, title_scores)}
         def score_item(it):
-            name = it.get('title') or it.get('name') or ''
             year_field = it.get('release_date') or it.get('first_air_date') or ''
             year_val = None
             if isinstance(year_field, str) and len(year_field) >= 4:
@@ -1043,7 +942,7 @@ def _tmdb_search(media_type: str, title: str, year: int | None):
                     year_val = int(year_field[:4])
                 except Exception:
                     year_val = None
-            title_score = fuzz.token_sort_ratio(ntarget, normalize_title(name))
+            title_score = score_by_id[id(it)]
             year_bonus = 5 if (year and year_val == year) else 0
             return (title_score + year_bonus, title_score, it.get('popularity') or 0)
         # Sort with composite keys: primary = title+year bonus, secondary = raw title score, tertiary = popularity
@@ -1056,10 +955,22 @@ def _tmdb_search(media_type: str, title: str, year: int | None):
         tmdb_id = best.get('id')
         if not tmdb_id:
             return None
-        return { 'poster_url': poster_url, 'tmdb_id': tmdb_id }
+        return _tmdb_search_entry(best, poster_url)
     except Exception:
         return None
 
+def _tmdb_search_entry(item: dict, poster_url: str, tmdb_id: int | None = None) -> dict:
+    """Search-cache entry for a TMDb result: poster and id plus title, genre_ids, year, popularity
+    and rating for taste profiles and the local recommender."""
+    genre_ids = item.get('genre_ids')
+    if genre_ids is None:
+        # Detail responses carry [{'id', 'name'}] instead of ids
+        genre_ids = [gn.get('id') for gn in item.get('genres') or [] if isinstance(gn, dict) and gn.get('id')]
+    date_field = item.get('release_date') or item.get('first_air_date') or ''
+    year = int(date_field[:4]) if isinstance(date_field, str) and date_field[:4].isdigit() else None
+    return {'poster_url': poster_url, 'tmdb_id': tmdb_id or item.get('id'), 'genre_ids': list(genre_ids), 'year': year,
+            'title': item.get('title') or item.get('name'), 'popularity': item.get('popularity'), 'vote': item.get('vote_average')}
+
 def _extract_year_from_title(t: str) -> int | None:
     # Try to detect a year in parentheses
     if not t:
@@ -1273,7 +1184,7 @@ def get_posters_for_titles(media_type: str, titles: list[str], year_map: dict |
                             jd = resp_d.json() or {}
                             path = jd.get('poster_path')
                             if path:
-                                res_direct = {'poster_url': f"https://image.tmdb.org/t/p/w342{path}", 'tmdb_id': preset_id}
+                                res_direct = _tmdb_search_entry(jd, f"https://image.tmdb.org/t/p/w342{path}", preset_id)
                     except Exception:
                         res_direct = None
                     _TMDB_SEARCH_CACHE[key_direct] = res_direct
@@ -1304,6 +1215,9 @@ def get_posters_for_titles(media_type: str, titles: list[str], year_map: dict |
                     results = j.get('results') or []
                     if results:
                         ntarget = normalize_title(title)
+                        norm_names = normalize_titles([it.get('title') or it.get('name') or '' for it in results])
+                        title_scores = score_one_to_many(ntarget, norm_names, scorer=fuzz.token_sort_ratio)
+                        score_by_id = {id(it): float(sc) for it, sc in zip(results, title_scores)}
                         
                         # Debug: Log the search and what we found
                         print(f"TMDb search for '{title}' (year hint: {year_hint}): Found {len(results)} results")
@@ -1317,7 +1231,7 @@ def get_posters_for_titles(media_type: str, titles: list[str], year_map: dict |
                                     year_val = int(year_field[:4])
                                 except Exception:
                                     year_val = None
-                            title_score = fuzz.token_sort_ratio(ntarget, normalize_title(name))
+                            title_score = score_by_id[id(it)]
                             # Give much stronger year bonus (50 points) to prioritize exact year matches
                             year_bonus = 50 if (year_hint and year_val == year_hint) else 0
                             # Penalize items from different years when we have a year hint
@@ -1346,7 +1260,7 @@ def get_posters_for_titles(media_type: str, titles: list[str], year_map: dict |
                         path = best.get('poster_path')
                         tmdb_id = best.get('id')
                         if path and tmdb_id:
-                            result = {'poster_url': f"https://image.tmdb.org/t/p/w342{path}", 'tmdb_id': tmdb_id}
+                            result = _tmdb_search_entry(best, f"https://image.tmdb.org/t/p/w342{path}")
             except Exception:
                 pass
 
@@ -1367,15 +1281,17 @@ def get_posters_for_titles(media_type: str, titles: list[str], year_map: dict |
                             results2 = j2.get('results') or []
                             if results2:
                                 ntarget2 = normalize_title(title)
+                                norm_names2 = normalize_titles([it.get('title') or it.get('name') or '' for it in results2])
+                                title_scores2 = score_one_to_many(ntarget2, norm_names2, scorer=fuzz.token_sort_ratio)
+                                score_by_id2 = {id(it): float(sc) for it, sc in zip(results2, title_scores2)}
                                 def score_item2(it):
-                                    name = it.get('title') or it.get('name') or ''
-                                    title_score = fuzz.token_sort_ratio(ntarget2, normalize_title(name))
+                                    title_score = score_by_id2[id(it)]
                                     return (title_score, it.get('popularity') or 0)
                                 best2 = sorted(results2, key=score_item2, reverse=True)[0]
                                 path2 = best2.get('poster_path')
                                 tmdb_id2 = best2.get('id')
                                 if path2 and tmdb_id2:
-                                    result = {'poster_url': f"https://image.tmdb.org/t/p/w342{path2}", 'tmdb_id': tmdb_id2}
+                                    result = _tmdb_search_entry(best2, f"https://image.tmdb.org/t/p/w342{path2}")
                         _TMDB_SEARCH_CACHE[fallback_key] = result
                     except Exception:
                         _TMDB_SEARCH_CACHE[fallback_key] = None
@@ -1469,6 +1385,7 @@ def get_posters_for_titles(media_type: str, titles: list[str], year_map: dict |
                 'runtime': runtime_str,
                 'vote': vote,
                 'media_type': media_type,
+                'genre_ids': search.get('genre_ids'),
             }
             results.append((orig_idx, result_item))
 
@@ -1492,27 +1409,302 @@ def get_posters_for_titles(media_type: str, titles: list[str], year_map: dict |
 
     return posters
 
-def extract_json_object(text: str) -> str | None:
-    if not text:
-        return None
-    # Strip code fences if present
-    txt = text.strip()
-    if txt.startswith('```'):
-        # remove first fence line and possible language
-        parts = txt.split('\n', 1)
-        txt = parts[1] if len(parts) > 1 else txt
-        if txt.endswith('```'):
-            txt = txt[: -3]
-    # Find the first top-level JSON object using simple bracket matching
-    start = txt.find('{')
-    end = txt.rfind('}')
-    if start != -1 and end != -1 and end > start:
-        return txt[start:end+1]
-    return None
+def _record_ai_call(provider, model, latency_ms, usage, parse_ok, position=0, error=None):
+    """Telemetry row for one model attempt; also feeds the model router (never raises)."""
+    try:
+        ut = usage if isinstance(usage, dict) else {}
+        record_call(provider, model, latency_ms, ut.get('prompt_token_count'), ut.get('candidates_token_count'),
+                    parse_ok=parse_ok, position=position, error=error)
+        _MODEL_ROUTER.record(model, latency_ms, parse_ok, error)
+    except Exception as e:
+        print(f"DEBUG: AI telemetry record failed: {e}")
+
+
+def _route_models(candidates, pinned=None):
+    """(models to try in order, {skipped model: reason}) for the current request's quotas."""
+    _MODEL_ROUTER.seed(lambda: get_call_stats(24))
+    ordered, skipped = _MODEL_ROUTER.order(candidates, quotas=getattr(g, 'AI_DAILY_QUOTAS', None) or {},
+                                           usage_today=get_usage_today, pinned=pinned)
+    return ordered, skipped
+
+
+# Preferred Gemini model order (a model chosen in Settings is tried first)
+_GEMINI_DEFAULT_ORDER = ['gemini-2.5-flash-lite', 'gemini-2.0-flash-001']
+# AI attempts run here so a slow model can be hedged; losers finish in the background
+_AI_EXECUTOR = ThreadPoolExecutor(max_workers=6, thread_name_prefix='ai')
+# Completed AI answers by (provider, model, normalized prompt)
+_AI_CACHE = AICache(os.path.join(get_appdata_dir(), 'ai_cache.db'))
+# Per-user taste profiles (genre/decade histograms, franchises, watched TMDb ids)
+_TASTE_PROFILES = TasteProfileStore(os.path.join(get_appdata_dir(), 'taste_profiles.db'))
+# Resolved, over-generated recommendation runs paged out per (user, mode, filters)
+_CANDIDATE_POOLS = CandidatePoolStore()
+# Shared custom-mode runs per (decade, genre, mood, season), personalized from the user pools
+_SEGMENT_POOLS = CandidatePoolStore(max_entries=64)
+# History stand-in for shared segment runs
+_EMPTY_HISTORY = {
+    'top_shows': [], 'top_movies': [], 'recent_shows': [], 'recent_movies': [],
+    'watched_set_all': frozenset(), 'watched_shows': [], 'watched_movies': [],
+    'watched_shows_all': [], 'watched_movies_all': [], 'watched_shows_total': 0, 'watched_movies_total': 0, 'recent_window_count': 0,
+    'history_count': 0, 'source': 'segment', 'cached': False,
+}
 
 
+def _taste_lookup(api_key, max_lookups):
+    """lookup(media_type, titles) for TasteProfileStore.update: TMDb search-cache entries
+    first, then at most max_lookups live searches per request (the rest stay pending)."""
+    budget = {'left': max_lookups}
+
+    def lookup(media_type, titles):
+        out, misses = {}, []
+        for title in titles:
+            hit = _TMDB_SEARCH_CACHE.get(_get_cache_key(media_type, title, None))
+            if isinstance(hit, dict) and 'genre_ids' in hit:
+                out[title] = hit
+            else:
+                misses.append(title)
+        if not api_key:
+            # Nothing to search with: fold without metadata so franchises still count
+            out.update({title: None for title in misses})
+            return out
+        batch = misses[:budget['left']]
+        budget['left'] -= len(batch)
+        if batch:
+            with ThreadPoolExecutor(max_workers=min(len(batch), 8)) as executor:
+                found = executor.map(lambda t: _tmdb_search(media_type, t, None, api_key), batch)
+                for title, res in zip(batch, found):
+                    out[title] = res
+                    if res is not None:
+                        _TMDB_SEARCH_CACHE[_get_cache_key(media_type, title, None)] = res
+            threading.Thread(target=_save_tmdb_cache, daemon=True).start()
+        return out
+    return lookup
+
+
+def _update_taste_profile(user_id, selected_libraries, history):
+    """Fold the user's watched titles not seen yet into their stored profile; (profile, info), never raises.
+
+    Uses the complete all-time watched lists (newest first); only the TMDb lookup budget
+    limits how many new titles are folded per request."""
+    libs = ','.join(sorted(str(lib) for lib in selected_libraries)) if selected_libraries else '*'
+    watched = {
+        'show': list(history.get('top_shows') or []) + list(history.get('recent_shows') or [])
+                + list(history.get('watched_shows_all') or history.get('watched_shows') or []),
+        'movie': list(history.get('top_movies') or []) + list(history.get('recent_movies') or [])
+                 + list(history.get('watched_movies_all') or history.get('watched_movies') or []),
+    }
+    try:
+        lookup = _taste_lookup(getattr(g, 'TMDB_API_KEY', ''), getattr(g, 'TASTE_PROFILE_LOOKUPS', 60))
+        return _TASTE_PROFILES.update(f"{user_id}:{libs}", watched, history.get('history_count') or 0, lookup)
+    except Exception as e:
+        print(f"DEBUG: taste profile update failed: {e}")
+        return None, {'error': str(e)[:200]}
+
+
+# Local recommender catalogues built from the TMDb search cache: (cache size, built at, {media type: Catalogue})
+_LOCAL_CATALOGUE = {'size': -1, 'built': 0.0, 'items': {}}
+_LOCAL_CATALOGUE_LOCK = threading.Lock()
+
+
+def _local_catalogue():
+    """Distinct cached TMDb titles with genre metadata, as one Catalogue per media type;
+    rebuilt when the search cache has changed size or after 5 minutes."""
+    with _LOCAL_CATALOGUE_LOCK:
+        size = len(_TMDB_SEARCH_CACHE)
+        if size == _LOCAL_CATALOGUE['size'] and time.time() - _LOCAL_CATALOGUE['built'] < 300:
+            return _LOCAL_CATALOGUE['items']
+        items, seen = {'show': [], 'movie': []}, set()
+        for key, entry in list(_TMDB_SEARCH_CACHE.items()):
+            mt = key[0]
+            if mt not in items or not isinstance(entry, dict) or not entry.get('title') or not entry.get('tmdb_id') or 'genre_ids' not in entry:
+                continue
+            if (mt, entry['tmdb_id']) in seen:
+                continue
+            seen.add((mt, entry['tmdb_id']))
+            items[mt].append(entry)
+        catalogues = {mt: LocalCatalogue(v) for mt, v in items.items()}
+        _LOCAL_CATALOGUE.update(size=size, built=time.time(), items=catalogues)
+        return catalogues
+
+
+def _local_recommend(taste_profile, watched_titles, mode, decade_code, genre_code, mood_code, per_type):
+    """Recommendations ranked from cached TMDb metadata against the taste profile, in the AI
+    answer shape: no network calls and no tokens. Returns (recommendations, info)."""
+    t = time.time()
+    catalogue = _local_catalogue()
+    decade_range = genre_ids = mood = None
+    if mode == 'custom':
+        if mood_code:
+            mood = mood_code
+        else:
+            if decade_code:
+                decade_range = (decade_code, 9999 if decade_code >= 2020 else decade_code + 9)
+            if genre_code:
+                genre_ids = _LOCAL_GENRE_IDS.get(genre_code) or None
+    recs = {'shows': [], 'movies': [], 'categories': []}
+    for mt, field in (('show', 'shows'), ('movie', 'movies')):
+        ranked = local_rank(catalogue[mt], taste_profile, exclude_ids=taste_watched_ids(taste_profile, mt),
+                            exclude_titles=list(watched_titles) + list(((taste_profile or {}).get('titles') or {}).get(mt, {})),
+                            decade_range=decade_range, genre_ids=genre_ids, mood=mood, limit=per_type * 3)
+        recs[field] = local_recommendations(ranked)
+        # Seed the search cache under the exact keys the TMDb id pre-resolution will look up
+        entries = {e['tmdb_id']: e for e, _ in ranked}
+        for it in recs[field]:
+            _TMDB_SEARCH_CACHE.setdefault(_get_cache_key(mt, it['title'], it['year']), entries[it['tmdb_id']])
+            _TMDB_SEARCH_CACHE.setdefault(_get_cache_key(mt, f"__direct_{it['tmdb_id']}", None), entries[it['tmdb_id']])
+    with _LOCAL_CATALOGUE_LOCK:
+        # Seeded keys only alias catalogue entries, so they do not call for a rebuild
+        if _LOCAL_CATALOGUE['items'] is catalogue:
+            _LOCAL_CATALOGUE['size'] = len(_TMDB_SEARCH_CACHE)
+    latency_ms = (time.time() - t) * 1000.0
+    _record_ai_call('local', 'local', latency_ms, None, bool(recs['shows'] or recs['movies']))
+    info = {'catalogue': {mt: len(v) for mt, v in catalogue.items()}, 'latency_ms': round(latency_ms, 2),
+            'returned': {'show': len(recs['shows']), 'movie': len(recs['movies'])}}
+    return recs, info
+
+def _parse_ai_recommendations(content):
+    """(json text, recommendations dict, parse info); raises ValueError when nothing is usable.
+
+    Truncated or slightly malformed output is repaired down to its complete items, so a
+    cut-off answer still yields recommendations instead of another model call."""
+    rec_json, ai_recommended, info = parse_json_object(content)
+    if ai_recommended is None:
+        raise ValueError('No JSON found in AI response')
+    for key in ('shows', 'movies'):
+        items = ai_recommended.get(key) or []
+        ai_recommended[key] = [it for it in items if (isinstance(it, dict) and it.get('title')) or (isinstance(it, str) and it)] if isinstance(items, list) else []
+    if not ai_recommended['shows'] and not ai_recommended['movies']:
+        raise ValueError(f"No recommendations in AI response (parse: {info.get('method')})")
+    cats = ai_recommended.get('categories', []) or []
+    if cats and isinstance(cats[0], dict):
+        cats = [c.get('name') or c.get('title') or str(c) for c in cats]
+    ai_recommended['categories'] = [c for c in cats if isinstance(c, str)]
+    if info.get('repaired'):
+        print(f"DEBUG: AI response repaired ({info.get('method')}): {len(ai_recommended['shows'])} shows, {len(ai_recommended['movies'])} movies kept")
+    return rec_json, ai_recommended, info
+
+
+def _ai_candidates():
+    """(provider, model) attempts for this request, in order, plus the router's decision.
+
+    The configured provider's models come first (routed by quota/health); when hedging
+    is on, the default model of every other provider with a key is appended."""
+    provider = g.AI_PROVIDER
+    keys = getattr(g, 'AI_PROVIDER_KEYS', {}) or {}
+    if provider == 'gemini' and _GENAI_SDK != 'legacy':
+        pinned = getattr(g, 'GEMINI_MODEL', '') or None
+        candidates = ([pinned] if pinned else []) + [m for m in _GEMINI_DEFAULT_ORDER if m != pinned]
+    else:
+        pinned = g.AI_MODEL or _ai_default_model(provider)
+        candidates = [pinned]
+    routed, skipped = _route_models(candidates, pinned=pinned) if keys.get(provider) else ([], {})
+    plan = [(provider, m) for m in routed]
+    if getattr(g, 'AI_HEDGE', False):
+        for other, key in keys.items():
+            if other == provider or not key or (other == 'gemini' and _GENAI_SDK is None):
+                continue
+            model = _ai_default_model(other)
+            if _route_models([model])[0]:
+                plan.append((other, model))
+    return plan, {'order': routed, 'skipped': skipped}
+
+
+def _run_ai(prompt, plan, gemini_recs):
+    """Answer from the AI cache if possible, else run the attempts in order (hedged when
+    AI_HEDGE is on). Fills gemini_recs; returns parsed recommendations or None on failure."""
+    cache_ttl = getattr(g, 'AI_CACHE_TTL', 0)
+    gemini_recs['ai_cache'] = {'hit': False, 'ttl': cache_ttl}
+    if cache_ttl > 0:
+        for provider, model in plan:
+            hit = _AI_CACHE.get(provider, model, prompt, cache_ttl)
+            if hit is None:
+                continue
+            try:
+                rec_json, ai_recommended, info = _parse_ai_recommendations(hit['text'])
+            except ValueError:
+                continue
+            # Served locally: no provider call, so nothing is added to usage counts
+            gemini_recs.update({
+                'error': None,
+                'raw_response': hit['text'],
+                'model_used': model,
+                'provider_used': provider,
+                'ai_endpoint': _AI_PROVIDERS[provider].endpoint,
+                'usage': hit['usage'],
+                'parsed_json': rec_json,
+                'ai_parse': info,
+                'usage_today': get_usage_today(model),
+                'available_models': [m for _, m in plan],
+                'ai_cache': {'hit': True, 'ttl': cache_ttl, 'age_s': hit['age_s'], 'key': hit['key']},
+            })
+            print(f"DEBUG: AI cache hit for {provider}/{model} (age {hit['age_s']}s)")
+            return ai_recommended
+
+    keys = dict(getattr(g, 'AI_PROVIDER_KEYS', {}) or {})
+    referer = request.host_url if request else ''
+    hedge = getattr(g, 'AI_HEDGE', False)
+    pct = getattr(g, 'AI_HEDGE_PERCENTILE', 90.0)
+    default_delay = getattr(g, 'AI_HEDGE_DELAY', 8.0)
+
+    def call(cand):
+        return get_provider(cand[0], keys.get(cand[0]), referer).generate(prompt, cand[1], schema=RECOMMENDATIONS_SCHEMA)
+
+    def delay_for(cand):
+        if not hedge:
+            return None
+        ms = _MODEL_ROUTER.latency_percentile(cand[1], pct)
+        return min(60.0, max(1.0, ms / 1000.0)) if ms else default_delay
+
+    def on_attempt(cand, position, res, won):
+        # Every answered call counts against quota, including ones that lost a hedge race
+        if res['content'] is not None:
+            ut = res['usage'] or {}
+            record_usage(cand[1], ut.get('prompt_token_count'), ut.get('candidates_token_count'), ut.get('total_token_count'))
+        _record_ai_call(cand[0], cand[1], res['latency_ms'], res['usage'], res['error'] is None, position, res['error'])
+
+    outcome = run_hedged(plan, call, _parse_ai_recommendations, delay_for, _AI_EXECUTOR, on_attempt,
+                         max_in_flight=2 if hedge else 1)
+    gemini_recs['available_models'] = [m for _, m in plan]
+    gemini_recs['ai_hedge'] = {
+        'enabled': hedge,
+        'percentile': pct if hedge else None,
+        'hedges': outcome['hedges'],
+        'attempts': [{'provider': a['candidate'][0], 'model': a['candidate'][1], 'position': a['position'],
+                      'latency_ms': a['latency_ms'], 'error': a['error'], 'won': a['won']} for a in outcome['attempts']],
+        'abandoned': [f"{p}/{m}" for p, m in outcome['abandoned']],
+    }
+    if outcome['winner'] is None:
+        for a in outcome['attempts']:
+            print(f"DEBUG: Model {a['candidate'][1]} failed: {a['error']}")
+        last = outcome['attempts'][-1]['error'] if outcome['attempts'] else 'no attempts'
+        gemini_recs['error'] = f"{g.AI_PROVIDER} request failed: {last}"
+        return None
+    provider, model = outcome['winner']
+    res = outcome['result']
+    # Repaired (truncated) answers are not cached so a later request can get the full one
+    if cache_ttl > 0 and not res['parsed'][2].get('repaired'):
+        _AI_CACHE.put(provider, model, prompt, res['content'], res['usage'], cache_ttl)
+    gemini_recs.update({
+        'error': None,
+        'raw_response': res['content'],
+        'model_used': model,
+        'provider_used': provider,
+        'ai_endpoint': _AI_PROVIDERS[provider].endpoint,
+        'usage': res['usage'],
+        'ai_timings': res.get('timings'),
+        'parsed_json': res['parsed'][0],
+        'ai_parse': res['parsed'][2],
+        'usage_today': get_usage_today(model),
+    })
+    print(f"DEBUG: Successfully used model: {provider}/{model} (attempt {len(outcome['attempts'])}, {outcome['hedges']} hedge(s))")
+    return res['parsed'][1]
+
 # Dummy recommendation logic (to be improved)
-def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=None, mood_code=None, requested_model=None):
+def _recommend_fresh(user_id, mode='history', decade_code=None, genre_code=None, mood_code=None, requested_model=None,
+                     per_type=20, history=None, taste=None, segment=False):
+    """One full run: AI generation of per_type titles per media type, then TMDb, availability and posters.
+
+    history / taste (profile, update info) may be passed in when the caller already has them.
+    segment=True builds a shared custom-mode list: no user history in the prompt or filters."""
     import time
     timing = {}
     t0 = time.time()
@@ -1546,14 +1738,15 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
                 display_model = 'mistral-small'
             elif g.AI_PROVIDER == 'openrouter':
                 display_model = 'anthropic/claude-3-haiku'
+            elif g.AI_PROVIDER == 'local':
+                display_model = 'local'
             else:
                 display_model = 'none'
         
         # Get username for debug output
         debug_username = "unknown"
         try:
-            users = get_cached_users()
-            user_match = next((u for u in users if str(u.get('user_id')) == str(user_id)), None)
+            user_match = _USER_DIRECTORY.get(user_id)
             if user_match:
                 debug_username = user_match.get('username') or user_match.get('friendly_name') or "unknown"
         except Exception:
@@ -1577,14 +1770,15 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
                 display_model = 'mistral-small'
             elif g.AI_PROVIDER == 'openrouter':
                 display_model = 'anthropic/claude-3-haiku'
+            elif g.AI_PROVIDER == 'local':
+                display_model = 'local'
             else:
                 display_model = 'none'
         
         # Get username for debug output (fallback)
         debug_username = "unknown"
         try:
-            users = get_cached_users()
-            user_match = next((u for u in users if str(u.get('user_id')) == str(user_id)), None)
+            user_match = _USER_DIRECTORY.get(user_id)
             if user_match:
                 debug_username = user_match.get('username') or user_match.get('friendly_name') or "unknown"
         except Exception:
@@ -1592,91 +1786,30 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
         
         print(f"DEBUG: recommend_for_user called user_id={user_id} username={debug_username} mode={mode} mood={mood_code} model={display_model}")
 
-    # Step 1: Recent (API) history strictly for top/recent calculations (stateless, up-to-date)
-    hist_api = get_user_watch_history_api(user_id, selected_libraries)
+    # Step 1-2: Top watched, recents and the all-time watched set from one cached snapshot
+    # (SQL aggregates when the Tautulli DB is available, API + Python otherwise)
+    if segment:
+        history, taste = dict(_EMPTY_HISTORY), (None, {})
+    elif history is None:
+        history = get_user_history_summary(user_id, selected_libraries)
     timing['user_history'] = time.time() - t0
-
-    # Step 2: Top watched and recents derived ONLY from API subset per requirement
-    t1 = time.time()
-    hist = hist_api  # alias for legacy variable names below
-    shows = [item.get('grandparent_title') for item in hist if item.get('media_type') == 'episode' and item.get('grandparent_title')]
-    movies = [item.get('title') for item in hist if item.get('media_type') == 'movie' and item.get('title')]
-    show_counts = Counter(shows)
-    movie_counts = Counter(movies)
-    top_shows = [show for show, _ in show_counts.most_common(3)]
-    top_movies = [movie for movie, _ in movie_counts.most_common(3)]
-
-    # Compute last 10 watched (helper)
-    def _ts(it):
-        for k in ('date', 'watched_at', 'timestamp', 'last_played', 'time'):
-            v = it.get(k)
-            if isinstance(v, (int, float)):
-                return float(v)
-            if isinstance(v, str):
-                try:
-                    return float(v)
-                except Exception:
-                    continue
-        return None
-
-    any_ts = any(_ts(it) is not None for it in hist)
-    if any_ts:
-        ordered_hist = sorted(hist, key=lambda it: _ts(it) or 0.0, reverse=True)
-    else:
-        # Assume API returns newest-first; keep as-is
-        ordered_hist = list(hist)
-    last10_shows = []
-    last10_movies = []
-    seen_shows = set()
-    seen_movies = set()
-    for it in ordered_hist:
-        if it.get('media_type') == 'episode':
-            title = it.get('grandparent_title')
-            if title and title not in seen_shows:
-                last10_shows.append(title)
-                seen_shows.add(title)
-        elif it.get('media_type') == 'movie':
-            title = it.get('title')
-            if title and title not in seen_movies:
-                last10_movies.append(title)
-                seen_movies.add(title)
-        if len(last10_shows) >= 10 and len(last10_movies) >= 10:
-            break
-
-    timing['top_watched'] = time.time() - t1
-
-    # Step 2b: Build an all-time watched set from FULL history (prefer DB) for filtering only
-    t2a = time.time()
-    hist_all = get_user_watch_history_all(user_id, selected_libraries)
-    shows_all = [it.get('grandparent_title') for it in hist_all if it.get('media_type') == 'episode' and it.get('grandparent_title')]
-    movies_all = [it.get('title') for it in hist_all if it.get('media_type') == 'movie' and it.get('title')]
-    watched_set_all = set(shows_all + movies_all)
-    timing['user_history_all'] = time.time() - t2a
-
-    # Build full unique-by-recency watched lists from full history for AI prompt (do NOT override top/recent)
-    ordered_all = sorted(hist_all, key=lambda it: it.get('date') or 0.0, reverse=True)
-    watched_shows_unique = []
-    watched_movies_unique = []
-    seen_shows2 = set()
-    seen_movies2 = set()
-    for it in ordered_all:
-        if it.get('media_type') == 'episode':
-            t = it.get('grandparent_title')
-            if t and t not in seen_shows2:
-                watched_shows_unique.append(t)
-                seen_shows2.add(t)
-        elif it.get('media_type') == 'movie':
-            t = it.get('title')
-            if t and t not in seen_movies2:
-                watched_movies_unique.append(t)
-                seen_movies2.add(t)
-    # Cap what we include in the prompt to avoid exceeding model limits - OPTIMIZED FOR SPEED
-    WATCHED_MAX_PER_TYPE = 100
-    watched_shows_in_prompt = watched_shows_unique[:WATCHED_MAX_PER_TYPE]
-    watched_movies_in_prompt = watched_movies_unique[:WATCHED_MAX_PER_TYPE]
+    top_shows = history['top_shows']
+    top_movies = history['top_movies']
+    last10_shows = history['recent_shows']
+    last10_movies = history['recent_movies']
+    watched_set_all = history['watched_set_all']
+    watched_shows_in_prompt = history['watched_shows']
+    watched_movies_in_prompt = history['watched_movies']
+    # Incrementally maintained taste profile; stands in for the long watched lists below
+    t_profile = time.time()
+    taste_profile, taste_info = taste if taste is not None else _update_taste_profile(user_id, selected_libraries, history)
+    watched_show_ids = taste_watched_ids(taste_profile, 'show')
+    watched_movie_ids = taste_watched_ids(taste_profile, 'movie')
+    timing['taste_profile'] = time.time() - t_profile
 
     # Step 3: Skip legacy full-library prefetch (deprecated) – availability resolved later
-    debug = {'library_prefetch': 'skipped', 'selected_libraries': selected_libraries}
+    debug = {'library_prefetch': 'skipped', 'selected_libraries': selected_libraries, 'history_source': history['source'], 'history_cached': history['cached']}
+    debug['taste_profile'] = dict(taste_info or {}, summary=summarize_taste_profile(taste_profile))
     timing['library_fetch'] = 0.0
 
     # Step 5: Gemini AI recommendations
@@ -1709,7 +1842,7 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
                     'ai_shows_titles': [], 'ai_movies_titles': [],
                     'ai_shows_unavailable': [], 'ai_movies_unavailable': [],
                     'ai_shows_available': [], 'ai_movies_available': [],
-                    'history_count': len(hist_all),
+                    'history_count': history['history_count'],
                     'show_posters': [], 'movie_posters': [],
                     'show_posters_unavailable': [], 'movie_posters_unavailable': [],
                     'debug': {'error': f'Invalid mood: {mood_code}. Valid options: {", ".join(mood_label_map.keys())}', 'timing': timing},
@@ -1729,7 +1862,7 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
                     'ai_shows_titles': [], 'ai_movies_titles': [],
                     'ai_shows_unavailable': [], 'ai_movies_unavailable': [],
                     'ai_shows_available': [], 'ai_movies_available': [],
-                    'history_count': len(hist_all),
+                    'history_count': history['history_count'],
                     'show_posters': [], 'movie_posters': [],
                     'show_posters_unavailable': [], 'movie_posters_unavailable': [],
                     'debug': {'error': 'At least a decade, genre, or mood must be selected for Custom mode.', 'timing': timing},
@@ -1747,39 +1880,49 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
                 selection_desc = f"Best of {decade_label}"
             elif genre_label:
                 selection_desc = f"Best of {genre_label}"
-    if not g.GOOGLE_API_KEY:
+    if g.AI_PROVIDER == 'local':
+        pass  # ranked from cached metadata below; no prompt needed
+    elif not g.GOOGLE_API_KEY:
         gemini_recs['error'] = 'GOOGLE_API_KEY is not set in the environment.'
     elif top_shows or top_movies or mode == 'custom':
-        import json as pyjson
-        
         # Create more concise watched history summaries for faster processing
-        def _summarize_watched(items, max_items=20):
-            if len(items) <= max_items:
-                return items
-            # Keep most recent and some variety
-            recent = items[:10]
-            remaining = items[10:max_items]
-            return recent + remaining
+        # History block: deduplicated across lists, franchises folded, fitted to the token budget.
+        # With a taste profile the long "also watched" lists are replaced by its summary
+        # (watched titles are filtered locally by TMDb id instead)
+        profile_text = render_taste_profile(taste_profile)
+        history_sections = [] if segment else [
+            ('Top shows', top_shows),
+            ('Top movies', top_movies),
+            ('Recent shows', last10_shows),
+            ('Recent movies', last10_movies),
+        ]
+        if not profile_text:
+            history_sections += [
+                ('Also watched shows', watched_shows_in_prompt),
+                ('Also watched movies', watched_movies_in_prompt),
+            ]
+        history_budget = getattr(g, 'AI_PROMPT_TOKEN_BUDGET', DEFAULT_HISTORY_BUDGET)
+        history_context, history_prompt_stats = build_history_context(
+            history_sections, budget_tokens=max(50, history_budget - estimate_tokens(profile_text, g.AI_PROVIDER)),
+            model=g.AI_PROVIDER)
+        if profile_text:
+            history_context = f"{profile_text}\n{history_context}" if history_context else profile_text
+        history_prompt_stats['taste_profile'] = bool(profile_text)
+        if segment:
+            history_context = ("No viewing history is given: this list is shared by many viewers and personalized "
+                               "for each of them afterwards, so cover the selection broadly.")
 
         if mode == 'history':
 
-            watched_shows_summary = _summarize_watched(watched_shows_in_prompt, 30)
-            watched_movies_summary = _summarize_watched(watched_movies_in_prompt, 30)
-
             prompt = (
             "Generate personalized recommendations for this user.\n"
-            f"Top shows: {top_shows}\n"
-            f"Top movies: {top_movies}\n"
-            f"Recent shows: {last10_shows}\n"
-            f"Recent movies: {last10_movies}\n"
-            f"Watched shows ({len(watched_shows_summary)}): {watched_shows_summary}\n"
-            f"Watched movies ({len(watched_movies_summary)}): {watched_movies_summary}\n"
+            f"{history_context}\n"
             "Rules:\n"
             "- Only recommend unwatched content\n"
             "- Max 2 per director/franchise, max 3 per genre\n"
             "- Ensure 6+ distinct genres total\n"
             "- Mix decades and regions\n"
-            "Output 20 shows, 20 movies with year, tmdb_id. Include 5-12 categories.\n"
+            f"Output {per_type} shows, {per_type} movies with year, tmdb_id. Include 5-12 categories.\n"
             'Format: {"shows": [{"title": "...", "year": 2020, "tmdb_id": 123}], "movies": [...], "categories": ["..."]}'
             )
         elif mode == 'custom' and mood_code:
@@ -1823,26 +1966,18 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
                 'seasonal': get_seasonal_prompt()
             }
             
-            watched_shows_summary = _summarize_watched(watched_shows_in_prompt, 30)
-            watched_movies_summary = _summarize_watched(watched_movies_in_prompt, 30)
-
             mood_instruction = mood_prompts.get(mood_code, "")
             server_context = ""
 
             prompt = (
                 f"Generate {selection_desc} recommendations.\n"
-                f"User's top shows: {top_shows}\n"
-                f"User's top movies: {top_movies}\n"
-                f"Recent shows: {last10_shows}\n"
-                f"Recent movies: {last10_movies}\n"
-                f"Watched shows ({len(watched_shows_summary)}): {watched_shows_summary}\n"
-                f"Watched movies ({len(watched_movies_summary)}): {watched_movies_summary}\n"
+                f"{history_context}\n"
                 f"{mood_instruction}\n"
                 "Rules:\n"
                 "- Only recommend unwatched content\n"
                 "- Max 2 per director/franchise, max 3 per genre\n"
                 "- Ensure quality and diversity\n"
-                "Output 20 shows, 20 movies with year, tmdb_id. Include 5-12 categories.\n"
+                f"Output {per_type} shows, {per_type} movies with year, tmdb_id. Include 5-12 categories.\n"
                 'Format: {"shows": [{"title": "...", "year": 2020, "tmdb_id": 123}], "movies": [...], "categories": ["..."]}'
             )
         else:
@@ -1860,28 +1995,28 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
             if genre_code:
                 genre_label = genre_label_map.get(genre_code, genre_code)
                 genre_clause = f" Emphasize the {genre_label} genre (or strong {genre_label} elements) while allowing adjacent subgenres for variety."
-            watched_shows_summary = _summarize_watched(watched_shows_in_prompt, 30)
-            watched_movies_summary = _summarize_watched(watched_movies_in_prompt, 30)
-
             selection_clause = selection_desc or 'Best of selection'
+            # Shared segment lists are personalized locally, so the history weighting rule is dropped
+            history_rule = '' if segment else "- 40% based on user history, 60% on selection criteria\n"
             prompt = (
                 f"Generate {selection_clause} recommendations.\n"
-                f"User's top shows: {top_shows}\n"
-                f"User's top movies: {top_movies}\n"
-                f"Recent shows: {last10_shows}\n"
-                f"Recent movies: {last10_movies}\n"
-                f"Watched shows ({len(watched_shows_summary)}): {watched_shows_summary}\n"
-                f"Watched movies ({len(watched_movies_summary)}): {watched_movies_summary}\n"
+                f"{history_context}\n"
                 f"Focus: {decade_clause.strip()}{genre_clause}\n"
                 "Rules:\n"
                 "- Only recommend unwatched content\n"
-                "- 40% based on user history, 60% on selection criteria\n"
+                f"{history_rule}"
                 "- Max 2 per director/franchise, max 3 per genre\n"
                 "- Mix canonical and under-the-radar picks\n"
-                "Output 20 shows, 20 movies with year, tmdb_id. Include 5-12 categories.\n"
+                f"Output {per_type} shows, {per_type} movies with year, tmdb_id. Include 5-12 categories.\n"
                 'Format: {"shows": [{"title": "...", "year": 2020, "tmdb_id": 123}], "movies": [...], "categories": ["..."]}'
             )
         gemini_recs['prompt'] = prompt
+        gemini_recs['prompt_tokens'] = {
+            'estimated': estimate_tokens(prompt, g.AI_PROVIDER),
+            'estimated_raw': estimate_tokens(prompt),
+            'actual': None,
+            'history': history_prompt_stats,
+        }
         # Log prompt with requesting IP for debugging/auditing
         try:
             from flask import request as _rqp
@@ -1894,260 +2029,38 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
                     ip_dbg = _rqp.remote_addr
         except Exception:
             pass
-        if getattr(g, 'genai_sdk', None) == 'new':
-            # Try a shortlist of commonly available models with the new google-genai SDK
-            gemini_recs['ai_endpoint'] = 'https://generativelanguage.googleapis.com/v1beta/models'
-            # Preferred model order. Allow override via GEMINI_MODEL (.env) and prioritize requested 2.5 flash lite.
-            default_order = ['gemini-2.5-flash-lite', 'gemini-2.0-flash-001']
-            print(f"DEBUG: g.AI_MODEL = {getattr(g, 'AI_MODEL', 'NOT SET')}")
-            print(f"DEBUG: g.GEMINI_MODEL = {getattr(g, 'GEMINI_MODEL', 'NOT SET')}")
-            if getattr(g, 'GEMINI_MODEL', ''):
-                # Put user-specified model first if provided.
-                user_model = g.GEMINI_MODEL
-                # Ensure no duplicates while preserving order.
-                tried_models = [user_model] + [m for m in default_order if m != user_model]
-            else:
-                tried_models = default_order
-            gemini_recs['available_models'] = tried_models
-            print(f"DEBUG: Trying models in order: {tried_models}")
-            client = getattr(g, 'genai_client', None)
-            last_err = None
-            if client is None:
-                gemini_recs['error'] = 'GenAI client not initialized.'
-            else:
-                for model_name in tried_models:
-                    try:
-                        response = client.models.generate_content(model=model_name, contents=prompt)
-                        content = getattr(response, 'text', None)
-                        gemini_recs['raw_response'] = content
-                        # Capture model and usage metadata when available
-                        gemini_recs['model_used'] = model_name
-                        print(f"DEBUG: Successfully used model: {model_name}")
-                        usage_meta = getattr(response, 'usage_metadata', None)
-                        usage = None
-                        if usage_meta is not None:
-                            if isinstance(usage_meta, dict):
-                                usage = usage_meta
-                            else:
-                                # Best-effort extraction of token counts
-                                try:
-                                    usage = {
-                                        'prompt_token_count': getattr(usage_meta, 'prompt_token_count', None),
-                                        'candidates_token_count': getattr(usage_meta, 'candidates_token_count', None),
-                                        'total_token_count': getattr(usage_meta, 'total_token_count', None),
-                                    }
-                                except Exception:
-                                    try:
-                                        usage = usage_meta.__dict__
-                                    except Exception:
-                                        usage = None
-                        gemini_recs['usage'] = usage
-                        rec_json = extract_json_object(content)
-                        gemini_recs['parsed_json'] = rec_json
-                        if not rec_json:
-                            raise ValueError('No JSON found in Gemini response')
-                        ai_recommended = pyjson.loads(rec_json)
-                        cats = ai_recommended.get('categories', []) or []
-                        if cats and isinstance(cats[0], dict):
-                            cats = [c.get('name') or c.get('title') or str(c) for c in cats]
-                        ai_recommended['categories'] = [c for c in cats if isinstance(c, str)]
-                        ut = gemini_recs.get('usage') or {}
-                        record_usage(
-                            gemini_recs.get('model_used') or model_name,
-                            ut.get('prompt_token_count'),
-                            ut.get('candidates_token_count'),
-                            ut.get('total_token_count'),
-                        )
-                        # Snapshot today's usage for this model
-                        gemini_recs['usage_today'] = get_usage_today(gemini_recs.get('model_used') or model_name)
-                        break
-                    except Exception as e:
-                        last_err = e
-                        print(f"DEBUG: Model {model_name} failed: {e}")
-                        gemini_recs['error'] = f"Tried model {model_name}: {e}"
-                if gemini_recs['error'] and last_err is not None:
-                    # Keep the last error for context
-                    gemini_recs['error'] = f"Gemini request failed: {last_err}"
-        elif getattr(g, 'genai_sdk', None) == 'legacy':
-            # Legacy SDK fallback
-            gemini_recs['ai_endpoint'] = 'https://generativelanguage.googleapis.com/v1beta/models'
-            try:
-                model = genai.GenerativeModel('gemini-pro')
-                response = model.generate_content(prompt)
-                content = getattr(response, 'text', None)
-                gemini_recs['raw_response'] = content
-                # Capture model and usage
-                gemini_recs['model_used'] = 'gemini-pro'
-                usage_meta = getattr(response, 'usage_metadata', None)
-                usage = None
-                if usage_meta is not None:
-                    if isinstance(usage_meta, dict):
-                        usage = usage_meta
-                    else:
-                        try:
-                            usage = {
-                                'prompt_token_count': getattr(usage_meta, 'prompt_token_count', None),
-                                'candidates_token_count': getattr(usage_meta, 'candidates_token_count', None),
-                                'total_token_count': getattr(usage_meta, 'total_token_count', None),
-                            }
-                        except Exception:
-                            try:
-                                usage = usage_meta.__dict__
-                            except Exception:
-                                usage = None
-                gemini_recs['usage'] = usage
-                rec_json = extract_json_object(content)
-                gemini_recs['parsed_json'] = rec_json
-                if not rec_json:
-                    raise ValueError('No JSON found in Gemini response')
-                ai_recommended = pyjson.loads(rec_json)
-                cats = ai_recommended.get('categories', []) or []
-                if cats and isinstance(cats[0], dict):
-                    cats = [c.get('name') or c.get('title') or str(c) for c in cats]
-                ai_recommended['categories'] = [c for c in cats if isinstance(c, str)]
-                gemini_recs['error'] = None
-                # Record usage locally for daily tracking
-                ut = gemini_recs.get('usage') or {}
-                record_usage(
-                    gemini_recs.get('model_used') or 'gemini-pro',
-                    ut.get('prompt_token_count'),
-                    ut.get('candidates_token_count'),
-                    ut.get('total_token_count'),
-                )
-                # Snapshot today's usage for this model
-                gemini_recs['usage_today'] = get_usage_today(gemini_recs.get('model_used') or 'gemini-pro')
-                gemini_recs['available_models'] = ['gemini-pro']
-            except Exception as e:
-                gemini_recs['error'] = f"Legacy Gemini request failed: {e}"
-        elif g.AI_PROVIDER == 'mistral':
-            # Mistral AI implementation
-            gemini_recs['ai_endpoint'] = 'https://api.mistral.ai/v1/chat/completions'
-            try:
-                import requests
-                mistral_url = "https://api.mistral.ai/v1/chat/completions"
-                headers = {
-                    "Authorization": f"Bearer {g.MISTRAL_API_KEY}",
-                    "Content-Type": "application/json"
-                }
-                
-                # Default model selection for Mistral
-                model_name = g.AI_MODEL or "mistral-small"
-                
-                data = {
-                    "model": model_name,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "temperature": 0.7,
-                    "max_tokens": 4000
-                }
-                
-                response = requests.post(mistral_url, headers=headers, json=data, timeout=30)
-                response.raise_for_status()
-                
-                result = response.json()
-                content = result['choices'][0]['message']['content']
-                gemini_recs['raw_response'] = content
-                gemini_recs['model_used'] = model_name
-                
-                # Extract usage information
-                usage = result.get('usage', {})
-                gemini_recs['usage'] = {
-                    'prompt_token_count': usage.get('prompt_tokens'),
-                    'candidates_token_count': usage.get('completion_tokens'),
-                    'total_token_count': usage.get('total_tokens')
-                }
-                
-                rec_json = extract_json_object(content)
-                gemini_recs['parsed_json'] = rec_json
-                if not rec_json:
-                    raise ValueError('No JSON found in Mistral response')
-                    
-                ai_recommended = pyjson.loads(rec_json)
-                cats = ai_recommended.get('categories', []) or []
-                if cats and isinstance(cats[0], dict):
-                    cats = [c.get('name') or c.get('title') or str(c) for c in cats]
-                ai_recommended['categories'] = [c for c in cats if isinstance(c, str)]
-                
-                # Record usage
-                ut = gemini_recs.get('usage') or {}
-                record_usage(
-                    model_name,
-                    ut.get('prompt_token_count'),
-                    ut.get('candidates_token_count'),
-                    ut.get('total_token_count'),
-                )
-                gemini_recs['usage_today'] = get_usage_today(model_name)
-                gemini_recs['available_models'] = [model_name]
-                
-            except Exception as e:
-                gemini_recs['error'] = f"Mistral request failed: {e}"
-                
-        elif g.AI_PROVIDER == 'openrouter':
-            # OpenRouter implementation
-            gemini_recs['ai_endpoint'] = 'https://openrouter.ai/api/v1/chat/completions'
-            try:
-                import requests
-                openrouter_url = "https://openrouter.ai/api/v1/chat/completions"
-                headers = {
-                    "Authorization": f"Bearer {g.OPENROUTER_API_KEY}",
-                    "Content-Type": "application/json",
-                    "HTTP-Referer": request.host_url if request else "",
-                    "X-Title": "Conjurr"
-                }
-                
-                # Default model selection for OpenRouter
-                model_name = g.AI_MODEL or "anthropic/claude-3-haiku"
-                
-                data = {
-                    "model": model_name,
-                    "messages": [{"role": "user", "content": prompt}],
-                    "temperature": 0.7,
-                    "max_tokens": 4000
-                }
-                
-                response = requests.post(openrouter_url, headers=headers, json=data, timeout=30)
-                response.raise_for_status()
-                
-                result = response.json()
-                content = result['choices'][0]['message']['content']
-                gemini_recs['raw_response'] = content
-                gemini_recs['model_used'] = model_name
-                
-                # Extract usage information
-                usage = result.get('usage', {})
-                gemini_recs['usage'] = {
-                    'prompt_token_count': usage.get('prompt_tokens'),
-                    'candidates_token_count': usage.get('completion_tokens'),
-                    'total_token_count': usage.get('total_tokens')
-                }
-                
-                rec_json = extract_json_object(content)
-                gemini_recs['parsed_json'] = rec_json
-                if not rec_json:
-                    raise ValueError('No JSON found in OpenRouter response')
-                    
-                ai_recommended = pyjson.loads(rec_json)
-                cats = ai_recommended.get('categories', []) or []
-                if cats and isinstance(cats[0], dict):
-                    cats = [c.get('name') or c.get('title') or str(c) for c in cats]
-                ai_recommended['categories'] = [c for c in cats if isinstance(c, str)]
-                
-                # Record usage
-                ut = gemini_recs.get('usage') or {}
-                record_usage(
-                    model_name,
-                    ut.get('prompt_token_count'),
-                    ut.get('candidates_token_count'),
-                    ut.get('total_token_count'),
-                )
-                gemini_recs['usage_today'] = get_usage_today(model_name)
-                gemini_recs['available_models'] = [model_name]
-                
-            except Exception as e:
-                gemini_recs['error'] = f"OpenRouter request failed: {e}"
-                
-        else:
+        if g.AI_PROVIDER not in _AI_PROVIDERS:
             gemini_recs['error'] = f"Unsupported AI provider: {g.AI_PROVIDER}"
-    
+        else:
+            gemini_recs['ai_endpoint'] = _AI_PROVIDERS[g.AI_PROVIDER].endpoint
+            plan, gemini_recs['ai_router'] = _ai_candidates()
+            print(f"DEBUG: Trying models in order: {plan} (skipped: {gemini_recs['ai_router']['skipped']})")
+            if not plan:
+                skipped = gemini_recs['ai_router']['skipped']
+                gemini_recs['error'] = (f"All {g.AI_PROVIDER} models unavailable: {skipped}" if skipped
+                                        else f"No API key configured for {g.AI_PROVIDER}")
+            else:
+                ai_recommended = _run_ai(prompt, plan, gemini_recs) or ai_recommended
+                actual_tokens = (gemini_recs.get('usage') or {}).get('prompt_token_count')
+                gemini_recs['prompt_tokens']['actual'] = actual_tokens
+                if actual_tokens and not (gemini_recs.get('ai_cache') or {}).get('hit'):
+                    calibrate(gemini_recs.get('provider_used') or g.AI_PROVIDER, gemini_recs['prompt_tokens']['estimated_raw'], actual_tokens)
+
+    # Local metadata ranking: the selected provider, or the fallback when the AI run failed
+    # (shared segment runs have no profile to rank against, so they keep the error)
+    if g.AI_PROVIDER == 'local' or (gemini_recs['error'] and getattr(g, 'AI_LOCAL_FALLBACK', True) and not segment):
+        local_recs, local_info = _local_recommend(taste_profile, watched_set_all, mode, decade_code, genre_code,
+                                                  mood_code, per_type)
+        local_info['fallback'] = g.AI_PROVIDER != 'local'
+        local_info['ai_error'] = gemini_recs['error']
+        gemini_recs['local'] = local_info
+        if local_recs['shows'] or local_recs['movies']:
+            ai_recommended = local_recs
+            gemini_recs.update({'error': None, 'model_used': 'local', 'provider_used': 'local'})
+            print(f"DEBUG: Local recommender used ({local_info})")
+        elif g.AI_PROVIDER == 'local':
+            gemini_recs['error'] = 'Local recommender has no cached TMDb metadata to rank yet'
+
     timing[f'{g.AI_PROVIDER}_{gemini_recs.get("model_used", "unknown")}'] = time.time() - t4
 
     # Step 6: AI parse
@@ -2234,9 +2147,9 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
     # Apply diversity caps if metadata present
     try:
         if ai_shows and isinstance(ai_shows[0], dict):
-            ai_shows = _enforce_diversity(ai_shows, target_count=20)
+            ai_shows = _enforce_diversity(ai_shows, target_count=per_type)
         if ai_movies and isinstance(ai_movies[0], dict):
-            ai_movies = _enforce_diversity(ai_movies, target_count=20)
+            ai_movies = _enforce_diversity(ai_movies, target_count=per_type)
     except Exception:
         pass
 
@@ -2546,45 +2459,85 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
             _availability_cache[cache_key] = result
             return result
 
+    # Tiered availability chain: cheap local answers first, live Plex search last
+    availability_scope = ','.join(sorted(selected_libraries)) if selected_libraries else '*'
+    availability_db_path = g.TAUTULLI_DB_PATH if getattr(g, 'use_tautulli_db', False) else None
+    tier_order = getattr(g, 'AVAILABILITY_TIERS', None) or list(DEFAULT_TIER_ORDER)
+    tier_timeouts = {**DEFAULT_TIER_TIMEOUTS, **(getattr(g, 'AVAILABILITY_TIER_TIMEOUTS', None) or {})}
+
+    def _tier_local(pending, media_type):
+        out = {}
+        for it in pending:
+            title = it.get('title')
+            ans = _LOCAL_AVAILABILITY_INDEX.get(availability_scope, media_type, tmdb_id=it.get('tmdb_id'), title_key=normalize_title(title))
+            if ans is not None:
+                out[title] = ans
+        return out
+
+    def _tier_overseerr(pending, media_type):
+        # Overseerr mirrors the whole server, so it cannot honour a library filter
+        if not overseerr_url or selected_libraries:
+            return {}
+        with_ids = [it for it in pending if it.get('tmdb_id')]
+        if not with_ids:
+            return {}
+        out = {}
+        with ThreadPoolExecutor(max_workers=min(len(with_ids), 8)) as executor:
+            futures = {executor.submit(_overseerr_available, it.get('tmdb_id'), media_type, overseerr_url, overseerr_key, overseerr_errors): it.get('title') for it in with_ids}
+            for future in as_completed(futures):
+                try:
+                    avail, _ = future.result()
+                except Exception:
+                    continue
+                if avail is not None:
+                    out[futures[future]] = avail
+        return out
+
+    def _tier_tautulli_db(pending, media_type):
+        lib = _get_db_library_titles(availability_db_path, media_type, selected_libraries)
+        if not lib:
+            return {}
+        out = {}
+        # Library titles carry no year, so only exact normalized hits answer here
+        # (a fuzzy "Alien 3" -> "Alien" would wrongly skip Plex); the rest go on to Plex
+        for it, ntitle in zip(pending, normalize_titles([it.get('title') for it in pending])):
+            if ntitle and lib.exact(ntitle) is not None:
+                out[it.get('title')] = True
+        return out
+
+    def _build_availability_chain(plex, plex_logs):
+        def _tier_plex(pending, media_type):
+            res, logs = plex.check_availability_for_items(pending, media_type, selected_libraries)
+            plex_logs.extend(logs)
+            return res
+        tier_fns = {
+            'local': (_tier_local, True),
+            'overseerr': (_tier_overseerr, False),
+            'tautulli_db': (_tier_tautulli_db if availability_db_path else None, False),
+            'plex': (_tier_plex if plex is not None else None, True),
+        }
+        tiers = []
+        for name in tier_order:
+            fn, authoritative = tier_fns.get(name, (None, False))
+            if fn is not None:
+                tiers.append(AvailabilityTier(name, fn, timeout=tier_timeouts.get(name, 5.0), authoritative_negative=authoritative))
+        return AvailabilityChain(tiers)
+
     def _resolve(items, media_type, pre_map):
         results = []
         tmdb_map = {}
         availability_debug_logs = []
         
         if not items:
-            return [], [], {}, 0.0, []
+            return [], [], {}, 0.0, [], {}
         
         start_batch = time.time()
         
-        # Get Plex client for availability checking
         plex = get_plex_client()
         if plex is None:
-            availability_debug_logs.append("Warning: Plex not configured, marking all items as unavailable")
-            # If Plex not configured, mark all as unavailable
-            for it in items:
-                title = it.get('title') if isinstance(it, dict) else it
-                year = it.get('year') if isinstance(it, dict) else None
-                tmdb_id = pre_map.get(title)
-                if not tmdb_id:
-                    tmdb_id = _tmdb_search_id(title, year, media_type)
-                    if isinstance(it, dict): 
-                        it['tmdb_id'] = tmdb_id
-                
-                results.append({
-                    'ai_title': title, 
-                    'ai_year': year, 
-                    'tmdb_id': tmdb_id, 
-                    'plex_available': False, 
-                    'plex_url': False
-                })
-                
-                if tmdb_id:
-                    tmdb_map[title] = tmdb_id
-                    
-            available_titles = []
-            return results, available_titles, tmdb_map, time.time() - start_batch, availability_debug_logs
+            availability_debug_logs.append("Warning: Plex not configured, relying on cached/mirror tiers only")
         
-        # Step 1: Resolve TMDb IDs for all items first (needed for GUID matching)
+        # Step 1: Resolve TMDb IDs for all items first (needed for GUID matching and Overseerr lookups)
         for it in items:
             title = it.get('title') if isinstance(it, dict) else it
             if title and not pre_map.get(title):
@@ -2595,8 +2548,11 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
                 if tmdb_id:
                     pre_map[title] = tmdb_id
         
-        # Step 2: Check Plex availability for all items (targeted checking only)
-        plex_availability, plex_logs = plex.check_availability_for_items(items, media_type, selected_libraries)
+        # Step 2: Walk the availability tiers; faster tiers short-circuit slower ones
+        plex_logs = []
+        chain = _build_availability_chain(plex, plex_logs)
+        availability, tier_stats, chain_logs = chain.resolve(items, media_type)
+        availability_debug_logs.extend(chain_logs)
         availability_debug_logs.extend(plex_logs)
         
         # Step 3: Build final results
@@ -2607,25 +2563,33 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
             # Get TMDb ID
             tmdb_id = pre_map.get(title) or (it.get('tmdb_id') if isinstance(it, dict) else None)
             
-            # Get availability from Plex batch results
-            plex_avail = plex_availability.get(title, False)
+            answer = availability.get(title) or {}
+            plex_avail = bool(answer.get('available'))
+            source = answer.get('source')
             
             results.append({
                 'ai_title': title, 
                 'ai_year': year, 
                 'tmdb_id': tmdb_id, 
                 'plex_available': plex_avail, 
-                'plex_url': plex_avail
+                'plex_url': plex_avail,
+                'availability_source': source,
             })
             
+            # Remember positives from any tier (all are exact or id-based) and negatives from authoritative tiers
+            if title and source and source != 'local' and (plex_avail or source == 'plex'):
+                _LOCAL_AVAILABILITY_INDEX.put(availability_scope, media_type, plex_avail, tmdb_id=tmdb_id, title_key=normalize_title(title))
+            
             if tmdb_id:
                 tmdb_map[title] = tmdb_id
         
-        available_titles = [r['ai_title'] for r in results if r.get('plex_available') and r.get('ai_title') not in watched_set_all]
-        return results, available_titles, tmdb_map, time.time() - start_batch, availability_debug_logs
+        watched_ids = watched_movie_ids if media_type == 'movie' else watched_show_ids
+        available_titles = [r['ai_title'] for r in results if r.get('plex_available') and r.get('ai_title') not in watched_set_all
+                            and r.get('tmdb_id') not in watched_ids]
+        return results, available_titles, tmdb_map, time.time() - start_batch, availability_debug_logs, tier_stats
 
-    show_matches, rec_shows, tmdb_map_shows, dur_shows, show_debug_logs = _resolve(ai_shows, 'show', tmdb_pre_map_shows)
-    movie_matches, rec_movies, tmdb_map_movies, dur_movies, movie_debug_logs = _resolve(ai_movies, 'movie', tmdb_pre_map_movies)
+    show_matches, rec_shows, tmdb_map_shows, dur_shows, show_debug_logs, show_tier_stats = _resolve(ai_shows, 'show', tmdb_pre_map_shows)
+    movie_matches, rec_movies, tmdb_map_movies, dur_movies, movie_debug_logs, movie_tier_stats = _resolve(ai_movies, 'movie', tmdb_pre_map_movies)
     tmdb_map_all = {**tmdb_map_shows, **tmdb_map_movies}
     timing['availability'] = dur_shows + dur_movies
     timing['fuzzy_match'] = timing['availability']  # maintain legacy key
@@ -2639,8 +2603,14 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
         'duration_shows': round(dur_shows,3),
         'duration_movies': round(dur_movies,3),
         'duration_total': round(timing['availability'],3),
-        'optimization': 'direct_plex_api',
-        'plex_configured': get_plex_client() is not None
+        'optimization': 'tiered_chain',
+        'plex_configured': get_plex_client() is not None,
+        'tier_order': tier_order,
+        'tiers': summarize_tier_stats(show_tier_stats, movie_tier_stats),
+        'tiers_shows': show_tier_stats,
+        'tiers_movies': movie_tier_stats,
+        'local_index_size': len(_LOCAL_AVAILABILITY_INDEX),
+        'overseerr_errors': overseerr_errors[:20],
     }
     # TMDb resolution debug summary
     if tmdb_resolution_events:
@@ -2662,8 +2632,8 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
             if x and x not in seen:
                 seen.add(x); out.append(x)
         return out
-    ai_shows_unavailable = dedup([m.get('ai_title') for m in show_matches if not m.get('plex_available')])
-    ai_movies_unavailable = dedup([m.get('ai_title') for m in movie_matches if not m.get('plex_available')])
+    ai_shows_unavailable = dedup([m.get('ai_title') for m in show_matches if not m.get('plex_available') and m.get('tmdb_id') not in watched_show_ids])
+    ai_movies_unavailable = dedup([m.get('ai_title') for m in movie_matches if not m.get('plex_available') and m.get('tmdb_id') not in watched_movie_ids])
 
     # Step 8: Resolve posters for available recommendations (best-effort) - BATCH OPTIMIZATION
     t7 = time.time()
@@ -2699,9 +2669,10 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
     total_tmdb = show_src.get('tmdb', 0) + movie_src.get('tmdb', 0)
     poster_source_summary = 'TMDb' if total_tmdb else 'None'
 
+    prompt_sections = ((gemini_recs.get('prompt_tokens') or {}).get('history') or {}).get('sections', {})
     debug.update({
         'watched_set_count': len(watched_set_all),
-        'watched_set_count_recent_window': len(set(shows + movies)),
+        'watched_set_count_recent_window': history['recent_window_count'],
         'recent_shows': last10_shows,
         'recent_movies': last10_movies,
         'ai_error': gemini_recs.get('error'),
@@ -2714,6 +2685,13 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
         'ai_raw_response': gemini_recs.get('raw_response'),
         'ai_parsed_json': gemini_recs.get('parsed_json'),
         'ai_usage_today': gemini_recs.get('usage_today'),
+        'ai_router': gemini_recs.get('ai_router'),
+        'ai_hedge': gemini_recs.get('ai_hedge'),
+        'ai_parse': gemini_recs.get('ai_parse'),
+        'ai_cache': gemini_recs.get('ai_cache'),
+        'ai_local': gemini_recs.get('local'),
+        'ai_prompt_tokens': gemini_recs.get('prompt_tokens'),
+        'ai_provider_used': gemini_recs.get('provider_used') or g.AI_PROVIDER,
         'ai_daily_quota': None,
         'ai_daily_remaining': None,
         'ai_shows': ai_shows,
@@ -2722,10 +2700,10 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
         'ai_shows_available': rec_shows,
         'ai_movies_available': rec_movies,
         'watched_list_prompt_counts': {
-            'shows_total': len(watched_shows_unique),
-            'shows_included': len(watched_shows_in_prompt),
-            'movies_total': len(watched_movies_unique),
-            'movies_included': len(watched_movies_in_prompt),
+            'shows_total': history['watched_shows_total'],
+            'shows_included': prompt_sections.get('Also watched shows', {}).get('kept', 0),
+            'movies_total': history['watched_movies_total'],
+            'movies_included': prompt_sections.get('Also watched movies', {}).get('kept', 0),
         },
         'timing': timing,
         'availability_matching': {
@@ -2825,7 +2803,7 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
     'ai_movies_unavailable': ai_movies_unavailable,
         'ai_shows_available': rec_shows,
         'ai_movies_available': rec_movies,
-    'history_count': len(hist_all),
+    'history_count': history['history_count'],
     'show_posters': show_posters,
     'movie_posters': movie_posters,
     'show_posters_unavailable': show_posters_unavailable,
@@ -2846,6 +2824,167 @@ def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=Non
     return result
 
 
+# Result fields holding per-title lists, by media type; a pool page keeps only its titles
+_POOL_PAGE_FIELDS = {
+    'show': ('shows', 'ai_shows', 'ai_shows_titles', 'ai_shows_available', 'ai_shows_unavailable', 'show_posters', 'show_posters_unavailable'),
+    'movie': ('movies', 'ai_movies', 'ai_movies_titles', 'ai_movies_available', 'ai_movies_unavailable', 'movie_posters', 'movie_posters_unavailable'),
+}
+# How strongly pool re-ranking follows the taste profile (vs. the AI's own order); moods
+# that are meant to leave the user's comfort zone invert or ignore it
+_POOL_AFFINITY_WEIGHT = {'comfort_zone': -0.6, 'surprise': 0.0}
+_POOL_PAGE_SIZE = 20
+
+
+def _pool_items(result):
+    """Candidates of a finished run per media type, in AI order, with TMDb genre ids and year."""
+    items = {}
+    for mt, ai_key, poster_keys in (('show', 'ai_shows', ('show_posters', 'show_posters_unavailable')),
+                                    ('movie', 'ai_movies', ('movie_posters', 'movie_posters_unavailable'))):
+        posters = {p.get('title'): p for key in poster_keys for p in result.get(key) or [] if isinstance(p, dict)}
+        items[mt] = []
+        for it in result.get(ai_key) or []:
+            if not isinstance(it, dict) or not it.get('title'):
+                continue
+            poster = posters.get(it['title']) or {}
+            items[mt].append({'title': it['title'], 'tmdb_id': it.get('tmdb_id') or poster.get('tmdb_id'),
+                              'year': it.get('year') or poster.get('year'), 'genre_ids': poster.get('genre_ids') or []})
+    return items
+
+
+def _pool_page(result, page):
+    """Copy of a pooled run's result restricted to the page's titles, in page order."""
+    out = dict(result)
+    for mt, fields in _POOL_PAGE_FIELDS.items():
+        order = {title: i for i, title in enumerate(page[mt])}
+        for field in fields:
+            entries = [it for it in result.get(field) or [] if (it.get('title') if isinstance(it, dict) else it) in order]
+            out[field] = sorted(entries, key=lambda it: order[it.get('title') if isinstance(it, dict) else it])
+    out['debug'] = dict(result.get('debug') or {})
+    return out
+
+
+def _segment_run(decade_code, genre_code, mood_code, requested_model, selected_libraries):
+    """Shared resolved run for a custom-mode segment, generated at most once per SEGMENT_POOL_TTL.
+
+    Returns (result, info); result carries debug['ai_error'] when generation failed."""
+    season = get_current_holiday_season() if mood_code == 'seasonal' else None
+    key = (decade_code, genre_code, mood_code, season, requested_model or '', tuple(sorted(selected_libraries)))
+    info = {'key': [k for k in key[:4]], 'hit': True}
+    with _SEGMENT_POOLS.key_lock(key):
+        pool = _SEGMENT_POOLS.get(key, g.SEGMENT_POOL_TTL)
+        if pool is None:
+            info['hit'] = False
+            result = _recommend_fresh('segment', 'custom', decade_code, genre_code, mood_code, requested_model,
+                                      per_type=getattr(g, 'RECOMMENDATION_POOL_SIZE', _POOL_PAGE_SIZE), segment=True)
+            debug = result.get('debug') or {}
+            if debug.get('ai_error') or debug.get('error') or not (result.get('ai_shows') or result.get('ai_movies')):
+                info['error'] = debug.get('ai_error') or debug.get('error') or 'no recommendations'
+                return result, info
+            pool = _SEGMENT_POOLS.put(key, result, {})
+    info['age_s'] = round(time.time() - pool['created'], 1)
+    return pool['result'], info
+
+
+def recommend_for_user(user_id, mode='history', decade_code=None, genre_code=None, mood_code=None, requested_model=None, more=False):
+    """Recommendations for one user, served from their candidate pool when possible.
+
+    A fresh run asks the AI for RECOMMENDATION_POOL_SIZE titles per media type and resolves
+    them all; the result is pooled per (user, mode, filters, model, libraries). Each request
+    then takes the next page of unserved titles from the pool, re-ranked against the taste
+    profile, with no AI call or TMDb search. A new run starts when the pool is used up or
+    older than RECOMMENDATION_POOL_TTL (0 disables pooling). In custom mode the run is the
+    segment's shared one (see _segment_run) until the user has used that up. With more=True
+    only the pool is used: None when there is no pool, an empty page once it is used up."""
+    import time
+    t0 = time.time()
+    pool_ttl = getattr(g, 'RECOMMENDATION_POOL_TTL', 0)
+    if pool_ttl <= 0 and not more:
+        return _recommend_fresh(user_id, mode, decade_code, genre_code, mood_code, requested_model)
+    selected_libraries = getattr(g, 'SELECTED_LIBRARIES', [])
+    if isinstance(selected_libraries, str):
+        selected_libraries = [selected_libraries] if selected_libraries else []
+    selected_libraries = [str(lib) for lib in selected_libraries]
+    key = (str(user_id), mode, decade_code, genre_code, mood_code, requested_model or '', tuple(sorted(selected_libraries)))
+
+    history = get_user_history_summary(user_id, selected_libraries)
+    taste_profile, taste_info = _update_taste_profile(user_id, selected_libraries, history)
+    watched_titles = history['watched_set_all']
+    watched = {'show': taste_watched_ids(taste_profile, 'show'), 'movie': taste_watched_ids(taste_profile, 'movie')}
+    weight = _POOL_AFFINITY_WEIGHT.get(mood_code, 0.6)
+
+    def rank(mt, item, prior):
+        return weight * taste_score(taste_profile, item.get('genre_ids'), item.get('year')) + 0.4 * prior
+
+    def exclude(mt, item):
+        # Watched since the pool was built
+        return item['title'] in watched_titles or (item.get('tmdb_id') or 0) in watched[mt]
+
+    def serve(pool, min_items):
+        page = _CANDIDATE_POOLS.take(pool, _POOL_PAGE_SIZE, rank, exclude, min_items=min_items)
+        if page is None:
+            return None
+        out = _pool_page(pool['result'], page)
+        out['user_id'] = user_id
+        out['history_count'] = history['history_count']
+        out['top_shows'], out['top_movies'] = history['top_shows'], history['top_movies']
+        out['pool'] = dict(_CANDIDATE_POOLS.info(pool), exhausted=not any(page.values()))
+        return out
+
+    ttl = pool_ttl if pool_ttl > 0 else float('inf')
+
+    def from_pool(out):
+        # The pooled run's own timing stays visible; 'pool' is the time this page took
+        out['debug']['candidate_pool'] = dict(out['pool'], hit=True)
+        out['debug']['timing'] = dict(out['debug'].get('timing') or {}, pool=time.time() - t0)
+        out['debug']['taste_profile'] = dict(taste_info or {}, summary=summarize_taste_profile(taste_profile))
+        return out
+
+    pool = _CANDIDATE_POOLS.get(key, ttl)
+    if more:
+        return from_pool(serve(pool, 0)) if pool is not None else None
+    # Reuse the pool while it still fills at least half a page
+    out = serve(pool, _POOL_PAGE_SIZE) if pool is not None else None
+    if out is not None:
+        print(f"DEBUG: served user_id={user_id} mode={mode} from candidate pool ({out['pool']})")
+        return from_pool(out)
+    # One build per key: concurrent requests wait here and are then served from the new pool
+    with _CANDIDATE_POOLS.key_lock(key):
+        fresh_pool = _CANDIDATE_POOLS.get(key, ttl)
+        if fresh_pool is not None and fresh_pool is not pool:
+            out = serve(fresh_pool, 1)
+            if out is not None:
+                return from_pool(out)
+        result, segment_info = None, None
+        if mode == 'custom' and getattr(g, 'SEGMENT_POOL_TTL', 0) > 0 and g.AI_PROVIDER != 'local':
+            result, segment_info = _segment_run(decade_code, genre_code, mood_code, requested_model, selected_libraries)
+            if 'error' in segment_info:
+                # Personal run instead, which can still fall back to the local recommender
+                result = None
+            elif pool is not None and pool['result'] is result:
+                # This user has already been through the whole shared list: personal run instead
+                segment_info['used_up'] = True
+                result = None
+        if result is None:
+            result = _recommend_fresh(user_id, mode, decade_code, genre_code, mood_code, requested_model,
+                                      per_type=getattr(g, 'RECOMMENDATION_POOL_SIZE', _POOL_PAGE_SIZE),
+                                      history=history, taste=(taste_profile, taste_info))
+            debug = result.get('debug') or {}
+            if debug.get('ai_error') or debug.get('error') or not (result.get('ai_shows') or result.get('ai_movies')):
+                return result
+            if (debug.get('ai_local') or {}).get('fallback'):
+                # Stand-in for a failed AI run: not pooled, so the next request tries the AI again
+                out = _pool_page(result, {mt: [it['title'] for it in items[:_POOL_PAGE_SIZE]]
+                                          for mt, items in _pool_items(result).items()})
+                if segment_info is not None:
+                    out['debug']['segment_pool'] = segment_info
+                return out
+        pool = _CANDIDATE_POOLS.put(key, result, _pool_items(result))
+    out = serve(pool, 0)
+    out['debug']['candidate_pool'] = dict(out['pool'], hit=False)
+    if segment_info is not None:
+        out['debug']['segment_pool'] = segment_info
+    return out
+
 
 # Simple in-process cache for TMDb keyword id lookups (category -> keyword id or None)
 _KEYWORD_ID_CACHE = {}
@@ -2870,9 +3009,10 @@ def tmdb_keyword_id(term: str) -> int | None:
             return None
         # Pick best fuzzy match
         target_norm = normalize_title(term)
+        name_scores = score_one_to_many(target_norm, normalize_titles([r.get('name') or '' for r in results]), scorer=fuzz.token_sort_ratio)
+        scores = dict(zip(map(id, results), name_scores.tolist()))
         def _score(r):
-            name = r.get('name') or ''
-            return fuzz.token_sort_ratio(target_norm, normalize_title(name))
+            return scores[id(r)]
         best = sorted(results, key=_score, reverse=True)[0]
         score = _score(best)
         if score < 55:  # too weak
@@ -2930,9 +3070,10 @@ def overseerr_keyword_id(term: str) -> int | None:
         
         # Pick best fuzzy match
         target_norm = normalize_title(term)
+        name_scores = score_one_to_many(target_norm, normalize_titles([r.get('name', '') for r in results]), scorer=fuzz.token_sort_ratio)
+        scores = dict(zip(map(id, results), name_scores.tolist()))
         def _score(r):
-            name = r.get('name', '')
-            return fuzz.token_sort_ratio(target_norm, normalize_title(name))
+            return scores[id(r)]
         
         best = sorted(results, key=_score, reverse=True)[0]
         score = _score(best)
@@ -2963,67 +3104,9 @@ def lookup_user_by_identifier(identifier):
     Lookup user by email, username, or friendly_name.
     Returns user dict if found, None otherwise.
     """
-    users = get_cached_users()
-    if not users:
+    if not identifier:
         return None
-    
-    low = identifier.lower()
-    match = None
-    
-    # Exact match against username/email first
-    for u in users:
-        uname = str(u.get('username') or '').lower()
-        email = str(u.get('email') or '').lower()
-        if (uname and low == uname) or (email and low == email):
-            match = u
-            break
-    
-    # Relaxed contains match (beginning match) if exact not found
-    if not match:
-        for u in users:
-            uname = str(u.get('username') or '').lower()
-            email = str(u.get('email') or '').lower()
-            if (uname and uname.startswith(low)) or (email and email.startswith(low)):
-                match = u
-                break
-    
-    # Friendly name exact match
-    if not match:
-        for u in users:
-            fname = str(u.get('friendly_name') or '').lower()
-            if fname and low == fname:
-                match = u
-                break
-    
-    # As a last resort, refresh users once more via API to capture recent changes
-    if not match:
-        try:
-            params = {'apikey': g.TAUTULLI_API_KEY, 'cmd': 'get_users'}
-            resp = requests.get(f"{g.TAUTULLI_URL}/api/v2", params=params, timeout=5)
-            data = resp.json()
-            payload = data.get('response', {}).get('data', [])
-            api_users = []
-            if isinstance(payload, list):
-                api_users = payload
-            elif isinstance(payload, dict):
-                if isinstance(payload.get('users'), list):
-                    api_users = [u for u in payload['users'] if u.get('is_active', True)]
-                elif isinstance(payload.get('data'), list):
-                    api_users = payload['data']
-            
-            for u in api_users:
-                uname = str(u.get('username') or '').lower()
-                email = str(u.get('email') or '').lower()
-                if (uname and low == uname) or (email and low == email):
-                    match = u
-                    break
-                if (uname and uname.startswith(low)) or (email and email.startswith(low)):
-                    match = u
-                    break
-        except Exception:
-            pass
-    
-    return match
+    return _USER_DIRECTORY.lookup(identifier)
 
 
 def get_current_holiday_season():
@@ -3096,8 +3179,49 @@ def get_seasonal_prompt():
         )
 
 
-@app.route('/recommendations')
-def recommendations():
+@app.route('/api/users/search')
+def api_users_search():
+    """Paginated typeahead search over the cached user directory (admin picker)."""
+    if getattr(g, 'USER_MODE', False):
+        return abort(403)
+    q = (request.args.get('q') or '').strip()
+    try:
+        page = int(request.args.get('page') or 1)
+        per_page = int(request.args.get('per_page') or 25)
+    except ValueError:
+        return jsonify({'error': 'page and per_page must be integers'}), 400
+    total, users = _USER_DIRECTORY.search(q, page=page, per_page=per_page)
+    page = max(1, page)
+    per_page = max(1, min(100, per_page))
+    return jsonify({
+        'query': q,
+        'page': page,
+        'per_page': per_page,
+        'total': total,
+        'has_more': page * per_page < total,
+        'results': [{'user_id': str(u.get('user_id')), 'name': display_name(u)} for u in users],
+    })
+
+@app.route('/api/ai/telemetry')
+def api_ai_telemetry():
+    """Rolling per-model AI call stats (latency p50/p95/p99, parse rate, tokens) for admins."""
+    if getattr(g, 'USER_MODE', False) or not _is_request_localhost(request):
+        return abort(403)
+    try:
+        hours = float(request.args.get('hours') or 24)
+        limit = int(request.args.get('recent') or 20)
+    except ValueError:
+        return jsonify({'error': 'hours and recent must be numbers'}), 400
+    hours = max(0.1, min(hours, 24 * 30))
+    return jsonify({
+        'hours': hours,
+        'models': get_call_stats(hours),
+        'router': _MODEL_ROUTER.stats(),
+        'recent': get_recent_calls(max(0, min(limit, 200))),
+    })
+
+def _recommendation_args():
+    """Validated /recommendations query parameters: (params, None) or (None, error response)."""
     # Get parameters
     user_id = request.args.get('user_id')
     user = request.args.get('user')  # email/username alternative
@@ -3116,14 +3240,14 @@ def recommendations():
         # Email/username lookup
         match = lookup_user_by_identifier(user)
         if not match:
-            return jsonify({'error': f'User not found: {user}'}), 400
+            return None, (jsonify({'error': f'User not found: {user}'}), 400)
         selected_user_id = str(match.get('user_id'))
     else:
-        return jsonify({'error': 'Either user_id or user parameter required'}), 400
+        return None, (jsonify({'error': 'Either user_id or user parameter required'}), 400)
     
     # Validate mode
     if mode not in ['history', 'custom']:
-        return jsonify({'error': 'mode must be "history" or "custom"'}), 400
+        return None, (jsonify({'error': 'mode must be "history" or "custom"'}), 400)
     
     # Parse decade parameter  
     decade_code = None
@@ -3141,7 +3265,7 @@ def recommendations():
         }
         decade_code = decade_mapping.get(decade.lower())
         if decade_code is None:
-            return jsonify({'error': f'Invalid decade: {decade}. Valid options: 1950s-2020s'}), 400
+            return None, (jsonify({'error': f'Invalid decade: {decade}. Valid options: 1950s-2020s'}), 400)
     
     # Parse genre parameter
     genre_code = None
@@ -3157,7 +3281,7 @@ def recommendations():
         genre_code = genre_mapping.get(genre.lower())
         if genre_code is None:
             valid_genres = list(set(genre_mapping.keys()))
-            return jsonify({'error': f'Invalid genre: {genre}. Valid options: {", ".join(sorted(valid_genres))}'}), 400
+            return None, (jsonify({'error': f'Invalid genre: {genre}. Valid options: {", ".join(sorted(valid_genres))}'}), 400)
     
     # Parse mood parameter
     mood_code = None
@@ -3174,7 +3298,7 @@ def recommendations():
         mood_code = mood_mapping.get(mood.lower())
         if mood_code is None:
             valid_moods = ['underrated', 'surprise me', 'out of my comfort zone', 'comfort food', 'award winners', 'popular (streaming services)', 'seasonal']
-            return jsonify({'error': f'Invalid mood: {mood}. Valid options: {", ".join(valid_moods)}'}), 400
+            return None, (jsonify({'error': f'Invalid mood: {mood}. Valid options: {", ".join(valid_moods)}'}), 400)
     
     # Validate custom mode requirements
     if mode == 'custom':
@@ -3182,12 +3306,29 @@ def recommendations():
             # Mood mode - decade and genre are ignored
             pass
         elif not decade_code and not genre_code:
-            return jsonify({'error': 'Custom mode requires at least one of: decade, genre, mood'}), 400
+            return None, (jsonify({'error': 'Custom mode requires at least one of: decade, genre, mood'}), 400)
     
     # Validate format
     if format_type not in ['json', 'html']:
-        return jsonify({'error': 'format must be "json" or "html"'}), 400
-    
+        return None, (jsonify({'error': 'format must be "json" or "html"'}), 400)
+    return {
+        'user_id': selected_user_id,
+        'mode': mode,
+        'decade_code': decade_code,
+        'genre_code': genre_code,
+        'mood_code': mood_code,
+        'model': model,
+        'format': format_type,
+    }, None
+
+@app.route('/recommendations')
+def recommendations():
+    params, error = _recommendation_args()
+    if error:
+        return error
+    selected_user_id, mode, format_type = params['user_id'], params['mode'], params['format']
+    decade_code, genre_code, mood_code, model = params['decade_code'], params['genre_code'], params['mood_code'], params['model']
+
     # Generate recommendations
     try:
         recs = recommend_for_user(selected_user_id, mode=mode, decade_code=decade_code, genre_code=genre_code, mood_code=mood_code, requested_model=model)
@@ -3209,6 +3350,24 @@ def recommendations():
     except Exception as e:
         return jsonify({'error': f'Internal server error: {str(e)}'}), 500
 
+@app.route('/recommendations/more')
+def recommendations_more():
+    """Next page from the candidate pool built by /recommendations (same parameters); never calls the AI."""
+    params, error = _recommendation_args()
+    if error:
+        return error
+    try:
+        recs = recommend_for_user(params['user_id'], mode=params['mode'], decade_code=params['decade_code'], genre_code=params['genre_code'],
+                                  mood_code=params['mood_code'], requested_model=params['model'], more=True)
+    except Exception as e:
+        return jsonify({'error': f'Internal server error: {str(e)}'}), 500
+    if recs is None:
+        return jsonify({'error': 'No candidate pool for these parameters; request /recommendations first'}), 404
+    if params['format'] == 'html':
+        return render_template('mobile.html', recs=recs, user_id=params['user_id'], mode=params['mode'],
+                               decade_selected=params['decade_code'], genre_selected=params['genre_code'], mood_selected=params['mood_code'])
+    return jsonify(recs)
+
 
 
 
@@ -3222,7 +3381,7 @@ def index():
         missing.append('PLEX_URL')
     if not g.PLEX_TOKEN:
         missing.append('PLEX_TOKEN')
-    if not g.GOOGLE_API_KEY:
+    if not g.GOOGLE_API_KEY and g.AI_PROVIDER != 'local':
         missing.append('GOOGLE_API_KEY')
     if missing:
         # In user mode, settings are hidden; don't redirect to settings.
@@ -3266,55 +3425,7 @@ def index():
                 if not user_login:
                     user_login_error = 'Please enter your Plex email or username.'
                 else:
-                    low = user_login.lower()
-                    match = None
-                    # Exact match against username/email first
-                    for u in users:
-                        uname = str(u.get('username') or '').lower()
-                        email = str(u.get('email') or '').lower()
-                        if (uname and low == uname) or (email and low == email):
-                            match = u
-                            break
-                    # Relaxed contains match (beginning match) if exact not found
-                    if not match:
-                        for u in users:
-                            uname = str(u.get('username') or '').lower()
-                            email = str(u.get('email') or '').lower()
-                            if (uname and uname.startswith(low)) or (email and email.startswith(low)):
-                                match = u
-                                break
-                    if not match:
-                        for u in users:
-                            fname = str(u.get('friendly_name') or '').lower()
-                            if fname and low == fname:
-                                match = u
-                                break
-                    # As a last resort, if still not found, refresh users once more via API to capture recent changes
-                    if not match:
-                        try:
-                            params = {'apikey': g.TAUTULLI_API_KEY, 'cmd': 'get_users'}
-                            resp = requests.get(f"{g.TAUTULLI_URL}/api/v2", params=params, timeout=5)
-                            data = resp.json()
-                            payload = data.get('response', {}).get('data', [])
-                            api_users = []
-                            if isinstance(payload, list):
-                                api_users = payload
-                            elif isinstance(payload, dict):
-                                if isinstance(payload.get('users'), list):
-                                    api_users = [u for u in payload['users'] if u.get('is_active', True)]
-                                elif isinstance(payload.get('data'), list):
-                                    api_users = payload['data']
-                            for u in api_users:
-                                uname = str(u.get('username') or '').lower()
-                                email = str(u.get('email') or '').lower()
-                                if (uname and low == uname) or (email and low == email):
-                                    match = u
-                                    break
-                                if (uname and uname.startswith(low)) or (email and email.startswith(low)):
-                                    match = u
-                                    break
-                        except Exception:
-                            pass
+                    match = lookup_user_by_identifier(user_login)
                     if match:
                         selected_user = match
                         user_id = str(match.get('user_id'))
@@ -3330,7 +3441,6 @@ def index():
                             recs = None
                             debug_info['error'] = f'No filters selected. Received - decade: "{form_decade}", genre: "{form_genre}", mood: "{form_mood}"'
                         else:
-                            refresh_user_cache_if_changed()
                             recs = recommend_for_user(user_id, mode=form_mode, decade_code=decade_int, genre_code=(form_genre or None), mood_code=form_mood, requested_model=form_model)
                             if recs['history_count'] == 0:
                                 debug_info['note'] = 'No watch history found for this user.'
@@ -3359,7 +3469,7 @@ def index():
                 form_model = request.args.get('model') or None
             if not user_id:
                 user_id = str(users[0].get('user_id'))
-            selected_user = next((u for u in users if str(u.get('user_id')) == str(user_id)), users[0])
+            selected_user = _USER_DIRECTORY.get(user_id) or users[0]
             if request.method == 'POST':
                 decade_int = None
                 if form_decade and form_decade.isdigit():
@@ -3372,7 +3482,6 @@ def index():
                     recs = None
                     debug_info['error'] = f'No filters selected. Received - decade: "{form_decade}", genre: "{form_genre}", mood: "{form_mood}"'
                 else:
-                    refresh_user_cache_if_changed()
                     recs = recommend_for_user(user_id, mode=form_mode, decade_code=decade_int, genre_code=(form_genre or None), mood_code=form_mood, requested_model=form_model)
                     if recs['history_count'] == 0:
                         debug_info['note'] = 'No watch history found for this user.'
@@ -3446,7 +3555,8 @@ def index():
         provider_names = {
             'gemini': 'Gemini',
             'mistral': 'Mistral',
-            'openrouter': 'OpenRouter'
+            'openrouter': 'OpenRouter',
+            'local': 'Local (no AI)'
         }
         provider_name = provider_names.get(ai_provider, ai_provider.title())
         
@@ -3458,6 +3568,8 @@ def index():
             api_key_exists = bool(getattr(g, 'MISTRAL_API_KEY', ''))
         elif ai_provider == 'openrouter':
             api_key_exists = bool(getattr(g, 'OPENROUTER_API_KEY', ''))
+        elif ai_provider == 'local':
+            api_key_exists = True
         
         model_display = ai_model if ai_model else 'Auto-selected'
         status_text = f'{provider_name}: {model_display}'
@@ -3515,7 +3627,7 @@ def index():
             category_links.append({'label': cat, 'url': url})
     return render_template(
             template_name,
-    users=users if not getattr(g, 'USER_MODE', False) else [],
+    user_count=len(users) if users else 0,
         selected_user=selected_user,
         recs=recs,
         debug_info=debug_info,
@@ -3705,6 +3817,8 @@ def settings_page():
         else:
             ok, err = save_settings(new_settings)
             if ok:
+                # Tautulli URL/key/DB may have changed: reload users in the background
+                _USER_DIRECTORY.request_refresh()
                 message = '✅ Settings Saved Successfully! Redirecting now....'
                 message_type = 'success'
                 # Show message for 2 seconds, then redirect
@@ -3718,7 +3832,7 @@ def settings_page():
         missing.append('TAUTULLI_URL')
     if not settings['TAUTULLI_API_KEY']:
         missing.append('TAUTULLI_API_KEY')
-    if not settings['GOOGLE_API_KEY']:
+    if not settings['GOOGLE_API_KEY'] and settings.get('AI_PROVIDER') != 'local':
         missing.append('GOOGLE_API_KEY')
     # DB path is optional; try to infer default
     # Build a simple feature summary map for template clarity
@@ -0,0 +1,199 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from typing import Callable, Dict, List, Optional
+
+
+# One small worker pool per tier, so a slow tier can be abandoned on timeout without
+# taking workers from the other tiers; a tier whose workers are all still busy with
+# abandoned calls is skipped instead of queued
+_TIER_WORKERS = 4
+_TIER_EXECUTORS: Dict[str, ThreadPoolExecutor] = {}
+_TIER_IN_FLIGHT: Dict[str, int] = {}
+_TIER_LOCK = threading.Lock()
+
+# Default per-tier timeouts (seconds); overridable per deployment
+DEFAULT_TIER_TIMEOUTS = {
+    'local': 0.5,
+    'overseerr': 8.0,
+    'tautulli_db': 5.0,
+    'plex': 30.0,
+}
+DEFAULT_TIER_ORDER = ['local', 'overseerr', 'tautulli_db', 'plex']
+
+
+class AvailabilityTier:
+    """One source of availability answers.
+
+    ``check(items, media_type)`` returns a dict mapping title -> True/False/None.
+    True always short-circuits slower tiers. False only does so when the tier is
+    authoritative for negatives (e.g. a live Plex search); otherwise the item falls
+    through to the next tier. None (or a missing title) means "unknown".
+    """
+
+    def __init__(self, name: str, check: Callable, timeout: float = 5.0, authoritative_negative: bool = False):
+        self.name = name
+        self.check = check
+        self.timeout = timeout
+        self.authoritative_negative = authoritative_negative
+
+
+def _submit(tier: 'AvailabilityTier', items: List, media_type: str):
+    """Run ``tier.check`` on the tier's own pool; None when all its workers are busy."""
+    with _TIER_LOCK:
+        if _TIER_IN_FLIGHT.get(tier.name, 0) >= _TIER_WORKERS:
+            return None
+        _TIER_IN_FLIGHT[tier.name] = _TIER_IN_FLIGHT.get(tier.name, 0) + 1
+        executor = _TIER_EXECUTORS.get(tier.name)
+        if executor is None:
+            executor = _TIER_EXECUTORS[tier.name] = ThreadPoolExecutor(
+                max_workers=_TIER_WORKERS, thread_name_prefix=f"availability-{tier.name}")
+
+    def _done(_fut):
+        with _TIER_LOCK:
+            _TIER_IN_FLIGHT[tier.name] -= 1
+
+    fut = executor.submit(tier.check, items, media_type)
+    fut.add_done_callback(_done)
+    return fut
+
+
+class AvailabilityChain:
+    """Run availability tiers in order, passing only unresolved items to each next tier."""
+
+    def __init__(self, tiers: List[AvailabilityTier]):
+        self.tiers = [t for t in tiers if t is not None]
+
+    def resolve(self, items: List, media_type: str):
+        """Return (results, stats, logs).
+
+        results: title -> {'available': bool, 'source': tier name or None}
+        stats: tier name -> {'checked', 'hits', 'negatives', 'latency', 'timed_out', 'busy', 'error'}
+        """
+        results: Dict[str, dict] = {}
+        stats: Dict[str, dict] = {}
+        logs: List[str] = []
+        pending = []
+        seen = set()
+        for it in items or []:
+            title = it.get('title') if isinstance(it, dict) else it
+            if not title or title in seen:
+                continue
+            seen.add(title)
+            pending.append(it if isinstance(it, dict) else {'title': it})
+
+        for tier in self.tiers:
+            if not pending:
+                break
+            st = {'checked': len(pending), 'hits': 0, 'negatives': 0, 'latency': 0.0, 'timed_out': False, 'busy': False, 'error': None}
+            stats[tier.name] = st
+            t0 = time.time()
+            answers = {}
+            try:
+                fut = _submit(tier, list(pending), media_type)
+                if fut is None:
+                    st['busy'] = True
+                    logs.append(f"Tier '{tier.name}' skipped: all workers still busy with earlier calls")
+                else:
+                    answers = fut.result(timeout=tier.timeout) or {}
+            except FutureTimeout:
+                st['timed_out'] = True
+                logs.append(f"Tier '{tier.name}' timed out after {tier.timeout}s; falling through")
+            except Exception as e:
+                st['error'] = str(e)[:200]
+                logs.append(f"Tier '{tier.name}' failed: {e}")
+            st['latency'] = round(time.time() - t0, 4)
+
+            still_pending = []
+            for it in pending:
+                title = it.get('title')
+                ans = answers.get(title)
+                if ans is True:
+                    results[title] = {'available': True, 'source': tier.name}
+                    st['hits'] += 1
+                elif ans is False and tier.authoritative_negative:
+                    results[title] = {'available': False, 'source': tier.name}
+                    st['negatives'] += 1
+                else:
+                    still_pending.append(it)
+            pending = still_pending
+            logs.append(f"Tier '{tier.name}': {st['hits']} available, {st['negatives']} unavailable, {len(pending)} unresolved ({st['latency']:.3f}s)")
+
+        # Anything no tier could answer is treated as unavailable
+        for it in pending:
+            results[it.get('title')] = {'available': False, 'source': None}
+        return results, stats, logs
+
+
+class LocalAvailabilityIndex:
+    """Process-level memo of availability answers produced by slower tiers.
+
+    Keys are (scope, media_type, key) where key is either ``tmdb:<id>`` or
+    ``title:<normalized title>`` and scope identifies the library filter in effect.
+    Positives are kept longer than negatives since new additions are the common change.
+    """
+
+    def __init__(self, positive_ttl: float = 6 * 3600, negative_ttl: float = 1800, max_size: int = 50000):
+        self.positive_ttl = positive_ttl
+        self.negative_ttl = negative_ttl
+        self.max_size = max_size
+        self._data: Dict[tuple, tuple] = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _keys(scope: str, media_type: str, tmdb_id, title_key: Optional[str]):
+        keys = []
+        if tmdb_id:
+            keys.append((scope, media_type, f"tmdb:{tmdb_id}"))
+        if title_key:
+            keys.append((scope, media_type, f"title:{title_key}"))
+        return keys
+
+    def get(self, scope: str, media_type: str, tmdb_id=None, title_key: Optional[str] = None):
+        now = time.time()
+        with self._lock:
+            for k in self._keys(scope, media_type, tmdb_id, title_key):
+                ent = self._data.get(k)
+                if ent is None:
+                    continue
+                available, ts = ent
+                ttl = self.positive_ttl if available else self.negative_ttl
+                if now - ts <= ttl:
+                    return available
+                self._data.pop(k, None)
+        return None
+
+    def put(self, scope: str, media_type: str, available: bool, tmdb_id=None, title_key: Optional[str] = None):
+        now = time.time()
+        with self._lock:
+            if len(self._data) >= self.max_size:
+                # Drop the oldest quarter when full
+                oldest = sorted(self._data.items(), key=lambda kv: kv[1][1])[: self.max_size // 4]
+                for k, _ in oldest:
+                    self._data.pop(k, None)
+            for k in self._keys(scope, media_type, tmdb_id, title_key):
+                self._data[k] = (bool(available), now)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._data)
+
+
+def summarize_tier_stats(*stat_dicts: Dict[str, dict]) -> Dict[str, dict]:
+    """Merge per-media-type tier stats into per-tier totals for debug output."""
+    merged: Dict[str, dict] = {}
+    for stats in stat_dicts:
+        for name, st in (stats or {}).items():
+            m = merged.setdefault(name, {'checked': 0, 'hits': 0, 'negatives': 0, 'latency': 0.0, 'timeouts': 0, 'busy': 0, 'errors': 0})
+            m['checked'] += st.get('checked', 0)
+            m['hits'] += st.get('hits', 0)
+            m['negatives'] += st.get('negatives', 0)
+            m['latency'] = round(m['latency'] + float(st.get('latency') or 0.0), 4)
+            m['timeouts'] += 1 if st.get('timed_out') else 0
+            m['busy'] += 1 if st.get('busy') else 0
+            m['errors'] += 1 if st.get('error') else 0
+    return merged
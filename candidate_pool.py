@@ -0,0 +1,107 @@
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+MEDIA_TYPES = ('show', 'movie')
+
+
+class CandidatePoolStore:
+    """Fully resolved recommendation runs kept per (user, mode, filters) key.
+
+    A pool holds the run's result (TMDb ids, availability, posters already resolved)
+    plus its candidates per media type in AI order. ``take`` hands out the best-ranked
+    candidates not served yet, so repeated requests page through one AI generation
+    instead of starting another. Entries expire after the caller's TTL; at most
+    ``max_entries`` pools are kept (oldest evicted).
+    """
+
+    def __init__(self, max_entries: int = 128):
+        self.max_entries = max_entries
+        self._pools: Dict[tuple, Dict] = {}
+        self._lock = threading.Lock()
+        self._key_locks: Dict[tuple, threading.Lock] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: tuple, ttl: float) -> Optional[Dict]:
+        with self._lock:
+            pool = self._pools.get(key)
+            if pool is not None and time.time() - pool['created'] > ttl:
+                self._pools.pop(key, None)
+                pool = None
+            if pool is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+            return pool
+
+    def key_lock(self, key: tuple) -> threading.Lock:
+        """Lock for one key, so concurrent requests for a missing pool build it only once."""
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def put(self, key: tuple, result: Dict, items: Dict[str, List[Dict]]) -> Dict:
+        """Store a run; ``items`` is {media type: [candidate dicts with at least 'title']}."""
+        pool = {
+            'key': key,
+            'created': time.time(),
+            'result': result,
+            'items': {mt: list(items.get(mt) or []) for mt in MEDIA_TYPES},
+            'served': {mt: set() for mt in MEDIA_TYPES},
+            'pages': 0,
+        }
+        with self._lock:
+            if len(self._pools) >= self.max_entries and key not in self._pools:
+                oldest = min(self._pools, key=lambda k: self._pools[k]['created'])
+                self._pools.pop(oldest, None)
+            self._pools[key] = pool
+            self._prune_locks()
+        return pool
+
+    def _prune_locks(self) -> None:
+        """Drop build locks of keys without a pool that nobody holds (caller holds _lock)."""
+        for k in [k for k, lock in self._key_locks.items() if k not in self._pools and not lock.locked()]:
+            self._key_locks.pop(k, None)
+
+    def take(self, pool: Dict, per_type: int, rank: Callable[[str, Dict, float], float],
+             exclude: Callable[[str, Dict], bool], min_items: int = 1) -> Optional[Dict[str, List[str]]]:
+        """Next page: up to ``per_type`` unserved, non-excluded titles per media type, best
+        ``rank(media_type, item, prior)`` first (prior is 1.0 for the AI's first pick down
+        to ~0 for its last). Returns None, serving nothing, if fewer than ``min_items``
+        titles are left in total."""
+        with self._lock:
+            page = {}
+            for mt in MEDIA_TYPES:
+                items = pool['items'][mt]
+                n = max(1, len(items))
+                scored = [(rank(mt, it, 1.0 - i / n), -i, it['title']) for i, it in enumerate(items)
+                          if it['title'] not in pool['served'][mt] and not exclude(mt, it)]
+                scored.sort(reverse=True)
+                page[mt] = [title for _, _, title in scored[:per_type]]
+            if sum(len(v) for v in page.values()) < min_items:
+                return None
+            for mt in MEDIA_TYPES:
+                pool['served'][mt].update(page[mt])
+            if any(page.values()):
+                pool['pages'] += 1
+            return page
+
+    def info(self, pool: Dict) -> Dict:
+        with self._lock:
+            return {
+                'age_s': round(time.time() - pool['created'], 1),
+                'pages': pool['pages'],
+                'size': {mt: len(pool['items'][mt]) for mt in MEDIA_TYPES},
+                'served': {mt: len(pool['served'][mt]) for mt in MEDIA_TYPES},
+                'remaining': {mt: len(pool['items'][mt]) - len(pool['served'][mt]) for mt in MEDIA_TYPES},
+            }
+
+    def clear(self) -> None:
+        with self._lock:
+            self._pools.clear()
+            self._prune_locks()
+
+    def stats(self) -> Dict:
+        with self._lock:
+            return {'entries': len(self._pools), 'max_entries': self.max_entries, 'hits': self.hits, 'misses': self.misses,
+                    'build_locks': len(self._key_locks)}
@@ -0,0 +1,206 @@
+import json
+import os
+import threading
+from array import array
+from typing import Dict, Iterable, List, Optional
+
+import numpy as np
+
+
+KIND_OTHER = -1
+KIND_EPISODE = 0
+KIND_MOVIE = 1
+_KIND_CODES = {'episode': KIND_EPISODE, 'movie': KIND_MOVIE}
+
+
+class TitleInterner:
+    """Process-wide title <-> integer id table shared by all history snapshots."""
+
+    def __init__(self):
+        self._ids: Dict[str, int] = {}
+        self._titles: List[str] = []
+        self._lock = threading.Lock()
+
+    def intern(self, title: Optional[str]) -> int:
+        if not title:
+            return -1
+        tid = self._ids.get(title)
+        if tid is not None:
+            return tid
+        with self._lock:
+            tid = self._ids.get(title)
+            if tid is None:
+                tid = len(self._titles)
+                self._titles.append(title)
+                self._ids[title] = tid
+        return tid
+
+    def title(self, tid: int) -> str:
+        return self._titles[tid]
+
+    def titles(self, ids) -> List[str]:
+        t = self._titles
+        return [t[i] for i in ids]
+
+    def __len__(self):
+        return len(self._titles)
+
+
+TITLES = TitleInterner()
+
+
+class HistorySnapshot:
+    """Columnar play history for one user: timestamp, media kind and interned title id.
+
+    Episodes are stored under their series title, movies under their own title (the
+    same display title the recommender uses). 100k plays take ~1.3 MB instead of 100k
+    dicts. ``summary()`` computes top/recent/watched with vectorized NumPy operations.
+    """
+
+    __slots__ = ('ts', 'kind', 'title_id')
+
+    def __init__(self, ts: np.ndarray, kind: np.ndarray, title_id: np.ndarray):
+        self.ts = ts
+        self.kind = kind
+        self.title_id = title_id
+
+    def __len__(self):
+        return len(self.ts)
+
+    @property
+    def nbytes(self) -> int:
+        return int(self.ts.nbytes + self.kind.nbytes + self.title_id.nbytes)
+
+    @classmethod
+    def from_rows(cls, rows: Iterable) -> 'HistorySnapshot':
+        """Build from a stream of API dicts or tautulli_db.HistoryRow tuples (ts None -> NaN)."""
+        ts = array('d')
+        kind = array('b')
+        tid = array('i')
+        intern = TITLES.intern
+        nan = float('nan')
+        for it in rows:
+            if isinstance(it, dict):
+                media_type = it.get('media_type')
+                title = it.get('grandparent_title') if media_type == 'episode' else it.get('title')
+                when = row_timestamp(it)
+            else:
+                media_type = it.media_type
+                title = it.grandparent_title if media_type == 'episode' else it.title
+                when = it.date
+            code = _KIND_CODES.get(media_type, KIND_OTHER)
+            ts.append(when if when is not None else nan)
+            kind.append(code)
+            tid.append(intern(title) if code != KIND_OTHER else -1)
+        return cls(np.frombuffer(ts, dtype=np.float64).copy(),
+                   np.frombuffer(kind, dtype=np.int8).copy(),
+                   np.frombuffer(tid, dtype=np.int32).copy())
+
+    @staticmethod
+    def _group(keys: np.ndarray, ts0: np.ndarray, pos: np.ndarray):
+        """Unique keys with play count, last timestamp and first position per key."""
+        uniq, inv, counts = np.unique(keys, return_inverse=True, return_counts=True)
+        last = np.full(len(uniq), -np.inf)
+        np.maximum.at(last, inv, ts0)
+        first = np.full(len(uniq), np.iinfo(np.int64).max, dtype=np.int64)
+        np.minimum.at(first, inv, pos)
+        return uniq, counts, last, first
+
+    def summary(self, recent_after: Optional[float], top_n: int, recent_n: int, watched_n: int) -> Dict:
+        """Same shape as history_service.summarize_history_db.
+
+        Ordering mirrors the streaming aggregator: top by (plays desc, last play desc,
+        first seen), recency by (last play desc, first seen); a missing timestamp counts
+        as 0 for ordering but inside the recent window."""
+        n = len(self.ts)
+        valid = (self.kind >= 0) & (self.title_id >= 0)
+        ts = np.asarray(self.ts)
+        ts0 = np.where(np.isnan(ts), 0.0, ts)
+        pos = np.arange(n, dtype=np.int64)
+        keys = self.title_id.astype(np.int64) * 2 + self.kind.astype(np.int64)
+
+        # All-time watched, per kind, by recency
+        uniq, _, last, first = self._group(keys[valid], ts0[valid], pos[valid])
+        watched = {}
+        for k in (KIND_EPISODE, KIND_MOVIE):
+            sel = (uniq % 2) == k
+            order = np.lexsort((first[sel], -last[sel]))
+            watched[k] = TITLES.titles((uniq[sel][order] // 2).tolist())
+
+        # Recent window: top by plays and last N by recency
+        rmask = valid.copy()
+        if recent_after is not None:
+            rmask &= np.isnan(ts) | (ts >= recent_after)
+        r_uniq, r_counts, r_last, r_first = self._group(keys[rmask], ts0[rmask], pos[rmask])
+        top, recent = {}, {}
+        for k in (KIND_EPISODE, KIND_MOVIE):
+            sel = (r_uniq % 2) == k
+            ids = r_uniq[sel] // 2
+            by_plays = np.lexsort((r_first[sel], -r_last[sel], -r_counts[sel]))[:top_n]
+            by_recency = np.lexsort((r_first[sel], -r_last[sel]))[:recent_n]
+            top[k] = TITLES.titles(ids[by_plays].tolist())
+            recent[k] = TITLES.titles(ids[by_recency].tolist())
+
+        return {
+            'top_shows': top[KIND_EPISODE],
+            'top_movies': top[KIND_MOVIE],
+            'recent_shows': recent[KIND_EPISODE],
+            'recent_movies': recent[KIND_MOVIE],
+            'recent_window_count': int(len(np.unique(r_uniq // 2))),
+            'watched_set_all': frozenset(watched[KIND_EPISODE] + watched[KIND_MOVIE]),
+            'watched_shows': watched[KIND_EPISODE][:watched_n],
+            'watched_movies': watched[KIND_MOVIE][:watched_n],
+            'watched_shows_all': watched[KIND_EPISODE],
+            'watched_movies_all': watched[KIND_MOVIE],
+            'watched_shows_total': len(watched[KIND_EPISODE]),
+            'watched_movies_total': len(watched[KIND_MOVIE]),
+            'history_count': int(n),
+        }
+
+    # -- persistence -----------------------------------------------------------------
+
+    def save(self, directory: str, meta: Optional[Dict] = None) -> None:
+        """Write columns as .npy files (titles stored by value, since interned ids are per process)."""
+        os.makedirs(directory, exist_ok=True)
+        ids = np.asarray(self.title_id)
+        present = np.unique(ids[ids >= 0])
+        local = np.full(len(ids), -1, dtype=np.int32)
+        if len(present):
+            local[ids >= 0] = np.searchsorted(present, ids[ids >= 0]).astype(np.int32)
+        np.save(os.path.join(directory, 'ts.npy'), np.asarray(self.ts))
+        np.save(os.path.join(directory, 'kind.npy'), np.asarray(self.kind))
+        np.save(os.path.join(directory, 'title.npy'), local)
+        with open(os.path.join(directory, 'titles.json'), 'w', encoding='utf-8') as f:
+            json.dump(TITLES.titles(present.tolist()), f)
+        with open(os.path.join(directory, 'meta.json'), 'w', encoding='utf-8') as f:
+            json.dump(meta or {}, f)
+
+    @classmethod
+    def load(cls, directory: str, mmap: bool = True):
+        """Load a saved snapshot; returns (snapshot, meta). ts/kind stay memory-mapped when mmap is set."""
+        mode = 'r' if mmap else None
+        ts = np.load(os.path.join(directory, 'ts.npy'), mmap_mode=mode)
+        kind = np.load(os.path.join(directory, 'kind.npy'), mmap_mode=mode)
+        local = np.load(os.path.join(directory, 'title.npy'))
+        with open(os.path.join(directory, 'titles.json'), 'r', encoding='utf-8') as f:
+            titles = json.load(f)
+        with open(os.path.join(directory, 'meta.json'), 'r', encoding='utf-8') as f:
+            meta = json.load(f)
+        # Re-map the snapshot's local title ids onto this process's interning table
+        remap = np.array([TITLES.intern(t) for t in titles] + [-1], dtype=np.int32)
+        title_id = remap[np.where(local >= 0, local, len(titles))]
+        return cls(ts, kind, title_id), meta
+
+
+def row_timestamp(it) -> Optional[float]:
+    """Play timestamp from an API/dict history row, trying the field names Tautulli has used."""
+    for k in ('date', 'watched_at', 'timestamp', 'last_played', 'time'):
+        v = it.get(k)
+        if isinstance(v, (int, float)):
+            return float(v)
+        if isinstance(v, str):
+            try:
+                return float(v)
+            except Exception:
+                continue
+    return None
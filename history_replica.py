@@ -0,0 +1,255 @@
+import os
+import sqlite3
+import threading
+import time
+from typing import Dict, List, Optional
+
+import tautulli_db
+
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS plays (
+    id INTEGER PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    media_type TEXT,
+    title TEXT,
+    date REAL,
+    section_id TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_plays_user_date ON plays (user_id, date);
+CREATE INDEX IF NOT EXISTS idx_plays_user_type_title ON plays (user_id, media_type, title);
+CREATE TABLE IF NOT EXISTS user_titles (
+    user_id TEXT NOT NULL,
+    media_type TEXT NOT NULL,
+    title TEXT NOT NULL,
+    section_id TEXT NOT NULL DEFAULT '',
+    plays INTEGER NOT NULL DEFAULT 0,
+    last_date REAL,
+    PRIMARY KEY (user_id, media_type, title, section_id)
+);
+CREATE INDEX IF NOT EXISTS idx_user_titles_recent ON user_titles (user_id, media_type, last_date);
+CREATE TABLE IF NOT EXISTS user_stats (
+    user_id TEXT PRIMARY KEY,
+    plays INTEGER NOT NULL DEFAULT 0,
+    max_id INTEGER
+);
+"""
+
+
+class HistoryReplica:
+    """App-owned, indexed copy of the Tautulli play history.
+
+    Holds only the columns the recommender uses (display title, type, date, library),
+    synced incrementally from session_history by max-id watermark. Per-user play counts
+    and watched sets are maintained in ``user_titles`` as rows arrive, so lookups no
+    longer depend on the size of the Tautulli DB. The first sync runs in the background;
+    callers fall back to querying Tautulli directly until ``ready``.
+    """
+
+    def __init__(self, path: str, min_sync_interval: float = 15.0, batch_size: int = 5000):
+        self.path = path
+        self.min_sync_interval = min_sync_interval
+        self.batch_size = batch_size
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+        self._sync_lock = threading.Lock()
+        self._last_sync = 0.0
+        self._initial_thread: Optional[threading.Thread] = None
+        self.ready = False
+        self.last_error: Optional[str] = None
+
+    # -- storage ---------------------------------------------------------------------
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def _meta_get(self, key: str) -> Optional[str]:
+        row = self._db().execute('SELECT value FROM meta WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else None
+
+    def _meta_set(self, key: str, value) -> None:
+        self._db().execute('INSERT OR REPLACE INTO meta (key, value) VALUES (?, ?)', (key, str(value)))
+
+    def _reset(self) -> None:
+        conn = self._db()
+        for table in ('plays', 'user_titles', 'user_stats', 'meta'):
+            conn.execute(f'DELETE FROM {table}')
+        conn.commit()
+
+    # -- sync ------------------------------------------------------------------------
+
+    def _apply_batch(self, batch) -> int:
+        conn = self._db()
+        added = 0
+        for play_id, user_id, media_type, title, date, section_id in batch:
+            try:
+                date = float(date) if date is not None else None
+            except Exception:
+                date = None
+            user_id = str(user_id)
+            section = str(section_id) if section_id is not None else ''
+            cur = conn.execute(
+                'INSERT OR IGNORE INTO plays (id, user_id, media_type, title, date, section_id) VALUES (?, ?, ?, ?, ?, ?)',
+                (play_id, user_id, media_type, title, date, section),
+            )
+            if cur.rowcount != 1:
+                continue  # duplicate row from the metadata join
+            added += 1
+            conn.execute(
+                'INSERT INTO user_stats (user_id, plays, max_id) VALUES (?, 1, ?) '
+                'ON CONFLICT(user_id) DO UPDATE SET plays = plays + 1, max_id = MAX(COALESCE(max_id, 0), excluded.max_id)',
+                (user_id, play_id),
+            )
+            if title and media_type in ('episode', 'movie'):
+                conn.execute(
+                    'INSERT INTO user_titles (user_id, media_type, title, section_id, plays, last_date) VALUES (?, ?, ?, ?, 1, ?) '
+                    'ON CONFLICT(user_id, media_type, title, section_id) DO UPDATE SET plays = plays + 1, '
+                    'last_date = MAX(COALESCE(last_date, 0), COALESCE(excluded.last_date, 0))',
+                    (user_id, media_type, title, section, date),
+                )
+        return added
+
+    def sync(self, db_path: str, rebuild: bool = True) -> Optional[int]:
+        """Pull plays newer than the watermark from the Tautulli DB. Returns rows added.
+
+        Rebuilds from scratch when the source DB changes or its max id goes backwards
+        (history deleted / DB restored); with rebuild=False it returns None instead."""
+        with self._sync_lock:
+            source_max = tautulli_db.db_get_max_history_id(db_path)
+            if source_max is None:
+                raise RuntimeError('session_history has no id column; replica unsupported')
+            with self._lock:
+                source = os.path.abspath(db_path)
+                watermark = int(self._meta_get('watermark') or 0)
+                if self._meta_get('source') != source or source_max < watermark:
+                    if not rebuild:
+                        return None
+                    self._reset()
+                    self._meta_set('source', source)
+                    watermark = 0
+                    self._db().commit()
+            added = 0
+            if source_max > watermark:
+                for batch in tautulli_db.db_iter_plays_since(db_path, watermark, self.batch_size):
+                    with self._lock:
+                        added += self._apply_batch(batch)
+                        self._meta_set('watermark', batch[-1][0])
+                        self._db().commit()
+            self._last_sync = time.time()
+            return added
+
+    def _initial_sync(self, db_path: str) -> None:
+        try:
+            t0 = time.time()
+            added = self.sync(db_path)
+            self.ready = True
+            self.last_error = None
+            print(f"DEBUG: history replica synced {added} plays in {time.time() - t0:.2f}s")
+        except Exception as e:
+            self.last_error = str(e)[:200]
+            print(f"DEBUG: history replica initial sync failed: {e}")
+
+    def ensure_synced(self, db_path: str) -> bool:
+        """Bring the replica up to date (throttled). Returns True when it can serve queries."""
+        if not self.ready:
+            if self._initial_thread is None or not self._initial_thread.is_alive():
+                if self.last_error is None or time.time() - self._last_sync > 300:
+                    self._last_sync = time.time()
+                    self._initial_thread = threading.Thread(target=self._initial_sync, args=(db_path,), daemon=True)
+                    self._initial_thread.start()
+            return False
+        if time.time() - self._last_sync >= self.min_sync_interval:
+            try:
+                # Request path: incremental only; a full rebuild goes to the background thread
+                if self.sync(db_path, rebuild=False) is None:
+                    print("DEBUG: history replica source changed; rebuilding in the background")
+                    self.ready = False
+                    self.last_error = None
+                    self._last_sync = time.time()
+                    self._initial_thread = threading.Thread(target=self._initial_sync, args=(db_path,), daemon=True)
+                    self._initial_thread.start()
+                    return False
+            except Exception as e:
+                self.last_error = str(e)[:200]
+                print(f"DEBUG: history replica sync failed: {e}")
+        return True
+
+    # -- queries ---------------------------------------------------------------------
+
+    def user_watermark(self, user_id) -> tuple:
+        with self._lock:
+            row = self._db().execute('SELECT plays, max_id FROM user_stats WHERE user_id = ?', (str(user_id),)).fetchone()
+        return (row[0], row[1]) if row else (0, None)
+
+    @staticmethod
+    def _library_clause(selected_libraries: Optional[List[str]], column: str = 'section_id'):
+        if not selected_libraries:
+            return '', []
+        libs = [str(lib) for lib in selected_libraries]
+        return f" AND {column} IN ({','.join('?' for _ in libs)})", libs
+
+    def summary(self, user_id, recent_after: Optional[float], top_n: int, recent_n: int, watched_n: int,
+                selected_libraries: Optional[List[str]] = None) -> Dict:
+        """History summary in the same shape as history_service.summarize_history_db."""
+        user_id = str(user_id)
+        lib_sql, lib_params = self._library_clause(selected_libraries)
+        out = {'top': {'episode': [], 'movie': []}, 'recent': {'episode': [], 'movie': []},
+               'recent_window': set(), 'watched': {'episode': [], 'movie': []}, 'count': 0}
+        with self._lock:
+            conn = self._db()
+            # One-year window: range scan on (user_id, date)
+            window_sql = 'WHERE user_id = ?' + lib_sql + " AND media_type IN ('episode', 'movie') AND title IS NOT NULL AND title != ''"
+            window_params = [user_id] + lib_params
+            if recent_after is not None:
+                window_sql += ' AND date >= ?'
+                window_params.append(float(recent_after))
+            rows = conn.execute(
+                f'SELECT media_type, title, COUNT(*) AS n, MAX(date) AS last_dt FROM plays {window_sql} GROUP BY media_type, title',
+                window_params,
+            ).fetchall()
+            # All-time watched titles from the maintained per-user table
+            watched_rows = conn.execute(
+                f'SELECT media_type, title, SUM(plays), MAX(last_date) AS last_dt FROM user_titles WHERE user_id = ?{lib_sql} '
+                'GROUP BY media_type, title ORDER BY last_dt DESC',
+                [user_id] + lib_params,
+            ).fetchall()
+            if selected_libraries:
+                count_row = conn.execute(f'SELECT COUNT(*) FROM plays WHERE user_id = ?{lib_sql}', [user_id] + lib_params).fetchone()
+            else:
+                count_row = conn.execute('SELECT plays FROM user_stats WHERE user_id = ?', (user_id,)).fetchone()
+        for mt in ('episode', 'movie'):
+            typed = [r for r in rows if r[0] == mt]
+            out['top'][mt] = [r[1] for r in sorted(typed, key=lambda r: (r[2], r[3] or 0), reverse=True)[:top_n]]
+            out['recent'][mt] = [r[1] for r in sorted(typed, key=lambda r: r[3] or 0, reverse=True)[:recent_n]]
+            out['watched'][mt] = [r[1] for r in watched_rows if r[0] == mt]
+        return {
+            'top_shows': out['top']['episode'],
+            'top_movies': out['top']['movie'],
+            'recent_shows': out['recent']['episode'],
+            'recent_movies': out['recent']['movie'],
+            'recent_window_count': len({r[1] for r in rows}),
+            'watched_set_all': frozenset(out['watched']['episode'] + out['watched']['movie']),
+            'watched_shows': out['watched']['episode'][:watched_n],
+            'watched_movies': out['watched']['movie'][:watched_n],
+            'watched_shows_all': out['watched']['episode'],
+            'watched_movies_all': out['watched']['movie'],
+            'watched_shows_total': len(out['watched']['episode']),
+            'watched_movies_total': len(out['watched']['movie']),
+            'history_count': int(count_row[0] or 0) if count_row else 0,
+        }
+
+    def stats(self) -> Dict:
+        info = {'ready': self.ready, 'path': self.path, 'last_error': self.last_error}
+        if self.ready:
+            with self._lock:
+                info['plays'] = self._db().execute('SELECT COUNT(*) FROM plays').fetchone()[0]
+                info['watermark'] = self._meta_get('watermark')
+        return info
@@ -0,0 +1,321 @@
+import hashlib
+import os
+import queue
+import shutil
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Iterator, List, Optional
+
+import requests
+
+import tautulli_db
+from history_arrays import HistorySnapshot
+
+
+HISTORY_TOP_N = 3
+HISTORY_RECENT_N = 10
+WATCHED_MAX_PER_TYPE = 100  # cap on watched titles included in the AI prompt
+RECENT_WINDOW_SECONDS = 365 * 24 * 60 * 60
+
+
+def _snapshot_summary(snapshot: HistorySnapshot, recent_after: Optional[float]) -> Dict:
+    return snapshot.summary(recent_after, HISTORY_TOP_N, HISTORY_RECENT_N, WATCHED_MAX_PER_TYPE)
+
+
+def summarize_history_db(db_path: str, user_id: str, recent_after: Optional[float], selected_libraries: Optional[List[str]] = None) -> Dict:
+    """Same summary shape as HistorySnapshot.summary, computed with SQL aggregates."""
+    agg = tautulli_db.db_get_history_aggregates(
+        db_path, user_id,
+        recent_after=int(recent_after) if recent_after is not None else None,
+        top_n=HISTORY_TOP_N,
+        recent_n=HISTORY_RECENT_N,
+        selected_libraries=selected_libraries,
+    )
+    recent_window = agg['recent_window_titles']
+    watched_all = agg['watched_all']
+    return {
+        'top_shows': agg['top']['episode'],
+        'top_movies': agg['top']['movie'],
+        'recent_shows': agg['recent']['episode'],
+        'recent_movies': agg['recent']['movie'],
+        'recent_window_count': len(recent_window['episode'] | recent_window['movie']),
+        'watched_set_all': frozenset(watched_all['episode'] | watched_all['movie']),
+        'watched_shows': agg['watched_recent_all']['episode'][:WATCHED_MAX_PER_TYPE],
+        'watched_movies': agg['watched_recent_all']['movie'][:WATCHED_MAX_PER_TYPE],
+        'watched_shows_all': agg['watched_recent_all']['episode'],
+        'watched_movies_all': agg['watched_recent_all']['movie'],
+        'watched_shows_total': len(watched_all['episode']),
+        'watched_movies_total': len(watched_all['movie']),
+        'history_count': agg['history_count'],
+    }
+
+
+# Bounded pool for fetching get_history pages in parallel
+_PAGE_WORKERS = 4
+_PAGE_EXECUTOR = ThreadPoolExecutor(max_workers=_PAGE_WORKERS, thread_name_prefix='history-page')
+# Per-library fan-out waits on page futures, so it must not share the page pool
+_LIBRARY_EXECUTOR = ThreadPoolExecutor(max_workers=_PAGE_WORKERS, thread_name_prefix='history-lib')
+
+
+def _fetch_history_page(api_url: str, api_key: str, user_id, start: int, length: int, section_id=None, timeout: float = 15):
+    """One get_history page: (rows, recordsTotal). Raises on transport/JSON errors."""
+    params = {
+        'apikey': api_key,
+        'cmd': 'get_history',
+        'user_id': user_id,
+        'start': start,
+        'length': length
+    }
+    if section_id is not None:
+        params['section_id'] = section_id
+    resp = requests.get(f"{api_url}/api/v2", params=params, timeout=timeout)
+    payload = resp.json().get('response', {}).get('data', {})
+    if not isinstance(payload, dict):
+        return [], 0
+    total = payload.get('recordsFiltered') if section_id is not None else None
+    total = total or payload.get('recordsTotal') or payload.get('recordsFiltered')
+    return payload.get('data', []) or [], total
+
+
+def _iter_history_pages(api_url: str, api_key: str, user_id, section_id=None, page_size: int = 1000, timeout: float = 15) -> Iterator[List[Dict]]:
+    """Pages for one (user, library) in order: page 0 gives recordsTotal, the rest run concurrently.
+
+    Pages are yielded as soon as they (and every page before them) arrive, so callers can
+    aggregate while later pages are still in flight."""
+    try:
+        first, total = _fetch_history_page(api_url, api_key, user_id, 0, page_size, section_id, timeout)
+    except Exception:
+        return
+    if not first:
+        return
+    try:
+        total = int(total) if total is not None else None
+    except Exception:
+        total = None
+    yield first
+    if total is None:
+        # No total reported: fall back to walking pages until one comes back short
+        page = first
+        start = page_size
+        while len(page) >= page_size:
+            try:
+                page, _ = _fetch_history_page(api_url, api_key, user_id, start, page_size, section_id, timeout)
+            except Exception:
+                break
+            yield page
+            start += page_size
+        return
+    starts = list(range(page_size, total, page_size))
+    futures = [_PAGE_EXECUTOR.submit(_fetch_history_page, api_url, api_key, user_id, st, page_size, section_id, timeout) for st in starts]
+    try:
+        for st, fut in zip(starts, futures):
+            try:
+                rows, _ = fut.result()
+            except Exception as e:
+                print(f"DEBUG: get_history page start={st} failed: {e}")
+                rows = []
+            yield rows
+    finally:
+        for fut in futures:
+            fut.cancel()
+
+
+def _pump_pages(pages: Iterator[List[Dict]], out: queue.Queue) -> None:
+    try:
+        for page in pages:
+            out.put(page)
+    except Exception as e:
+        print(f"DEBUG: get_history library fetch failed: {e}")
+    finally:
+        out.put(None)
+
+
+def iter_api_history(api_url: str, api_key: str, user_id, selected_libraries: Optional[List[str]] = None, page_size: int = 1000, timeout: float = 15) -> Iterator[Dict]:
+    """Stream history rows from the Tautulli API (newest first within each library).
+
+    With a library filter the section_id is passed to get_history; the libraries are
+    fetched concurrently and their pages are yielded in arrival order."""
+    libs = list(dict.fromkeys(str(lib) for lib in selected_libraries)) if selected_libraries else [None]
+    if len(libs) == 1:
+        for page in _iter_history_pages(api_url, api_key, user_id, libs[0], page_size, timeout):
+            yield from page
+        return
+    out: queue.Queue = queue.Queue()
+    for lib in libs:
+        _LIBRARY_EXECUTOR.submit(_pump_pages, _iter_history_pages(api_url, api_key, user_id, lib, page_size, timeout), out)
+    done = 0
+    while done < len(libs):
+        page = out.get()
+        if page is None:
+            done += 1
+        else:
+            yield from page
+
+
+def api_history_watermark(api_url: str, api_key: str, user_id, timeout: float = 5) -> Optional[tuple]:
+    """(recordsTotal, newest row id) from a one-row get_history call; None on failure."""
+    params = {
+        'apikey': api_key,
+        'cmd': 'get_history',
+        'user_id': user_id,
+        'start': 0,
+        'length': 1
+    }
+    try:
+        resp = requests.get(f"{api_url}/api/v2", params=params, timeout=timeout)
+        payload = resp.json().get('response', {}).get('data', {})
+        if not isinstance(payload, dict):
+            return None
+        rows = payload.get('data') or []
+        newest = rows[0] if rows else {}
+        return (payload.get('recordsTotal'), newest.get('id') or newest.get('reference_id') or newest.get('date'))
+    except Exception:
+        return None
+
+
+class HistoryService:
+    """Fetches a user's history once per change and derives every view from that snapshot.
+
+    Summaries are cached per (source, user, library filter) together with a watermark
+    (DB/replica: play count + max id; API: recordsTotal + newest row id). A request only refetches
+    when the watermark moved. Entries older than ``ttl`` are recomputed (the one-year window
+    slides): from the cached HistorySnapshot when there is one, otherwise by querying again.
+    With ``snapshot_dir`` set, API snapshots are also written to disk and memory-mapped back
+    after a restart if the watermark still matches.
+    """
+
+    def __init__(self, ttl: float = 3600, max_entries: int = 256, replica=None, snapshot_dir: Optional[str] = None):
+        self.ttl = ttl
+        self.replica = replica
+        self.snapshot_dir = snapshot_dir
+        self.max_entries = max_entries
+        self._cache: Dict[tuple, Dict] = {}
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def _snapshot_path(self, key) -> Optional[str]:
+        if not self.snapshot_dir:
+            return None
+        name = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:16]
+        return os.path.join(self.snapshot_dir, name)
+
+    def _lookup(self, key, watermark):
+        if watermark is None:
+            return None
+        with self._lock:
+            ent = self._cache.get(key)
+        if ent is None:
+            ent = self._load_snapshot(key, watermark)
+        if ent is None or ent['watermark'] != watermark:
+            with self._lock:
+                self.misses += 1
+            return None
+        if time.time() - ent['ts'] > self.ttl:
+            if ent.get('snapshot') is None:
+                with self._lock:
+                    self.misses += 1
+                return None
+            # Same plays, newer window: recompute from the columns, no refetch
+            ent['summary'] = _snapshot_summary(ent['snapshot'], time.time() - RECENT_WINDOW_SECONDS)
+            ent['ts'] = time.time()
+        with self._lock:
+            self.hits += 1
+        return ent['summary']
+
+    def _load_snapshot(self, key, watermark):
+        path = self._snapshot_path(key)
+        if not path or not os.path.isdir(path):
+            return None
+        try:
+            snapshot, meta = HistorySnapshot.load(path, mmap=True)
+            if meta.get('watermark') != list(watermark):
+                return None
+            ent = {'watermark': watermark, 'snapshot': snapshot, 'ts': 0.0, 'summary': None}
+            with self._lock:
+                self._cache[key] = ent
+            return ent
+        except Exception as e:
+            print(f"DEBUG: could not load history snapshot {path}: {e}")
+            return None
+
+    def _store(self, key, watermark, summary, snapshot: Optional[HistorySnapshot] = None, persist: bool = False):
+        if watermark is None:
+            return
+        with self._lock:
+            if len(self._cache) >= self.max_entries and key not in self._cache:
+                oldest = min(self._cache, key=lambda k: self._cache[k]['ts'])
+                self._cache.pop(oldest, None)
+            self._cache[key] = {'watermark': watermark, 'summary': summary, 'snapshot': snapshot, 'ts': time.time()}
+        path = self._snapshot_path(key) if persist and snapshot is not None else None
+        if path:
+            try:
+                snapshot.save(path, {'watermark': list(watermark)})
+            except Exception as e:
+                print(f"DEBUG: could not save history snapshot {path}: {e}")
+
+    def get_summary(self, user_id, selected_libraries: Optional[List[str]] = None, db_path: Optional[str] = None,
+                    api_url: Optional[str] = None, api_key: Optional[str] = None) -> Dict:
+        """History summary for user_id; 'source' and 'cached' are added for debug output."""
+        libs = tuple(sorted(str(lib) for lib in selected_libraries)) if selected_libraries else ()
+        recent_after = time.time() - RECENT_WINDOW_SECONDS
+        if db_path and self.replica is not None:
+            try:
+                if self.replica.ensure_synced(db_path):
+                    key = ('replica', str(user_id), libs)
+                    watermark = self.replica.user_watermark(user_id)
+                    summary = self._lookup(key, watermark)
+                    if summary is not None:
+                        return dict(summary, source='replica', cached=True)
+                    summary = self.replica.summary(user_id, recent_after, HISTORY_TOP_N, HISTORY_RECENT_N,
+                                                   WATCHED_MAX_PER_TYPE, list(libs) or None)
+                    self._store(key, watermark, summary)
+                    return dict(summary, source='replica', cached=False)
+            except Exception as e:
+                print(f"DEBUG: history replica query failed, using Tautulli DB directly: {e}")
+        if db_path:
+            try:
+                key = ('tautulli_db', str(user_id), libs)
+                watermark = tautulli_db.db_get_history_watermark(db_path, str(user_id))
+                summary = self._lookup(key, watermark)
+                if summary is not None:
+                    return dict(summary, source='tautulli_db', cached=True)
+                try:
+                    summary = summarize_history_db(db_path, str(user_id), recent_after, list(libs) or None)
+                except Exception as e:
+                    # SQL aggregates unavailable on this schema/SQLite build: stream the plays instead
+                    print(f"DEBUG: SQL history aggregates failed, streaming rows: {e}")
+                    snapshot = HistorySnapshot.from_rows(tautulli_db.iter_history(db_path, str(user_id), selected_libraries=list(libs) or None))
+                    summary = _snapshot_summary(snapshot, recent_after)
+                    self._store(key, watermark, summary, snapshot)
+                    return dict(summary, source='tautulli_db', cached=False)
+                self._store(key, watermark, summary)
+                return dict(summary, source='tautulli_db', cached=False)
+            except Exception as e:
+                print(f"DEBUG: Tautulli DB history failed, falling back to API: {e}")
+        key = ('api', str(user_id), libs)
+        watermark = api_history_watermark(api_url, api_key, user_id) if api_url else None
+        summary = self._lookup(key, watermark)
+        if summary is not None:
+            return dict(summary, source='api', cached=True)
+        # Pack pages into columns as the API responds; rows are never collected into a list
+        rows = iter_api_history(api_url, api_key, user_id, list(libs) or None) if api_url else []
+        snapshot = HistorySnapshot.from_rows(rows)
+        summary = _snapshot_summary(snapshot, recent_after)
+        self._store(key, watermark, summary, snapshot, persist=True)
+        return dict(summary, source='api', cached=False)
+
+    def clear(self):
+        with self._lock:
+            self._cache.clear()
+        if self.snapshot_dir and os.path.isdir(self.snapshot_dir):
+            shutil.rmtree(self.snapshot_dir, ignore_errors=True)
+
+    def stats(self) -> Dict:
+        with self._lock:
+            info = {'entries': len(self._cache), 'hits': self.hits, 'misses': self.misses,
+                    'snapshot_bytes': sum(e['snapshot'].nbytes for e in self._cache.values() if e.get('snapshot') is not None)}
+        if self.replica is not None:
+            info['replica'] = self.replica.stats()
+        return info
@@ -0,0 +1,124 @@
+from typing import Dict, Iterable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+from taste_profile import GENRE_NAMES, decade_of
+from title_normalize import normalize_title
+
+
+# Custom-mode genre codes -> TMDb genre ids (movie and TV variants)
+GENRE_CODE_IDS = {
+    'action': [28, 10759], 'adventure': [12, 10759], 'animation': [16], 'biography': [36],
+    'comedy': [35], 'crime': [80], 'documentary': [99], 'drama': [18], 'family': [10751, 10762],
+    'fantasy': [14, 10765], 'history': [36], 'horror': [27], 'musical': [10402], 'mystery': [9648],
+    'romance': [10749], 'scifi': [878, 10765], 'sports': [], 'thriller': [53], 'war': [10752, 10768],
+    'western': [37],
+}
+
+# Score weights per mood: (taste affinity, decade affinity, popularity, rating)
+_DEFAULT_WEIGHTS = (0.55, 0.15, 0.15, 0.15)
+_MOOD_WEIGHTS = {
+    'comfort_food': (0.7, 0.2, 0.05, 0.05),
+    'comfort_zone': (-0.6, -0.1, 0.15, 0.15),
+    'underrated': (0.4, 0.1, -0.2, 0.3),
+    'award_winners': (0.35, 0.05, 0.1, 0.5),
+    'popular_streaming': (0.35, 0.05, 0.45, 0.15),
+    'surprise': (0.2, 0.0, 0.1, 0.2),
+}
+
+
+class Catalogue:
+    """Candidate titles of one media type as arrays, built once and ranked many times.
+
+    Items are dicts with title, tmdb_id, genre_ids, year and optionally popularity/vote
+    (TMDb vote_average). Genres become a multi-hot matrix; popularity is log-scaled to [0, 1].
+    """
+
+    def __init__(self, items: List[Dict]):
+        self.items = list(items)
+        n = len(self.items)
+        self.genre_ids = sorted(set(GENRE_NAMES) | {gid for it in self.items for gid in it.get('genre_ids') or []})
+        self._col = {gid: j for j, gid in enumerate(self.genre_ids)}
+        self.genres = np.zeros((n, len(self.genre_ids)), dtype=np.float32)
+        for i, it in enumerate(self.items):
+            for gid in it.get('genre_ids') or []:
+                self.genres[i, self._col[gid]] = 1.0
+        self.genre_norms = np.linalg.norm(self.genres, axis=1)
+        self.years = np.array([it.get('year') or 0 for it in self.items], dtype=np.int32)
+        self.decades = self.years - self.years % 10
+        pop = np.log1p(np.array([max(0.0, float(it.get('popularity') or 0)) for it in self.items], dtype=np.float32))
+        self.popularity = pop / pop.max() if n and pop.max() > 0 else pop
+        self.vote = np.array([float(it.get('vote') or 0) for it in self.items], dtype=np.float32) / 10.0
+        self._by_id: Dict[int, List[int]] = {}
+        self._by_title: Dict[str, List[int]] = {}
+        for i, it in enumerate(self.items):
+            self._by_id.setdefault(it.get('tmdb_id'), []).append(i)
+            self._by_title.setdefault(normalize_title(it['title']), []).append(i)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def columns(self, genre_ids: Iterable[int]) -> List[int]:
+        return [self._col[gid] for gid in genre_ids if gid in self._col]
+
+    def rows(self, ids: Iterable[int] = (), titles: Iterable[str] = ()) -> List[int]:
+        """Row indices of items with any of the TMDb ids or (normalized) titles."""
+        out = [i for tid in ids for i in self._by_id.get(tid, ())]
+        out += [i for t in titles if t for i in self._by_title.get(normalize_title(t), ())]
+        return out
+
+
+def rank(catalogue: Catalogue, profile: Optional[Dict], *, exclude_ids: Iterable[int] = (),
+         exclude_titles: Iterable[str] = (), decade_range: Optional[Tuple[int, int]] = None,
+         genre_ids: Optional[Sequence[int]] = None, mood: Optional[str] = None,
+         limit: int = 60) -> List[Tuple[Dict, float]]:
+    """Best ``limit`` catalogue items for a taste profile as [(item, score)].
+
+    Affinity is the cosine similarity between an item's genre set and the profile's genre
+    histogram, plus the profile's share of the item's decade; popularity and rating are
+    mixed in by mood. Excluded ids/titles and items outside ``decade_range`` or without
+    any of ``genre_ids`` are never returned."""
+    n = len(catalogue)
+    if not n:
+        return []
+    affinity = np.zeros(n, dtype=np.float32)
+    decade_part = np.zeros(n, dtype=np.float32)
+    if profile:
+        hist = profile.get('genres') or {}
+        p = np.array([float(hist.get(str(gid), 0)) for gid in catalogue.genre_ids], dtype=np.float32)
+        norms = catalogue.genre_norms * np.linalg.norm(p)
+        affinity = np.divide(catalogue.genres @ p, norms, out=np.zeros(n, dtype=np.float32), where=norms > 0)
+        decade_hist = {int(k): v for k, v in (profile.get('decades') or {}).items()}
+        if decade_hist:
+            # Lookup table over the item decades: weight relative to the favourite decade
+            uniq, inverse = np.unique(catalogue.decades, return_inverse=True)
+            top = float(max(decade_hist.values()))
+            decade_part = np.array([decade_hist.get(int(d), 0) / top for d in uniq], dtype=np.float32)[inverse]
+
+    w_aff, w_dec, w_pop, w_vote = _MOOD_WEIGHTS.get(mood, _DEFAULT_WEIGHTS)
+    score = w_aff * affinity + w_dec * decade_part + w_pop * catalogue.popularity + w_vote * catalogue.vote
+    if mood == 'surprise':
+        score += np.random.default_rng().uniform(0.0, 0.3, n).astype(np.float32)
+
+    keep = np.ones(n, dtype=bool)
+    keep[catalogue.rows(exclude_ids, exclude_titles)] = False
+    if decade_range:
+        keep &= (catalogue.years >= decade_range[0]) & (catalogue.years <= decade_range[1])
+    if genre_ids:
+        cols = catalogue.columns(genre_ids)
+        keep &= catalogue.genres[:, cols].sum(axis=1) > 0 if cols else False
+    score = np.where(keep, score, -np.inf)
+    top = np.argsort(-score, kind='stable')[:limit]
+    return [(catalogue.items[i], float(score[i])) for i in top if np.isfinite(score[i])]
+
+
+def as_recommendations(ranked: List[Tuple[Dict, float]]) -> List[Dict]:
+    """Ranked catalogue items in the AI recommendation shape (genre names for the diversity caps)."""
+    return [{
+        'title': it['title'],
+        'year': it.get('year'),
+        'tmdb_id': it.get('tmdb_id'),
+        'genres': [GENRE_NAMES.get(gid, str(gid)) for gid in it.get('genre_ids') or []],
+        'decade': decade_of(it.get('year')),
+        'score': round(s, 4),
+    } for it, s in ranked]
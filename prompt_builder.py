@@ -0,0 +1,118 @@
+import math
+import re
+import threading
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from title_normalize import normalize_title
+
+
+_TOKEN_RE = re.compile(r"[A-Za-z]+|\d+|[^\sA-Za-z\d]")
+_YEAR_RE = re.compile(r'\s*\(\d{4}\)\s*$')
+_SUBTITLE_RE = re.compile(r'\s*(?::|\s-\s|\s–\s).*$')
+# Trailing sequel markers: "2", "II", "Part 3", "Chapter 4", "Vol. 2", "Episode IV"
+_SEQUEL_RE = re.compile(r'\s+(?:(?:part|chapter|vol\.?|volume|episode|season)\s+)?(?:[2-9]|[1-9]\d|ii|iii|iv|vi{0,3}|ix)\s*$', re.IGNORECASE)
+
+# Default token budget for the history block of a prompt (about what the old fixed
+# 3 + 3 + 10 + 10 + 30 + 30 title slices cost)
+DEFAULT_HISTORY_BUDGET = 600
+
+# Correction factor per model, learned from reported prompt_token_count
+_CALIBRATION: Dict[str, float] = {}
+_CALIBRATION_LOCK = threading.Lock()
+
+
+def estimate_tokens(text: str, model: Optional[str] = None) -> int:
+    """Local token estimate (no tokenizer download): words cost ~1 token per 5 letters,
+    digits and punctuation 1 each. Scaled by the model's learned calibration if any."""
+    if not text:
+        return 0
+    n = 0
+    for m in _TOKEN_RE.finditer(text):
+        piece = m.group(0)
+        n += math.ceil(len(piece) / 5) if piece[0].isalpha() else 1
+    factor = _CALIBRATION.get(model, 1.0) if model else 1.0
+    return int(round(n * factor))
+
+
+def calibrate(model: str, estimated_raw: int, actual: Optional[int]) -> None:
+    """Fold one (uncalibrated estimate, provider-reported count) pair into the model's factor."""
+    if not model or not actual or not estimated_raw:
+        return
+    ratio = max(0.25, min(4.0, float(actual) / float(estimated_raw)))
+    with _CALIBRATION_LOCK:
+        prev = _CALIBRATION.get(model)
+        _CALIBRATION[model] = ratio if prev is None else prev * 0.8 + ratio * 0.2
+
+
+def franchise_key(title: str) -> str:
+    """Series/franchise identity: title without year, subtitle and sequel number."""
+    base = _YEAR_RE.sub('', title or '')
+    base = _SUBTITLE_RE.sub('', base)
+    base = _SEQUEL_RE.sub('', base)
+    return normalize_title(base) or normalize_title(title or '')
+
+
+def _collapse(titles: Sequence[str], seen_titles: set, seen_franchises: Dict[str, int]) -> Tuple[List[str], int, int]:
+    """Drop titles already listed, fold franchise entries into their first title ("X (+2)")."""
+    kept: List[str] = []
+    extra: Dict[int, int] = {}
+    dupes = folded = 0
+    for title in titles:
+        if not title:
+            continue
+        norm = normalize_title(title)
+        if norm in seen_titles:
+            dupes += 1
+            continue
+        seen_titles.add(norm)
+        fkey = franchise_key(title)
+        if fkey in seen_franchises:
+            idx = seen_franchises[fkey]
+            if idx >= 0:
+                extra[idx] = extra.get(idx, 0) + 1
+            folded += 1
+            continue
+        seen_franchises[fkey] = len(kept)
+        kept.append(title)
+    out = [f"{t} (+{extra[i]})" if i in extra else t for i, t in enumerate(kept)]
+    return out, dupes, folded
+
+
+def build_history_context(sections: Sequence[Tuple[str, Sequence[str]]], budget_tokens: int = DEFAULT_HISTORY_BUDGET,
+                          model: Optional[str] = None) -> Tuple[str, Dict]:
+    """Render labelled title lists as prompt lines that fit ``budget_tokens``.
+
+    ``sections`` is [(label, titles)] in priority order. A title (or franchise) shown in
+    an earlier section is not repeated later; within a section, sequels fold into the
+    first entry; empty sections are left out. If still over budget, titles are trimmed from the end of the two
+    lowest-priority sections that can still give (longest first), keeping at least one
+    title per non-empty section. Returns (text, stats)."""
+    seen_titles: set = set()
+    seen_franchises: Dict[str, int] = {}
+    lists: List[List[str]] = []
+    stats = {'budget': budget_tokens, 'duplicates_dropped': 0, 'franchises_folded': 0, 'trimmed': 0, 'sections': {}}
+    for label, titles in sections:
+        # Franchises from earlier sections are marked -1 so later sequels are dropped, not folded
+        seen_franchises = {k: -1 for k in seen_franchises}
+        kept, dupes, folded = _collapse(list(titles or []), seen_titles, seen_franchises)
+        stats['duplicates_dropped'] += dupes
+        stats['franchises_folded'] += folded
+        stats['sections'][label] = {'input': len(titles or []), 'kept': len(kept)}
+        lists.append(kept)
+
+    def render() -> str:
+        return '\n'.join(f"{label} ({len(items)}): {items}" for (label, _), items in zip(sections, lists) if items)
+
+    est = estimate_tokens(render(), model)
+    while est > budget_tokens:
+        candidates = [i for i in range(len(lists) - 1, -1, -1) if len(lists[i]) > 1][:2]
+        if not candidates:
+            break
+        i = max(candidates, key=lambda j: len(lists[j]))
+        est -= estimate_tokens(repr(lists[i].pop()) + ', ', model)
+        stats['trimmed'] += 1
+    text = render()
+    for (label, _), items in zip(sections, lists):
+        stats['sections'][label]['kept'] = len(items)
+    stats['estimated_tokens'] = estimate_tokens(text, model)
+    return text, stats
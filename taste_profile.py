@@ -0,0 +1,226 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from typing import Callable, Dict, Iterable, List, Optional, Set, Tuple
+
+from prompt_builder import franchise_key
+from title_normalize import normalize_title
+
+
+# TMDb genre ids (movie and TV lists merged; ids are stable across both)
+GENRE_NAMES = {
+    12: 'Adventure', 14: 'Fantasy', 16: 'Animation', 18: 'Drama', 27: 'Horror', 28: 'Action',
+    35: 'Comedy', 36: 'History', 37: 'Western', 53: 'Thriller', 80: 'Crime', 99: 'Documentary',
+    878: 'Science Fiction', 9648: 'Mystery', 10402: 'Music', 10749: 'Romance', 10751: 'Family',
+    10752: 'War', 10759: 'Action & Adventure', 10762: 'Kids', 10763: 'News', 10764: 'Reality',
+    10765: 'Sci-Fi & Fantasy', 10766: 'Soap', 10767: 'Talk', 10768: 'War & Politics', 10770: 'TV Movie',
+}
+
+MEDIA_TYPES = ('show', 'movie')
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS profiles (
+    key TEXT PRIMARY KEY,
+    updated REAL NOT NULL,
+    data TEXT NOT NULL
+);
+"""
+
+
+def decade_of(year) -> Optional[int]:
+    try:
+        year = int(year)
+    except (TypeError, ValueError):
+        return None
+    return year - year % 10 if 1870 <= year <= 2100 else None
+
+
+def empty_profile() -> Dict:
+    """Profile shape (JSON-serializable).
+
+    titles: {media type: {normalized title: tmdb id or 0}} - every title folded in so far;
+    genres / decades: histograms over those titles (one count per distinct title);
+    franchises: {franchise key: {'title': first title seen, 'count': n}}."""
+    return {'titles': {mt: {} for mt in MEDIA_TYPES}, 'genres': {}, 'decades': {}, 'franchises': {},
+            'plays': 0, 'updated': None}
+
+
+def fold(profile: Dict, media_type: str, title: str, meta: Optional[Dict]) -> None:
+    """Add one watched title (with its cached TMDb metadata, if any) to the profile."""
+    meta = meta or {}
+    profile['titles'][media_type][normalize_title(title)] = int(meta.get('tmdb_id') or 0)
+    for gid in meta.get('genre_ids') or []:
+        profile['genres'][str(gid)] = profile['genres'].get(str(gid), 0) + 1
+    decade = decade_of(meta.get('year'))
+    if decade is not None:
+        profile['decades'][str(decade)] = profile['decades'].get(str(decade), 0) + 1
+    fkey = franchise_key(title)
+    if fkey:
+        ent = profile['franchises'].setdefault(fkey, {'title': title, 'count': 0})
+        ent['count'] += 1
+
+
+def watched_ids(profile: Optional[Dict], media_type: str) -> Set[int]:
+    if not profile:
+        return set()
+    return {tid for tid in profile['titles'].get(media_type, {}).values() if tid}
+
+
+def _shares(hist: Dict[str, int], top_n: int) -> List[Tuple[str, float]]:
+    total = float(sum(hist.values()))
+    if not total:
+        return []
+    ranked = sorted(hist.items(), key=lambda kv: (-kv[1], kv[0]))[:top_n]
+    return [(k, v / total) for k, v in ranked]
+
+
+def summarize(profile: Optional[Dict], top_n: int = 6) -> Dict:
+    """Compact view: top genres/decades with their share, franchises seen 2+ times, title counts."""
+    if not profile:
+        return {}
+    franchises = sorted((f for f in profile['franchises'].values() if f['count'] > 1),
+                        key=lambda f: (-f['count'], f['title']))[:top_n]
+    return {
+        'genres': [(GENRE_NAMES.get(int(k), k), round(s, 3)) for k, s in _shares(profile['genres'], top_n)],
+        'decades': [(f"{k}s", round(s, 3)) for k, s in _shares(profile['decades'], top_n)],
+        'franchises': [(f['title'], f['count']) for f in franchises],
+        'titles': {mt: len(profile['titles'][mt]) for mt in MEDIA_TYPES},
+        'plays': profile.get('plays'),
+    }
+
+
+def score(profile: Optional[Dict], genre_ids, year) -> float:
+    """Affinity of one title to the profile in [0, 1]: its genres' mean weight relative to
+    the favourite genre (70%) plus its decade's weight relative to the favourite decade (30%)."""
+    if not profile:
+        return 0.0
+    genres, decades = profile['genres'], profile['decades']
+    top_genre = max(genres.values(), default=0)
+    top_decade = max(decades.values(), default=0)
+    genre_part = 0.0
+    if top_genre and genre_ids:
+        genre_part = sum(genres.get(str(gid), 0) for gid in genre_ids) / (len(genre_ids) * top_genre)
+    decade = decade_of(year)
+    decade_part = decades.get(str(decade), 0) / top_decade if top_decade and decade is not None else 0.0
+    return 0.7 * genre_part + 0.3 * decade_part
+
+
+def render(profile: Optional[Dict], top_n: int = 6) -> str:
+    """Prompt lines for the profile; '' until there is genre or decade data to describe."""
+    s = summarize(profile, top_n)
+    if not s or not (s['genres'] or s['decades']):
+        return ''
+    lines = [f"Taste profile ({s['titles']['show']} shows, {s['titles']['movie']} movies watched):"]
+    if s['genres']:
+        lines.append('Genres: ' + ', '.join(f"{name} {share:.0%}" for name, share in s['genres']))
+    if s['decades']:
+        lines.append('Decades: ' + ', '.join(f"{name} {share:.0%}" for name, share in s['decades']))
+    if s['franchises']:
+        lines.append('Franchises: ' + ', '.join(f"{title} ({n})" for title, n in s['franchises']))
+    return '\n'.join(lines)
+
+
+class TasteProfileStore:
+    """Persisted per-user taste profiles, one JSON row per (user, library filter) key.
+
+    ``update`` only folds in titles the profile has not seen yet, so each new play costs
+    at most one TMDb lookup (usually a cache hit) and the rest of the history is never
+    re-read. Profiles stay in memory after first use.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.Lock()
+        self._profiles: Dict[str, Dict] = {}
+
+    def _db(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.executescript(_SCHEMA)
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> Optional[Dict]:
+        with self._lock:
+            prof = self._profiles.get(key)
+            if prof is not None:
+                return prof
+            try:
+                row = self._db().execute('SELECT data FROM profiles WHERE key = ?', (key,)).fetchone()
+                prof = json.loads(row[0]) if row else None
+            except Exception as e:
+                print(f"DEBUG: taste profile read failed: {e}")
+                prof = None
+            if prof is not None:
+                self._profiles[key] = prof
+            return prof
+
+    def _save(self, key: str, prof: Dict) -> None:
+        try:
+            with self._lock:
+                conn = self._db()
+                conn.execute('INSERT OR REPLACE INTO profiles (key, updated, data) VALUES (?, ?, ?)',
+                             (key, prof['updated'] or time.time(), json.dumps(prof)))
+                conn.commit()
+        except Exception as e:
+            print(f"DEBUG: taste profile write failed: {e}")
+
+    def update(self, key: str, watched: Dict[str, Iterable[str]], plays: int,
+               lookup: Callable[[str, List[str]], Dict[str, Optional[Dict]]]) -> Tuple[Dict, Dict]:
+        """Fold new titles from ``watched`` ({media type: titles}) into the profile.
+
+        ``lookup(media_type, titles)`` returns {title: TMDb metadata or None}; titles it
+        leaves out (lookup budget spent) stay pending and are retried next time.
+        Returns (profile, info)."""
+        prof = self.get(key) or empty_profile()
+        new: Dict[str, List[str]] = {}
+        for mt in MEDIA_TYPES:
+            known = prof['titles'][mt]
+            seen = set()
+            for title in watched.get(mt) or []:
+                norm = normalize_title(title) if title else ''
+                if norm and norm not in known and norm not in seen:
+                    seen.add(norm)
+                    new.setdefault(mt, []).append(title)
+        info = {'new': sum(len(v) for v in new.values()), 'folded': 0, 'pending': 0}
+        if not new and prof.get('plays') == plays:
+            info['titles'] = sum(len(prof['titles'][mt]) for mt in MEDIA_TYPES)
+            return prof, info
+        metas = {mt: lookup(mt, titles) for mt, titles in new.items()}
+        # Fold into a copy so readers of the current profile never see it half-updated
+        prof = json.loads(json.dumps(prof))
+        with self._lock:
+            for mt, titles in new.items():
+                for title in titles:
+                    if title not in metas[mt]:
+                        info['pending'] += 1
+                    elif normalize_title(title) not in prof['titles'][mt]:
+                        fold(prof, mt, title, metas[mt][title])
+                        info['folded'] += 1
+            prof['plays'] = plays
+            prof['updated'] = time.time()
+            self._profiles[key] = prof
+        self._save(key, prof)
+        info['titles'] = sum(len(prof['titles'][mt]) for mt in MEDIA_TYPES)
+        return prof, info
+
+    def clear(self) -> None:
+        with self._lock:
+            self._profiles.clear()
+            conn = self._db()
+            conn.execute('DELETE FROM profiles')
+            conn.commit()
+
+    def stats(self) -> Dict:
+        try:
+            with self._lock:
+                stored = self._db().execute('SELECT COUNT(*) FROM profiles').fetchone()[0]
+                loaded = len(self._profiles)
+        except Exception:
+            stored, loaded = None, len(self._profiles)
+        return {'stored': stored, 'loaded': loaded, 'path': self.path}
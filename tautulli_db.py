@@ -1,6 +1,16 @@
 import os
+import queue
 import sqlite3
-from typing import List, Dict, Optional
+import threading
+from collections import namedtuple
+from contextlib import contextmanager
+from typing import Iterator, List, Dict, Optional
+
+
+# Read-only connection tuning: large mmap window + page cache, never write
+_MMAP_SIZE = 256 * 1024 * 1024
+_CACHE_SIZE_KIB = 32 * 1024
+_POOL_SIZE = 4
 
 
 def _connect(db_path: str) -> sqlite3.Connection:
@@ -9,10 +19,91 @@ def _connect(db_path: str) -> sqlite3.Connection:
     # Use read-only mode when possible
     uri = f"file:{db_path}?mode=ro"
     try:
-        return sqlite3.connect(uri, uri=True)
+        return sqlite3.connect(uri, uri=True, check_same_thread=False)
     except Exception:
         # Fallback to normal connect
-        return sqlite3.connect(db_path)
+        return sqlite3.connect(db_path, check_same_thread=False)
+
+
+def _apply_read_pragmas(conn: sqlite3.Connection) -> None:
+    for pragma in (f"PRAGMA mmap_size={_MMAP_SIZE}", f"PRAGMA cache_size=-{_CACHE_SIZE_KIB}", "PRAGMA query_only=1", "PRAGMA temp_store=MEMORY"):
+        try:
+            conn.execute(pragma)
+        except Exception:
+            pass
+
+
+def _file_identity(db_path: str) -> tuple:
+    st = os.stat(db_path)
+    return (st.st_ino, st.st_mtime_ns)
+
+
+class _ConnectionPool:
+    """Small pool of persistent read-only connections for one DB file (inode)."""
+
+    def __init__(self, db_path: str, inode: int, size: int = _POOL_SIZE):
+        self.db_path = db_path
+        self.inode = inode
+        self._idle = queue.LifoQueue(maxsize=size)
+        self.closed = False
+
+    def acquire(self) -> sqlite3.Connection:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            conn = _connect(self.db_path)
+            _apply_read_pragmas(conn)
+            return conn
+
+    def release(self, conn: sqlite3.Connection) -> None:
+        if not self.closed:
+            try:
+                self._idle.put_nowait(conn)
+                return
+            except queue.Full:
+                pass
+        conn.close()
+
+    def close(self) -> None:
+        self.closed = True
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                break
+            except Exception:
+                continue
+
+
+_POOLS: Dict[str, _ConnectionPool] = {}
+_POOLS_LOCK = threading.Lock()
+
+
+def _get_pool(db_path: str) -> _ConnectionPool:
+    if not db_path or not os.path.exists(db_path):
+        raise FileNotFoundError(f"Tautulli DB not found: {db_path}")
+    inode = os.stat(db_path).st_ino
+    with _POOLS_LOCK:
+        pool = _POOLS.get(db_path)
+        if pool is not None and pool.inode == inode:
+            return pool
+        # DB file replaced (restore / re-upload): drop the old connections
+        if pool is not None:
+            pool.close()
+        pool = _ConnectionPool(db_path, inode)
+        _POOLS[db_path] = pool
+        return pool
+
+
+@contextmanager
+def db_connection(db_path: str):
+    """Borrow a pooled read-only connection for the duration of a with-block."""
+    pool = _get_pool(db_path)
+    conn = pool.acquire()
+    try:
+        yield conn
+    finally:
+        pool.release(conn)
 
 
 def _get_columns(conn: sqlite3.Connection, table: str) -> set:
@@ -22,10 +113,57 @@ def _get_columns(conn: sqlite3.Connection, table: str) -> set:
     return cols
 
 
+class SchemaInfo:
+    """Tables and per-table columns of a Tautulli DB, introspected once per file version.
+
+    Column sets are loaded lazily the first time a table is asked for.
+    """
+
+    def __init__(self, identity: tuple, tables: set):
+        self.identity = identity
+        self.tables = tables
+        self._columns: Dict[str, set] = {}
+        self._lock = threading.Lock()
+
+    def has_table(self, table: str) -> bool:
+        return table in self.tables
+
+    def columns(self, conn: sqlite3.Connection, table: str) -> set:
+        cols = self._columns.get(table)
+        if cols is None:
+            cols = _get_columns(conn, table) if table in self.tables else set()
+            with self._lock:
+                self._columns[table] = cols
+        return cols
+
+
+_SCHEMAS: Dict[str, SchemaInfo] = {}
+_SCHEMAS_LOCK = threading.Lock()
+
+
+def get_schema(db_path: str, conn: sqlite3.Connection) -> SchemaInfo:
+    """Cached schema for db_path; recomputed when the file's inode or mtime changes."""
+    identity = _file_identity(db_path)
+    with _SCHEMAS_LOCK:
+        schema = _SCHEMAS.get(db_path)
+    if schema is not None and schema.identity == identity:
+        return schema
+    cur = conn.cursor()
+    cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
+    schema = SchemaInfo(identity, {row[0] for row in cur.fetchall()})
+    with _SCHEMAS_LOCK:
+        _SCHEMAS[db_path] = schema
+    return schema
+
+
 def db_get_users(db_path: str) -> List[Dict]:
-    conn = _connect(db_path)
+    with db_connection(db_path) as conn:
+        schema = get_schema(db_path, conn)
+        return _select_users(conn, schema.columns(conn, 'users'))
+
+
+def _select_users(conn: sqlite3.Connection, cols: set) -> List[Dict]:
     cur = conn.cursor()
-    cols = _get_columns(conn, 'users')
     # Common columns in Tautulli users table
     col_user_id = 'user_id' if 'user_id' in cols else 'id'
     display_cols = [c for c in ('friendly_name', 'username', 'email') if c in cols]
@@ -59,19 +197,22 @@ def db_get_users(db_path: str) -> List[Dict]:
         else:
             rec['is_active'] = True
         users.append(rec)
-    conn.close()
     # Return only active users if that flag exists
     return [u for u in users if u.get('is_active', True)]
 
 
-def _select_history(conn: sqlite3.Connection, user_id: str, after: Optional[int] = None, limit: Optional[int] = None, selected_libraries: Optional[List[str]] = None):
-    sh_cols = _get_columns(conn, 'session_history')
-    sm_cols = _get_columns(conn, 'session_history_metadata')
+def _history_exprs(conn: sqlite3.Connection, schema: Optional[SchemaInfo] = None) -> Optional[Dict]:
+    """Column expressions for history queries, adapted to the DB's schema version."""
+    if schema is not None:
+        sh_cols = schema.columns(conn, 'session_history')
+        sm_cols = schema.columns(conn, 'session_history_metadata')
+    else:
+        sh_cols = _get_columns(conn, 'session_history')
+        sm_cols = _get_columns(conn, 'session_history_metadata')
     # Required columns
     if 'user_id' not in sh_cols or 'media_type' not in sh_cols:
-        return []
+        return None
 
-    # Build selectable fields
     title_expr = 'sm.title' if 'title' in sm_cols else 'NULL'
     gp_expr = None
     for c in ('grandparent_title', 'series_name', 'show_title', 'parent_title'):
@@ -79,7 +220,6 @@ def _select_history(conn: sqlite3.Connection, user_id: str, after: Optional[int]
             gp_expr = f"sm.{c}"
             break
     # Determine best available date
-    date_expr = None
     if 'last_viewed_at' in sm_cols:
         date_expr = 'sm.last_viewed_at'
     elif 'stopped' in sh_cols:
@@ -88,94 +228,258 @@ def _select_history(conn: sqlite3.Connection, user_id: str, after: Optional[int]
         date_expr = 'sh.started'
     else:
         date_expr = 'NULL'
+    return {
+        'title': title_expr,
+        'grandparent': gp_expr or 'NULL',
+        'date': date_expr,
+        'section_id': 'sh.section_id' if 'section_id' in sh_cols else None,
+        # Display title per play: series name for episodes, item title for movies
+        'display_title': f"CASE WHEN sh.media_type = 'episode' THEN {gp_expr or 'NULL'} ELSE {title_expr} END",
+    }
 
-    select_fields = [
-        'sh.media_type as media_type',
-        f'{title_expr} as title',
-        (f'{gp_expr} as grandparent_title' if gp_expr else 'NULL as grandparent_title'),
-        f'{date_expr} as dt',
-        ('sh.section_id as section_id' if 'section_id' in sh_cols else 'NULL as section_id')
-    ]
+
+def _history_where(exprs: Dict, user_id: str, after: Optional[int] = None, selected_libraries: Optional[List[str]] = None):
+    """FROM/WHERE clause shared by history queries, with library and date filters pushed down."""
     sql = (
-        f"SELECT {', '.join(select_fields)} "
         "FROM session_history sh "
         "LEFT JOIN session_history_metadata sm ON sm.rating_key = sh.rating_key "
         "WHERE sh.user_id = ? "
     )
-    
+    params: list = [user_id]
     # Add library filter if selected_libraries is provided and section_id is available
-    params = [user_id]
-    if selected_libraries and 'section_id' in sh_cols:
+    if selected_libraries and exprs['section_id']:
         placeholders = ','.join('?' for _ in selected_libraries)
-        sql += f"AND sh.section_id IN ({placeholders}) "
+        sql += f"AND {exprs['section_id']} IN ({placeholders}) "
         params.extend(selected_libraries)
-    
-    sql += f"ORDER BY {date_expr} DESC"
-    
+    if after is not None and exprs['date'] != 'NULL':
+        sql += f"AND {exprs['date']} >= ? "
+        params.append(after)
+    return sql, params
+
+
+# Compact per-play record for streaming consumers (no per-row dict)
+HistoryRow = namedtuple('HistoryRow', ['media_type', 'title', 'grandparent_title', 'date', 'section_id'])
+
+
+def _coerce_ts(dt):
+    if dt is None or isinstance(dt, float):
+        return dt
+    try:
+        return float(dt)
+    except Exception:
+        return None
+
+
+def _iter_history(conn: sqlite3.Connection, user_id: str, after: Optional[int] = None, limit: Optional[int] = None, selected_libraries: Optional[List[str]] = None, schema: Optional[SchemaInfo] = None, batch_size: int = 2000) -> Iterator[HistoryRow]:
+    exprs = _history_exprs(conn, schema)
+    if exprs is None:
+        return
+    select_fields = [
+        'sh.media_type as media_type',
+        f"{exprs['title']} as title",
+        f"{exprs['grandparent']} as grandparent_title",
+        f"{exprs['date']} as dt",
+        (f"{exprs['section_id']} as section_id" if exprs['section_id'] else 'NULL as section_id')
+    ]
+    where_sql, params = _history_where(exprs, user_id, after=after, selected_libraries=selected_libraries)
+    sql = f"SELECT {', '.join(select_fields)} {where_sql}ORDER BY {exprs['date']} DESC"
     if limit:
         sql += f" LIMIT {int(limit)}"
     cur = conn.cursor()
     cur.execute(sql, params)
-    rows = cur.fetchall()
-    out = []
-    for media_type, title, grandparent_title, dt, section_id in rows:
-        rec = {
-            'media_type': media_type,
-            'title': title,
-            'grandparent_title': grandparent_title,
-            'section_id': section_id if section_id is not None else None,
-        }
-        # Normalize dt to float when possible
+    make = HistoryRow._make
+    while True:
+        batch = cur.fetchmany(batch_size)
+        if not batch:
+            break
+        for media_type, title, grandparent_title, dt, section_id in batch:
+            yield make((media_type, title, grandparent_title, _coerce_ts(dt), section_id))
+
+
+def iter_history(db_path: str, user_id: str, after: Optional[int] = None, limit: Optional[int] = None, selected_libraries: Optional[List[str]] = None, batch_size: int = 2000) -> Iterator[HistoryRow]:
+    """Stream a user's plays newest first as HistoryRow tuples, fetched in fetchmany batches.
+
+    Holds a pooled connection until the generator is exhausted or closed."""
+    with db_connection(db_path) as conn:
+        schema = get_schema(db_path, conn)
+        yield from _iter_history(conn, user_id, after=after, limit=limit, selected_libraries=selected_libraries, schema=schema, batch_size=batch_size)
+
+
+def _ranked_titles(conn: sqlite3.Connection, exprs: Dict, user_id: str, order_expr: str, limit: Optional[int], after: Optional[int], selected_libraries: Optional[List[str]]) -> Dict[str, List[tuple]]:
+    """Per media type (episode/movie): distinct display titles with play count and last date,
+    ordered by order_expr and cut to `limit` rows per type with a window function."""
+    where_sql, params = _history_where(exprs, user_id, after=after, selected_libraries=selected_libraries)
+    grouped = (
+        f"SELECT sh.media_type AS media_type, {exprs['display_title']} AS dtitle, "
+        f"COUNT(*) AS plays, MAX({exprs['date']}) AS last_dt "
+        f"{where_sql}AND sh.media_type IN ('episode', 'movie') "
+        f"GROUP BY sh.media_type, dtitle HAVING dtitle IS NOT NULL AND dtitle != ''"
+    )
+    out: Dict[str, List[tuple]] = {'episode': [], 'movie': []}
+    cur = conn.cursor()
+    if limit:
+        sql = (
+            f"SELECT media_type, dtitle, plays, last_dt FROM ("
+            f"SELECT *, ROW_NUMBER() OVER (PARTITION BY media_type ORDER BY {order_expr}) AS rn FROM ({grouped})"
+            f") WHERE rn <= ? ORDER BY media_type, rn"
+        )
         try:
-            rec['date'] = float(dt) if dt is not None else None
-        except Exception:
-            rec['date'] = dt
-        # Apply 'after' filter here if provided
-        if after is not None:
-            try:
-                if rec['date'] is None or float(rec['date']) < float(after):
-                    continue
-            except Exception:
-                # If unparseable, skip filter
-                pass
-        out.append(rec)
+            cur.execute(sql, params + [int(limit)])
+            rows = cur.fetchall()
+        except sqlite3.OperationalError:
+            # SQLite < 3.25 has no window functions: order in SQL, cut per type here
+            cur.execute(f"{grouped} ORDER BY {order_expr}", params)
+            rows = [r for r in cur.fetchall()]
+            counts = {'episode': 0, 'movie': 0}
+            kept = []
+            for r in rows:
+                if counts.get(r[0], 0) < int(limit):
+                    counts[r[0]] = counts.get(r[0], 0) + 1
+                    kept.append(r)
+            rows = kept
+    else:
+        cur.execute(f"{grouped} ORDER BY {order_expr}", params)
+        rows = cur.fetchall()
+    for media_type, title, plays, last_dt in rows:
+        out.setdefault(media_type, []).append((title, plays, last_dt))
     return out
 
 
-def db_get_user_watch_history(db_path: str, user_id: str, after: Optional[int] = None, limit: Optional[int] = 1000, selected_libraries: Optional[List[str]] = None):
-    conn = _connect(db_path)
-    try:
-        return _select_history(conn, user_id, after=after, limit=limit, selected_libraries=selected_libraries)
-    finally:
-        conn.close()
+def _top_titles(conn, exprs, user_id, limit, after, selected_libraries):
+    return _ranked_titles(conn, exprs, user_id, 'plays DESC, last_dt DESC', limit, after, selected_libraries)
 
 
-def db_get_user_watch_history_all(db_path: str, user_id: str, selected_libraries: Optional[List[str]] = None):
-    conn = _connect(db_path)
-    try:
-        return _select_history(conn, user_id, after=None, limit=None, selected_libraries=selected_libraries)
-    finally:
-        conn.close()
+def _recent_titles(conn, exprs, user_id, limit, after, selected_libraries):
+    return _ranked_titles(conn, exprs, user_id, 'last_dt DESC', limit, after, selected_libraries)
+
+
+def _watched_titles(conn, exprs, user_id, after, selected_libraries) -> Dict[str, set]:
+    where_sql, params = _history_where(exprs, user_id, after=after, selected_libraries=selected_libraries)
+    cur = conn.cursor()
+    cur.execute(
+        f"SELECT DISTINCT sh.media_type, {exprs['display_title']} AS dtitle {where_sql}"
+        f"AND sh.media_type IN ('episode', 'movie')",
+        params,
+    )
+    out: Dict[str, set] = {'episode': set(), 'movie': set()}
+    for media_type, title in cur.fetchall():
+        if title:
+            out.setdefault(media_type, set()).add(title)
+    return out
+
+
+def _count_history(conn, exprs, user_id, after, selected_libraries) -> int:
+    where_sql, params = _history_where(exprs, user_id, after=after, selected_libraries=selected_libraries)
+    cur = conn.cursor()
+    cur.execute(f"SELECT COUNT(*) {where_sql}", params)
+    row = cur.fetchone()
+    return int(row[0] or 0) if row else 0
+
+
+def db_get_history_aggregates(db_path: str, user_id: str, recent_after: Optional[int] = None, top_n: int = 3, recent_n: int = 10, selected_libraries: Optional[List[str]] = None) -> Dict:
+    """Everything the recommender needs from history, computed in SQL on one connection.
+
+    - top / recent: within the `recent_after` window
+    - watched_all / watched_recent_all: all-time distinct titles per type, as a set and
+      as a list ordered by most recent play
+    """
+    with db_connection(db_path) as conn:
+        exprs = _history_exprs(conn, get_schema(db_path, conn))
+        if exprs is None:
+            empty = {'episode': [], 'movie': []}
+            return {'top': empty, 'recent': empty, 'recent_window_titles': {'episode': set(), 'movie': set()},
+                    'watched_all': {'episode': set(), 'movie': set()}, 'watched_recent_all': empty, 'history_count': 0}
+        top = _top_titles(conn, exprs, user_id, top_n, recent_after, selected_libraries)
+        recent = _recent_titles(conn, exprs, user_id, recent_n, recent_after, selected_libraries)
+        recent_window = _watched_titles(conn, exprs, user_id, recent_after, selected_libraries)
+        watched_recent_all = _recent_titles(conn, exprs, user_id, None, None, selected_libraries)
+        count = _count_history(conn, exprs, user_id, None, selected_libraries)
+    return {
+        'top': {mt: [t for t, _, _ in rows] for mt, rows in top.items()},
+        'recent': {mt: [t for t, _, _ in rows] for mt, rows in recent.items()},
+        'recent_window_titles': recent_window,
+        'watched_all': {mt: {t for t, _, _ in rows} for mt, rows in watched_recent_all.items()},
+        'watched_recent_all': {mt: [t for t, _, _ in rows] for mt, rows in watched_recent_all.items()},
+        'history_count': count,
+    }
+
 
+def db_get_history_watermark(db_path: str, user_id: str) -> tuple:
+    """Cheap change marker for a user's history: (play count, max session_history id).
+
+    Any new, imported or deleted play changes it, so cached summaries can be reused
+    until it moves."""
+    with db_connection(db_path) as conn:
+        cols = get_schema(db_path, conn).columns(conn, 'session_history')
+        if 'user_id' not in cols:
+            return (0, None)
+        key_col = 'id' if 'id' in cols else ('started' if 'started' in cols else None)
+        max_expr = f"MAX({key_col})" if key_col else 'NULL'
+        cur = conn.cursor()
+        cur.execute(f"SELECT COUNT(*), {max_expr} FROM session_history WHERE user_id = ?", (user_id,))
+        row = cur.fetchone() or (0, None)
+        return (int(row[0] or 0), row[1])
+
+
+def db_get_max_history_id(db_path: str) -> Optional[int]:
+    """Highest session_history id (rowid lookup, constant time); None if the column is missing."""
+    with db_connection(db_path) as conn:
+        if 'id' not in get_schema(db_path, conn).columns(conn, 'session_history'):
+            return None
+        cur = conn.cursor()
+        cur.execute("SELECT MAX(id) FROM session_history")
+        row = cur.fetchone()
+        return int(row[0]) if row and row[0] is not None else 0
 
-def db_get_all_library_titles(db_path: str, media_type: str) -> List[str]:
+
+def db_iter_plays_since(db_path: str, after_id: int, batch_size: int = 5000):
+    """Yield batches of (id, user_id, media_type, display_title, date, section_id) for plays
+    with session_history.id > after_id, in id order. Used to sync the local history replica."""
+    last_id = int(after_id or 0)
+    while True:
+        with db_connection(db_path) as conn:
+            schema = get_schema(db_path, conn)
+            if 'id' not in schema.columns(conn, 'session_history'):
+                return
+            exprs = _history_exprs(conn, schema)
+            if exprs is None:
+                return
+            section_expr = exprs['section_id'] or 'NULL'
+            cur = conn.cursor()
+            cur.execute(
+                f"SELECT sh.id, sh.user_id, sh.media_type, {exprs['display_title']}, {exprs['date']}, {section_expr} "
+                "FROM session_history sh "
+                "LEFT JOIN session_history_metadata sm ON sm.rating_key = sh.rating_key "
+                "WHERE sh.id > ? ORDER BY sh.id LIMIT ?",
+                (last_id, int(batch_size)),
+            )
+            batch = cur.fetchall()
+        if not batch:
+            return
+        last_id = batch[-1][0]
+        yield batch
+        if len(batch) < batch_size:
+            return
+
+
+def db_get_all_library_titles(db_path: str, media_type: str, section_ids: Optional[List[str]] = None) -> List[str]:
     """Best-effort extraction of full library item titles for a media type from the Tautulli DB.
 
     Tautulli's schema can vary a bit by version. We attempt several strategies:
       1. If table 'library_media_info' exists, use it (preferred) filtering by a type column.
       2. Fallback: If only watched metadata exists (session_history_metadata), we return the
          union of watched titles (this is incomplete for availability, but better than empty).
+    When section_ids is given and the table carries a section_id column, only those libraries are read.
     Returns a sorted, de-duplicated list. May be partial if fallback path used.
     """
-    conn = _connect(db_path)
-    try:
+    with db_connection(db_path) as conn:
+        schema = get_schema(db_path, conn)
         cur = conn.cursor()
-        cur.execute("SELECT name FROM sqlite_master WHERE type='table'")
-        tables = {row[0] for row in cur.fetchall()}
+        tables = schema.tables
         titles = set()
         partial = False
         if 'library_media_info' in tables:
-            cols = _get_columns(conn, 'library_media_info')
+            cols = schema.columns(conn, 'library_media_info')
             # Determine type column
             type_col = None
             for cand in ('section_type', 'media_type'):
@@ -183,20 +487,26 @@ def db_get_all_library_titles(db_path: str, media_type: str) -> List[str]:
                     type_col = cand
                     break
             if 'title' in cols:
+                where = []
+                params = []
+                if section_ids and 'section_id' in cols:
+                    where.append(f"section_id IN ({','.join('?' for _ in section_ids)})")
+                    params.extend(section_ids)
+                base_sql = "SELECT DISTINCT title FROM library_media_info"
                 if type_col:
                     try:
-                        cur.execute(f"SELECT DISTINCT title FROM library_media_info WHERE {type_col}=?", (media_type,))
+                        cur.execute(f"{base_sql} WHERE {' AND '.join(where + [f'{type_col}=?'])}", params + [media_type])
                     except Exception:
-                        cur.execute("SELECT DISTINCT title FROM library_media_info")
+                        cur.execute(base_sql + (f" WHERE {' AND '.join(where)}" if where else ''), params)
                 else:
-                    cur.execute("SELECT DISTINCT title FROM library_media_info")
+                    cur.execute(base_sql + (f" WHERE {' AND '.join(where)}" if where else ''), params)
                 for (t,) in cur.fetchall():
                     if t:
                         titles.add(t)
         # Fallback: use watched metadata (incomplete)
         if not titles and 'session_history_metadata' in tables:
             partial = True
-            sh_cols = _get_columns(conn, 'session_history_metadata')
+            sh_cols = schema.columns(conn, 'session_history_metadata')
             if 'title' in sh_cols or 'grandparent_title' in sh_cols:
                 q_parts = []
                 if media_type == 'movie' and 'title' in sh_cols:
@@ -227,5 +537,3 @@ def db_get_all_library_titles(db_path: str, media_type: str) -> List[str]:
             except Exception:
                 pass
         return out
-    finally:
-        conn.close()
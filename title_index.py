@@ -0,0 +1,92 @@
+from collections import defaultdict
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from rapidfuzz import fuzz
+
+from title_normalize import normalize_titles
+from title_matcher import score_one_to_many
+
+
+def _trigrams(text: str) -> set:
+    padded = f"  {text} "
+    return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+
+def _grams(text: str) -> set:
+    grams = {f"w:{tok}" for tok in text.split()}
+    grams.update(f"t:{g}" for g in _trigrams(text))
+    return grams
+
+
+class TitleIndex:
+    """Token + trigram inverted index over normalized library titles.
+
+    ``candidates()`` returns a small set of title ids sharing the most (and rarest)
+    grams with the query, so fuzzy verification only runs on a handful of titles
+    instead of the whole library.
+    """
+
+    def __init__(self, titles: Iterable[str], max_candidates: int = 64, max_posting_fraction: float = 0.05, posting_budget: int = 4000):
+        self.titles: List[str] = list(titles)
+        self.normalized: List[str] = normalize_titles(self.titles)
+        self.max_candidates = max_candidates
+        self._posting_budget = posting_budget
+        self._exact: Dict[str, int] = {}
+        postings = defaultdict(list)
+        for idx, norm in enumerate(self.normalized):
+            if not norm:
+                continue
+            self._exact.setdefault(norm, idx)
+            for gram in _grams(norm):
+                postings[gram].append(idx)
+        self._postings = {g: np.asarray(ids, dtype=np.int32) for g, ids in postings.items()}
+        # Grams shared by a large slice of the library carry little signal
+        self._max_posting = max(1000, int(len(self.titles) * max_posting_fraction))
+
+    def __len__(self):
+        return len(self.titles)
+
+    def exact(self, normalized_query: str) -> Optional[int]:
+        return self._exact.get(normalized_query)
+
+    def candidates(self, normalized_query: str, limit: Optional[int] = None) -> List[int]:
+        if not normalized_query:
+            return []
+        limit = limit or self.max_candidates
+        lists = [self._postings[g] for g in _grams(normalized_query) if g in self._postings]
+        if not lists:
+            return []
+        lists.sort(key=len)
+        selective = [p for p in lists if len(p) <= self._max_posting] or lists[:2]
+        # Count overlaps from the rarest grams only, within a fixed posting budget
+        chosen = []
+        budget = self._posting_budget
+        for posting in selective:
+            if budget <= 0:
+                break
+            budget -= len(posting)
+            chosen.append(posting)
+        ids, counts = np.unique(np.concatenate(chosen), return_counts=True)
+        if len(ids) <= limit:
+            return ids.tolist()
+        top = np.argpartition(counts, -limit)[-limit:]
+        return ids[top[np.argsort(counts[top])[::-1]]].tolist()
+
+    def match(self, normalized_query: str, score_cutoff: float = 70) -> Tuple[Optional[int], float]:
+        """Best (title id, score) for a normalized query, verified with fuzz.ratio."""
+        hit = self.exact(normalized_query)
+        if hit is not None:
+            return hit, 100.0
+        cand = self.candidates(normalized_query)
+        if not cand:
+            return None, 0.0
+        scores = score_one_to_many(normalized_query, [self.normalized[i] for i in cand], scorer=fuzz.ratio)
+        best_pos = int(scores.argmax())
+        best_score = float(scores[best_pos])
+        if best_score < score_cutoff:
+            return None, 0.0
+        return cand[best_pos], best_score
+
+    def match_many(self, normalized_queries: Iterable[str], score_cutoff: float = 70) -> List[Tuple[Optional[int], float]]:
+        return [self.match(q, score_cutoff) for q in normalized_queries]
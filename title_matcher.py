@@ -0,0 +1,61 @@
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+from rapidfuzz import fuzz, process
+
+
+def score_one_to_many(query: str, choices: Sequence[str], scorer: Callable = fuzz.ratio, workers: int = 1) -> np.ndarray:
+    """Score a single (already normalized) query against every choice in one call."""
+    if not choices:
+        return np.zeros(0, dtype=np.float32)
+    return process.cdist([query], list(choices), scorer=scorer, workers=workers)[0]
+
+
+def score_matrix(queries: Sequence[str], choices: Sequence[str], scorer: Callable = fuzz.ratio, score_cutoff: Optional[float] = None, workers: int = -1) -> np.ndarray:
+    """Return a len(queries) x len(choices) similarity matrix using all cores.
+
+    Scores below score_cutoff come back as 0, which lets rapidfuzz skip work early.
+    """
+    if not queries or not choices:
+        return np.zeros((len(queries or []), len(choices or [])), dtype=np.float32)
+    return process.cdist(list(queries), list(choices), scorer=scorer, score_cutoff=score_cutoff, workers=workers)
+
+
+def best_matches(
+    queries: Sequence[str],
+    choices: Sequence[str],
+    scorer: Callable = fuzz.ratio,
+    score_cutoff: float = 0,
+    workers: int = -1,
+    query_years: Optional[Sequence[Optional[int]]] = None,
+    choice_years: Optional[Sequence[Optional[int]]] = None,
+    year_tolerance: int = 1,
+) -> List[Tuple[Optional[int], float]]:
+    """Best choice index and score per query (None, 0.0 when nothing reaches score_cutoff).
+
+    When both sides carry years, candidates whose known year differs from the query year
+    by more than year_tolerance are dropped (remakes / same-name titles); candidates with
+    an unknown year are kept.
+    """
+    if not queries:
+        return []
+    if not choices:
+        return [(None, 0.0) for _ in queries]
+    matrix = score_matrix(queries, choices, scorer=scorer, score_cutoff=score_cutoff or None, workers=workers)
+    if query_years is not None and choice_years is not None:
+        cy = np.array([y if isinstance(y, (int, float)) else np.nan for y in choice_years], dtype=np.float64)
+        for qi, qy in enumerate(query_years):
+            if not isinstance(qy, (int, float)):
+                continue
+            mismatch = np.abs(cy - float(qy)) > year_tolerance  # NaN compares False -> kept
+            if mismatch.any():
+                matrix[qi, mismatch] = 0
+    best_idx = matrix.argmax(axis=1)
+    best_scores = matrix[np.arange(len(queries)), best_idx]
+    out = []
+    for idx, score in zip(best_idx.tolist(), best_scores.tolist()):
+        if score <= 0 or score < score_cutoff:
+            out.append((None, 0.0))
+        else:
+            out.append((int(idx), float(score)))
+    return out
@@ -0,0 +1,155 @@
+import re
+from functools import lru_cache
+from typing import Iterable, List
+
+
+# Precompiled patterns (previously rebuilt on every normalize_title call)
+_AMP_RE = re.compile(r'\s*&\s*')
+_PLUS_RE = re.compile(r'\s*\+\s*')
+# Important differentiators kept as suffixes (Jr, Sr, II, III, ...); order matters
+_SUFFIX_RES = [(suffix, re.compile(rf'\b{suffix}\.?\s*$')) for suffix in ('jr', 'sr', 'ii', 'iii', 'iv', 'v')]
+_NON_ALNUM_RE = re.compile(r'[^a-z0-9 ]')
+_LEADING_ARTICLE_RES = [re.compile(r'^\bthe\b\s+'), re.compile(r'^\ba\b\s+'), re.compile(r'^\ban\b\s+')]
+_MULTI_SPACE_RE = re.compile(r'\s+')
+
+_ANTHOLOGY_RES = [
+    re.compile(r'^(.*?)\s+of\s+[^:]+$'),  # "The Haunting of Hill House" -> "The Haunting"
+    re.compile(r'^(.*?):\s+.*$'),          # "American Horror Story: Coven" -> "American Horror Story"
+]
+_VERSION_SUFFIX_RES = [
+    re.compile(r'\s+xl\b'),                   # "QI XL" -> "QI"
+    re.compile(r'\s+extended\b'),             # "Movie Extended" -> "Movie"
+    re.compile(r'\s+uncut\b'),                # "Movie Uncut" -> "Movie"
+    re.compile(r'\s+directors?\s*cut\b'),     # "Movie Director's Cut" -> "Movie" (handles apostrophe)
+    re.compile(r'\s+ultimate\s+edition\b'),   # "Movie Ultimate Edition" -> "Movie"
+    re.compile(r'\s+special\s+edition\b'),    # "Movie Special Edition" -> "Movie"
+    re.compile(r'\s+remastered\b'),           # "Movie Remastered" -> "Movie"
+    re.compile(r'\s+redux\b'),                # "Movie Redux" -> "Movie"
+    re.compile(r'\s+\d+th\s+anniversary\b'),  # "Movie 25th Anniversary" -> "Movie"
+]
+_YEAR_SUFFIX_RE = re.compile(r'\s*\(\d{4}\)\s*$')
+
+_NORMALIZE_CACHE_SIZE = 65536
+_VARIATIONS_CACHE_SIZE = 16384
+
+
+@lru_cache(maxsize=_NORMALIZE_CACHE_SIZE)
+def _normalize_cached(title: str) -> str:
+    t = title.lower()
+
+    # Handle common character/word substitutions before removing special chars
+    t = _AMP_RE.sub(' and ', t)
+    t = _PLUS_RE.sub(' and ', t)
+
+    # Preserve important differentiators before normalization
+    preserved_suffix = ''
+    for suffix, pattern in _SUFFIX_RES:
+        if pattern.search(t):
+            preserved_suffix = f' {suffix}'
+            t = pattern.sub('', t).strip()
+            break
+
+    # Remove all non-alphanumeric except spaces
+    t = _NON_ALNUM_RE.sub('', t)
+
+    # Remove leading articles but KEEP "and" as it's often significant
+    for pattern in _LEADING_ARTICLE_RES:
+        t = pattern.sub('', t)
+
+    # Clean up multiple spaces and add back preserved suffix
+    t = _MULTI_SPACE_RE.sub(' ', t).strip()
+    t += preserved_suffix
+    return t.strip()
+
+
+def normalize_title(title: str) -> str:
+    if not title:
+        return ''
+    return _normalize_cached(title)
+
+
+def normalize_titles(titles: Iterable[str]) -> List[str]:
+    """Normalize a list of titles in one pass, preserving order (duplicates share one lookup)."""
+    local = {}
+    out = []
+    for t in titles:
+        if not t:
+            out.append('')
+            continue
+        n = local.get(t)
+        if n is None:
+            n = _normalize_cached(t)
+            local[t] = n
+        out.append(n)
+    return out
+
+
+@lru_cache(maxsize=_VARIATIONS_CACHE_SIZE)
+def _variations_cached(title: str) -> frozenset:
+    variations = set()
+    title_lower = title.lower()
+
+    # Always add the normalized version
+    normalized = _normalize_cached(title)
+    if normalized:
+        variations.add(normalized)
+
+    # Add original lowercased
+    variations.add(title_lower)
+
+    # Handle anthology series patterns
+    for pattern in _ANTHOLOGY_RES:
+        match = pattern.match(title_lower)
+        if match:
+            anthology_base = match.group(1).strip()
+            if anthology_base:
+                variations.add(anthology_base)
+                anthology_normalized = normalize_title(anthology_base)
+                if anthology_normalized:
+                    variations.add(anthology_normalized)
+
+    # Remove common version suffixes for core matching
+    for pattern in _VERSION_SUFFIX_RES:
+        base_title = pattern.sub('', title_lower)
+        if base_title != title_lower:
+            variations.add(base_title)
+            base_normalized = normalize_title(base_title)
+            if base_normalized:
+                variations.add(base_normalized)
+
+    # Remove articles from beginning
+    for article in ('the ', 'a ', 'an '):
+        if title_lower.startswith(article):
+            variant = title_lower[len(article):]
+            variations.add(variant)
+            variant_normalized = normalize_title(variant)
+            if variant_normalized:
+                variations.add(variant_normalized)
+
+    # Remove year from title if present
+    title_no_year = _YEAR_SUFFIX_RE.sub('', title_lower)
+    if title_no_year != title_lower:
+        variations.add(title_no_year)
+        no_year_normalized = normalize_title(title_no_year)
+        if no_year_normalized:
+            variations.add(no_year_normalized)
+
+    variations.discard('')
+    return frozenset(variations)
+
+
+def get_title_variations(title: str) -> set[str]:
+    """Generate multiple variations of a title for better matching"""
+    if not title:
+        return set()
+    return set(_variations_cached(title))
+
+
+def cache_info() -> dict:
+    """Hit/miss counters for the normalization memos (exposed on /cache)."""
+    n = _normalize_cached.cache_info()
+    v = _variations_cached.cache_info()
+    return {
+        'normalize': {'hits': n.hits, 'misses': n.misses, 'size': n.currsize, 'max': n.maxsize},
+        'variations': {'hits': v.hits, 'misses': v.misses, 'size': v.currsize, 'max': v.maxsize},
+    }
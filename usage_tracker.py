@@ -1,7 +1,11 @@
+import atexit
+import math
 import os
 import sqlite3
 import datetime
 import sys
+import threading
+import time
 
 def get_data_directory():
     """Get appropriate data directory for both development and compiled .exe"""
@@ -27,81 +31,302 @@ def get_data_directory():
 DB_PATH = os.path.join(get_data_directory(), 'usage.db')
 
 
-def init_usage_db():
-    try:
-        conn = sqlite3.connect(DB_PATH)
-        c = conn.cursor()
-        c.execute(
-            """
-            CREATE TABLE IF NOT EXISTS usage (
-                date TEXT NOT NULL,
-                model TEXT NOT NULL,
-                calls INTEGER NOT NULL DEFAULT 0,
-                prompt_tokens INTEGER NOT NULL DEFAULT 0,
-                candidates_tokens INTEGER NOT NULL DEFAULT 0,
-                total_tokens INTEGER NOT NULL DEFAULT 0,
-                PRIMARY KEY (date, model)
-            )
-            """
-        )
-        conn.commit()
-    finally:
+# Flush buffered counters to disk at most this often (seconds)
+FLUSH_INTERVAL = 5.0
+
+_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS usage (
+        date TEXT NOT NULL,
+        model TEXT NOT NULL,
+        calls INTEGER NOT NULL DEFAULT 0,
+        prompt_tokens INTEGER NOT NULL DEFAULT 0,
+        candidates_tokens INTEGER NOT NULL DEFAULT 0,
+        total_tokens INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (date, model)
+    )
+"""
+
+# Per-call AI telemetry (one row per model attempt, including failed fallbacks)
+_CALLS_SCHEMA_SQL = """
+    CREATE TABLE IF NOT EXISTS ai_calls (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        ts REAL NOT NULL,
+        provider TEXT NOT NULL,
+        model TEXT NOT NULL,
+        latency_ms REAL,
+        prompt_tokens INTEGER,
+        output_tokens INTEGER,
+        parse_ok INTEGER NOT NULL DEFAULT 0,
+        position INTEGER NOT NULL DEFAULT 0,
+        error TEXT
+    )
+"""
+CALLS_RETENTION_DAYS = 30
+
+# In-memory state: totals served to readers, pending deltas not yet on disk
+_STATE_LOCK = threading.Lock()
+_TOTALS = {}      # (date, model) -> [calls, prompt_tokens, candidates_tokens, total_tokens]
+_PENDING = {}     # (date, model) -> same, unflushed
+_IN_FLIGHT = []   # batches taken by a running flush: {'rows': {(date, model): [...]}, 'on_disk': bool}
+_LOADED_DATES = set()
+_PENDING_CALLS = []  # telemetry rows not yet on disk
+_LAST_PRUNE = 0.0
+
+# One long-lived WAL connection, used by the flusher and the once-per-day loads
+_DB_LOCK = threading.Lock()
+_CONN = None
+_FLUSHER = None
+
+
+def _get_conn():
+    global _CONN
+    if _CONN is None:
+        conn = sqlite3.connect(DB_PATH, check_same_thread=False)
         try:
-            conn.close()
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
         except Exception:
             pass
+        conn.execute(_SCHEMA_SQL)
+        conn.execute(_CALLS_SCHEMA_SQL)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_ai_calls_ts ON ai_calls (ts)")
+        conn.commit()
+        _CONN = conn
+    return _CONN
+
+
+def init_usage_db():
+    """Create the usage table if needed (runs once per process on the shared connection)."""
+    with _DB_LOCK:
+        _get_conn()
 
 
 def _today():
     return str(datetime.date.today())
 
 
+def _ensure_day_loaded(day: str):
+    """Seed in-memory totals for a date from disk once. Caller holds _STATE_LOCK.
+
+    Totals for the day are replaced by disk + unflushed counts, so calls recorded while
+    an earlier load failed (and maybe flushed since) are not counted twice."""
+    if day in _LOADED_DATES:
+        return
+    try:
+        with _DB_LOCK:
+            rows = _get_conn().execute(
+                "SELECT model, calls, prompt_tokens, candidates_tokens, total_tokens FROM usage WHERE date = ?", (day,)
+            ).fetchall()
+            # Batches committed by now are in rows; the others are not on disk yet
+            unflushed = [b['rows'] for b in _IN_FLIGHT if not b['on_disk']] + [_PENDING]
+    except Exception as e:
+        print(f"DEBUG: usage load failed for {day}: {e}")
+        return
+    for key in [k for k in _TOTALS if k[0] == day]:
+        del _TOTALS[key]
+    for model, calls, pt, ct, tt in rows:
+        _TOTALS[(day, model)] = [calls, pt, ct, tt]
+    for store in unflushed:
+        for (d, model), vals in store.items():
+            if d == day:
+                cur = _TOTALS.setdefault((d, model), [0, 0, 0, 0])
+                for i, v in enumerate(vals):
+                    cur[i] += v
+    _LOADED_DATES.add(day)
+    # Keep only today's (and yesterday's, around midnight) totals in memory
+    for key in [k for k in _TOTALS if k[0] < day and k not in _PENDING]:
+        _TOTALS.pop(key, None)
+    _LOADED_DATES.intersection_update({d for d, _ in _TOTALS} | {day})
+
+
+def flush():
+    """Write pending counters and telemetry rows in one transaction. Safe to call from any thread."""
+    global _LAST_PRUNE
+    with _STATE_LOCK:
+        if not _PENDING and not _PENDING_CALLS:
+            return 0
+        batch = [(day, model, *vals) for (day, model), vals in _PENDING.items()]
+        calls = list(_PENDING_CALLS)
+        in_flight = {'rows': dict(_PENDING), 'on_disk': False}
+        _IN_FLIGHT.append(in_flight)
+        _PENDING.clear()
+        _PENDING_CALLS.clear()
+    try:
+        with _DB_LOCK:
+            conn = _get_conn()
+            conn.executemany(
+                "INSERT INTO usage(date, model, calls, prompt_tokens, candidates_tokens, total_tokens) VALUES(?,?,?,?,?,?) "
+                "ON CONFLICT(date, model) DO UPDATE SET calls = calls + excluded.calls, "
+                "prompt_tokens = prompt_tokens + excluded.prompt_tokens, candidates_tokens = candidates_tokens + excluded.candidates_tokens, "
+                "total_tokens = total_tokens + excluded.total_tokens",
+                batch,
+            )
+            conn.executemany(
+                "INSERT INTO ai_calls(ts, provider, model, latency_ms, prompt_tokens, output_tokens, parse_ok, position, error) "
+                "VALUES(?,?,?,?,?,?,?,?,?)",
+                calls,
+            )
+            if time.time() - _LAST_PRUNE > 24 * 3600:
+                conn.execute("DELETE FROM ai_calls WHERE ts < ?", (time.time() - CALLS_RETENTION_DAYS * 24 * 3600,))
+                _LAST_PRUNE = time.time()
+            conn.commit()
+            in_flight['on_disk'] = True
+    except Exception as e:
+        # Put the deltas back so the next flush retries them
+        print(f"DEBUG: usage flush failed: {e}")
+        with _STATE_LOCK:
+            _IN_FLIGHT.remove(in_flight)
+            for day, model, n, pt, ct, tt in batch:
+                cur = _PENDING.setdefault((day, model), [0, 0, 0, 0])
+                cur[0] += n
+                cur[1] += pt
+                cur[2] += ct
+                cur[3] += tt
+            _PENDING_CALLS[:0] = calls
+        return 0
+    with _STATE_LOCK:
+        _IN_FLIGHT.remove(in_flight)
+    return len(batch) + len(calls)
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_INTERVAL)
+        flush()
+
+
+def _ensure_flusher():
+    global _FLUSHER
+    if _FLUSHER is None:
+        with _STATE_LOCK:
+            if _FLUSHER is None:
+                _FLUSHER = threading.Thread(target=_flush_loop, name='usage-flush', daemon=True)
+                _FLUSHER.start()
+
+
+atexit.register(flush)
+
+
 def record_usage(model: str, prompt_tokens: int | None, candidates_tokens: int | None, total_tokens: int | None):
+    """Count one AI call. Only touches memory; the background thread persists it."""
     if not model:
         return
-    init_usage_db()
     pt = int(prompt_tokens or 0)
     ct = int(candidates_tokens or 0)
     tt = int(total_tokens or (pt + ct))
     day = _today()
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        c = conn.cursor()
-        c.execute(
-            "INSERT INTO usage(date, model, calls, prompt_tokens, candidates_tokens, total_tokens) VALUES(?,?,?,?,?,?) "
-            "ON CONFLICT(date, model) DO UPDATE SET calls = calls + excluded.calls, "
-            "prompt_tokens = prompt_tokens + excluded.prompt_tokens, candidates_tokens = candidates_tokens + excluded.candidates_tokens, "
-            "total_tokens = total_tokens + excluded.total_tokens",
-            (day, model, 1, pt, ct, tt),
-        )
-        conn.commit()
-    finally:
-        conn.close()
+    _ensure_flusher()
+    with _STATE_LOCK:
+        _ensure_day_loaded(day)
+        for store in (_TOTALS, _PENDING):
+            cur = store.setdefault((day, model), [0, 0, 0, 0])
+            cur[0] += 1
+            cur[1] += pt
+            cur[2] += ct
+            cur[3] += tt
+
+
+def _as_dict(vals):
+    return {"calls": vals[0], "prompt_tokens": vals[1], "candidates_tokens": vals[2], "total_tokens": vals[3]}
 
 
 def get_usage_today(model: str):
-    init_usage_db()
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        c = conn.cursor()
-        c.execute("SELECT calls, prompt_tokens, candidates_tokens, total_tokens FROM usage WHERE date = ? AND model = ?", (_today(), model))
-        row = c.fetchone()
-        if not row:
-            return {"calls": 0, "prompt_tokens": 0, "candidates_tokens": 0, "total_tokens": 0}
-        return {"calls": row[0], "prompt_tokens": row[1], "candidates_tokens": row[2], "total_tokens": row[3]}
-    finally:
-        conn.close()
+    day = _today()
+    with _STATE_LOCK:
+        _ensure_day_loaded(day)
+        vals = _TOTALS.get((day, model))
+        return _as_dict(vals) if vals else {"calls": 0, "prompt_tokens": 0, "candidates_tokens": 0, "total_tokens": 0}
 
 
 def get_usage_today_all():
-    init_usage_db()
-    conn = sqlite3.connect(DB_PATH)
-    try:
-        c = conn.cursor()
-        c.execute("SELECT model, calls, prompt_tokens, candidates_tokens, total_tokens FROM usage WHERE date = ?", (_today(),))
-        out = {}
-        for model, calls, pt, ct, tt in c.fetchall():
-            out[model] = {"calls": calls, "prompt_tokens": pt, "candidates_tokens": ct, "total_tokens": tt}
-        return out
-    finally:
-        conn.close()
+    day = _today()
+    with _STATE_LOCK:
+        _ensure_day_loaded(day)
+        return {model: _as_dict(vals) for (d, model), vals in _TOTALS.items() if d == day}
+
+
+def record_call(provider: str, model: str, latency_ms: float | None, prompt_tokens: int | None = None,
+                output_tokens: int | None = None, parse_ok: bool = False, position: int = 0, error: str | None = None):
+    """Log one AI attempt for latency/quality telemetry (buffered like record_usage).
+
+    position is the attempt's index in the model fallback order (0 = first choice)."""
+    if not model:
+        return
+    row = (
+        time.time(),
+        provider or '',
+        model,
+        float(latency_ms) if latency_ms is not None else None,
+        int(prompt_tokens) if prompt_tokens is not None else None,
+        int(output_tokens) if output_tokens is not None else None,
+        1 if parse_ok else 0,
+        int(position or 0),
+        (str(error)[:300] if error else None),
+    )
+    _ensure_flusher()
+    with _STATE_LOCK:
+        _PENDING_CALLS.append(row)
+
+
+def _percentile(sorted_vals, pct):
+    """Nearest-rank percentile of an already sorted list."""
+    if not sorted_vals:
+        return None
+    k = max(0, min(len(sorted_vals) - 1, int(math.ceil(pct / 100.0 * len(sorted_vals))) - 1))
+    return round(sorted_vals[k], 1)
+
+
+def get_call_stats(hours: float = 24):
+    """Rolling per provider/model stats over the last `hours`: latency p50/p95/p99 (ms),
+    parse success rate, mean tokens and how often each fallback position served."""
+    flush()
+    since = time.time() - float(hours) * 3600
+    with _DB_LOCK:
+        rows = _get_conn().execute(
+            "SELECT provider, model, latency_ms, prompt_tokens, output_tokens, parse_ok, position, error "
+            "FROM ai_calls WHERE ts >= ? ORDER BY ts",
+            (since,),
+        ).fetchall()
+    groups = {}
+    for provider, model, latency, pt, ot, ok, pos, err in rows:
+        g = groups.setdefault(f"{provider}/{model}", {
+            'provider': provider, 'model': model, 'calls': 0, 'parse_ok': 0, 'errors': 0,
+            '_lat': [], '_ok_lat': [], '_pt': [], '_ot': [], 'positions': {},
+        })
+        g['calls'] += 1
+        g['parse_ok'] += 1 if ok else 0
+        g['errors'] += 1 if err else 0
+        if latency is not None:
+            g['_lat'].append(latency)
+            if ok:
+                g['_ok_lat'].append(latency)
+        if pt is not None:
+            g['_pt'].append(pt)
+        if ot is not None:
+            g['_ot'].append(ot)
+        g['positions'][str(pos)] = g['positions'].get(str(pos), 0) + 1
+    out = {}
+    for key, g in groups.items():
+        lat = sorted(g.pop('_lat'))
+        ok_lat = sorted(g.pop('_ok_lat'))
+        pts = g.pop('_pt')
+        ots = g.pop('_ot')
+        g['parse_rate'] = round(g['parse_ok'] / g['calls'], 3) if g['calls'] else None
+        g['latency_ms'] = {'p50': _percentile(lat, 50), 'p95': _percentile(lat, 95), 'p99': _percentile(lat, 99)}
+        g['latency_ms_ok'] = {'p50': _percentile(ok_lat, 50), 'p95': _percentile(ok_lat, 95), 'p99': _percentile(ok_lat, 99)}
+        g['avg_prompt_tokens'] = round(sum(pts) / len(pts)) if pts else None
+        g['avg_output_tokens'] = round(sum(ots) / len(ots)) if ots else None
+        out[key] = g
+    return out
+
+
+def get_recent_calls(limit: int = 20):
+    flush()
+    with _DB_LOCK:
+        rows = _get_conn().execute(
+            "SELECT ts, provider, model, latency_ms, prompt_tokens, output_tokens, parse_ok, position, error "
+            "FROM ai_calls ORDER BY id DESC LIMIT ?",
+            (int(limit),),
+        ).fetchall()
+    keys = ('ts', 'provider', 'model', 'latency_ms', 'prompt_tokens', 'output_tokens', 'parse_ok', 'position', 'error')
+    return [dict(zip(keys, r)) for r in rows]
@@ -0,0 +1,209 @@
+import bisect
+import hashlib
+import threading
+import time
+from typing import Callable, Dict, List, Optional
+
+
+def _hash_users(user_list) -> Optional[str]:
+    try:
+        # Build a stable hash based on user_id + username + email
+        parts = []
+        for u in user_list or []:
+            try:
+                parts.append(f"{u.get('user_id')}|{(u.get('username') or '').lower()}|{(u.get('email') or '').lower()}")
+            except Exception:
+                continue
+        return hashlib.sha1('\n'.join(sorted(parts)).encode('utf-8')).hexdigest()
+    except Exception:
+        return None
+
+
+def display_name(user: Dict) -> str:
+    return str(user.get('friendly_name') or user.get('username') or user.get('user_id') or '')
+
+
+class _UserIndex:
+    """Immutable lookup tables over one user list (swapped atomically on refresh)."""
+
+    __slots__ = ('users', 'by_id', 'by_login', 'by_friendly', 'prefix_keys', 'prefix_pos',
+                 'name_keys', 'name_pos', 'display_rank')
+
+    def __init__(self, users: List[Dict]):
+        self.users = list(users or [])
+        self.by_id: Dict[str, Dict] = {}
+        # username/email (lowercased) -> list position of the first user with that value
+        self.by_login: Dict[str, int] = {}
+        self.by_friendly: Dict[str, int] = {}
+        prefix = []
+        for pos, u in enumerate(self.users):
+            uid = u.get('user_id')
+            if uid is not None:
+                self.by_id.setdefault(str(uid), u)
+            for field in ('username', 'email'):
+                val = str(u.get(field) or '').lower()
+                if val:
+                    self.by_login.setdefault(val, pos)
+                    prefix.append((val, pos))
+            fname = str(u.get('friendly_name') or '').lower()
+            if fname:
+                self.by_friendly.setdefault(fname, pos)
+        prefix.sort()
+        self.prefix_keys = [k for k, _ in prefix]
+        self.prefix_pos = [p for _, p in prefix]
+        # Display names (friendly_name or username), sorted for paging and name-prefix search
+        names = sorted((display_name(u).lower(), pos) for pos, u in enumerate(self.users))
+        self.name_keys = [k for k, _ in names]
+        self.name_pos = [p for _, p in names]
+        self.display_rank = {pos: rank for rank, pos in enumerate(self.name_pos)}
+
+    @staticmethod
+    def _range(keys: List[str], low: str):
+        lo = bisect.bisect_left(keys, low)
+        hi = bisect.bisect_left(keys, low + '\uffff', lo)
+        return lo, hi
+
+    def prefix_range(self, low: str):
+        """(lo, hi) slice of the sorted username/email keys starting with low."""
+        return self._range(self.prefix_keys, low)
+
+    def search(self, query: str):
+        """List positions of users whose display name, username or email starts with query,
+        in display-name order. An empty query returns everyone."""
+        low = (query or '').strip().lower()
+        if not low:
+            return self.name_pos
+        lo, hi = self._range(self.name_keys, low)
+        hits = set(self.name_pos[lo:hi])
+        lo, hi = self.prefix_range(low)
+        hits.update(self.prefix_pos[lo:hi])
+        return sorted(hits, key=self.display_rank.__getitem__)
+
+    def lookup(self, identifier: str) -> Optional[Dict]:
+        low = (identifier or '').strip().lower()
+        if not low:
+            return None
+        # Exact match against username/email first
+        pos = self.by_login.get(low)
+        if pos is not None:
+            return self.users[pos]
+        # Beginning match on username/email; the earliest user in list order wins
+        lo, hi = self.prefix_range(low)
+        if lo < hi:
+            return self.users[min(self.prefix_pos[lo:hi])]
+        # Friendly name exact match
+        pos = self.by_friendly.get(low)
+        if pos is not None:
+            return self.users[pos]
+        return None
+
+
+class UserDirectory:
+    """Cached Tautulli user list with O(1) id/login lookups and sorted prefix matching.
+
+    ``fetch`` returns the raw user list; it runs on a background thread every
+    ``refresh_interval`` seconds (started on first use) rather than per request.
+    A failed login lookup forces one refresh, at most every ``miss_refresh_interval``
+    seconds, so newly shared users can sign in without waiting for the next cycle.
+    """
+
+    def __init__(self, fetch: Callable[[], List[Dict]], refresh_interval: float = 300, miss_refresh_interval: float = 30):
+        self._fetch = fetch
+        self.refresh_interval = refresh_interval
+        self.miss_refresh_interval = miss_refresh_interval
+        self._index: Optional[_UserIndex] = None
+        self._hash: Optional[str] = None
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+        self._wake = threading.Event()
+        self.last_refresh = 0.0
+        self.last_error: Optional[str] = None
+
+    def refresh(self) -> bool:
+        """Fetch users now; rebuild the indexes only if membership changed. Returns True if changed."""
+        with self._refresh_lock:
+            self.last_refresh = time.time()
+            try:
+                users = self._fetch() or []
+            except Exception as e:
+                self.last_error = str(e)[:200]
+                return False
+            self.last_error = None
+            new_hash = _hash_users(users)
+            with self._lock:
+                if self._index is not None and new_hash and new_hash == self._hash:
+                    return False
+                # Keep the last good list if a refresh comes back empty (Tautulli briefly down)
+                if not users and self._index is not None and self._index.users:
+                    return False
+            index = _UserIndex(users)
+            with self._lock:
+                self._index = index
+                self._hash = new_hash
+            return True
+
+    def request_refresh(self) -> None:
+        """Wake the background refresher early (e.g. after settings changed)."""
+        self._ensure_started()
+        self._wake.set()
+
+    def _run(self) -> None:
+        while True:
+            self._wake.wait(self.refresh_interval)
+            self._wake.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                print(f"DEBUG: user directory refresh failed: {e}")
+
+    def _ensure_started(self) -> None:
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._run, name='user-directory', daemon=True)
+                    self._thread.start()
+
+    def _current(self) -> _UserIndex:
+        self._ensure_started()
+        index = self._index
+        if index is None or (not index.users and time.time() - self.last_refresh > self.miss_refresh_interval):
+            # First use (or still empty): fill synchronously once
+            self.refresh()
+            index = self._index or _UserIndex([])
+        return index
+
+    def users(self) -> List[Dict]:
+        return self._current().users
+
+    def get(self, user_id) -> Optional[Dict]:
+        if user_id is None:
+            return None
+        return self._current().by_id.get(str(user_id))
+
+    def lookup(self, identifier: str) -> Optional[Dict]:
+        """Match by username/email (exact, then prefix) or exact friendly_name."""
+        match = self._current().lookup(identifier)
+        if match is None and time.time() - self.last_refresh > self.miss_refresh_interval:
+            # Not found: pick up recently added users once, then retry
+            if self.refresh():
+                match = self._current().lookup(identifier)
+        return match
+
+    def search(self, query: str, page: int = 1, per_page: int = 25):
+        """One page of users matching a typeahead query: (total matches, users on this page)."""
+        index = self._current()
+        positions = index.search(query)
+        page = max(1, int(page or 1))
+        per_page = max(1, min(100, int(per_page or 25)))
+        start = (page - 1) * per_page
+        return len(positions), [index.users[pos] for pos in positions[start:start + per_page]]
+
+    def stats(self) -> Dict:
+        index = self._index
+        return {
+            'users': len(index.users) if index else 0,
+            'last_refresh': self.last_refresh,
+            'refresh_interval': self.refresh_interval,
+            'last_error': self.last_error,
+        }